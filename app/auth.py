@@ -1,10 +1,12 @@
 import os
+import uuid
 from datetime import datetime, timedelta
 from jose import JWTError, jwt  # Librería para manejar JSON Web Tokens (JWT)
 from passlib.context import CryptContext  # Librería para el hashing de contraseñas
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import bindparam
 from sqlalchemy.future import select
 from dotenv import load_dotenv
 
@@ -17,11 +19,16 @@ load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY")  # Clave secreta para firmar tokens
 ALGORITHM = "HS256"  # Algoritmo de firma para JWT (HMAC con SHA-256)
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
+# Vigencia del ticket para abrir el flujo de eventos (EventSource no envía cabeceras)
+EVENTOS_TICKET_SEGUNDOS = int(os.getenv("EVENTOS_TICKET_SEGUNDOS", "60"))
 
 # Contexto para el manejo de contraseñas (usa bcrypt por seguridad)
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 # Esquema para obtener el token de las cabeceras de la solicitud (Bearer)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
+# Consulta de cada petición autenticada: se construye una sola vez (ver app/crud.py)
+_USUARIO_POR_ID = select(Usuario).where(Usuario.id == bindparam("id"))
 
 
 # --- Funciones de Hashing de Contraseña ---
@@ -51,8 +58,75 @@ def create_access_token(data: dict, expire_delta: timedelta = None):
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
+def create_refresh_token(data: dict, familia: str = None) -> str:
+    """
+    Crea un Refresh Token JWT de larga duración. Cada token tiene su propio
+    `jti` y hereda la `familia` del login original, para poder revocar la
+    cadena completa de rotaciones.
+    """
+    to_encode = data.copy()
+    expire = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    to_encode.update({
+        "exp": expire,
+        "type": "refresh",
+        "jti": uuid.uuid4().hex,
+        "fam": familia or uuid.uuid4().hex,
+    })
+    very_secret_key()
+    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+
+
+def decode_refresh_token(token: str) -> dict:
+    """Valida firma, expiración y tipo de un Refresh Token y devuelve su payload."""
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Refresh token inválido",
+    )
+    try:
+        very_secret_key()
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        int(payload["sub"])
+    except (JWTError, KeyError, ValueError):
+        raise credentials_exception
+    if payload.get("type") != "refresh" or not payload.get("jti") or not payload.get("fam"):
+        raise credentials_exception
+    return payload
+
+
+def create_ticket_eventos(usuario_id: int, negocio_id: int) -> str:
+    """
+    Ticket de corta duración para abrir /negocios/{id}/eventos desde el
+    navegador: va en la URL, así que solo sirve para ese usuario y negocio.
+    """
+    to_encode = {
+        "sub": str(usuario_id),
+        "neg": negocio_id,
+        "type": "eventos",
+        "exp": datetime.utcnow() + timedelta(seconds=EVENTOS_TICKET_SEGUNDOS),
+    }
+    very_secret_key()
+    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+
+
+def decode_ticket_eventos(ticket: str, negocio_id: int) -> int:
+    """Valida un ticket de eventos para `negocio_id` y devuelve el id del usuario."""
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Ticket de eventos inválido o vencido",
+    )
+    try:
+        very_secret_key()
+        payload = jwt.decode(ticket, SECRET_KEY, algorithms=[ALGORITHM])
+        usuario_id = int(payload["sub"])
+    except (JWTError, KeyError, ValueError):
+        raise credentials_exception
+    if payload.get("type") != "eventos" or payload.get("neg") != negocio_id:
+        raise credentials_exception
+    return usuario_id
+
+
 # --- Función de Dependencia (Autenticación) ---
-async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> Usuario:
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db, scope="function")) -> Usuario:
     """
     Función de dependencia de FastAPI que decodifica y valida el JWT,
     y luego busca el usuario asociado en la base de datos.
@@ -70,7 +144,8 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession
         # Decodifica el token
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         sub = payload.get("sub")
-        if sub is None:
+        # Un refresh token o un ticket de eventos no sirven como token de acceso
+        if sub is None or payload.get("type") in ("refresh", "eventos"):
             raise credentials_exception
         user_id = int(sub)
     except (JWTError, ValueError):
@@ -78,7 +153,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession
         raise credentials_exception
 
     # Busca el usuario en la base de datos usando el ID
-    result = await db.execute(select(Usuario).where(Usuario.id == user_id))
+    result = await db.execute(_USUARIO_POR_ID, {"id": user_id})
     user = result.scalar_one_or_none()
 
     if user is None:
@@ -1,20 +1,93 @@
-from datetime import date
-from http.client import HTTPException
-
-from sqlalchemy import select, func
+import asyncio
+import base64
+import json
+import re
+from datetime import date, datetime
+from typing import Callable, Dict, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import select, func, union_all, case, and_, tuple_, literal, literal_column, Numeric, Integer, \
+    bindparam, event
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from decimal import Decimal
 from typing import List, Optional
 
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, load_only
+from sqlalchemy.orm.attributes import set_committed_value
 
 from app import models, schemas
-from app.utils.telegram import enviar_mensaje_telegram
+from app.database import engines, SHARD_PRINCIPAL, shard_por_id, shard_para_negocio_nuevo, sql_plazo_sentencia, \
+    SesionEnrutada
+from app.utils import eventos, outbox, cache_reportes
+from app.utils.programador import clave_bloqueo
+from app.utils.telegram import TELEGRAM_BOT_TOKEN
+
+
+# Consultas de las rutas más frecuentes, construidas una sola vez con
+# parámetros enlazados: SQLAlchemy memoriza su clave de caché y reutiliza la
+# compilación, y asyncpg la sentencia preparada de cada conexión.
+_USUARIO_POR_EMAIL = select(models.Usuario).where(models.Usuario.email == bindparam("email"))
+_CLIENTE_POR_ID = select(models.Cliente).where(models.Cliente.id == bindparam("id"))
+_TRANSACCION_POR_ID = select(models.Transaccion).where(models.Transaccion.id == bindparam("id"))
+_DEUDA_POR_ID = (
+    select(models.Deuda)
+    .options(joinedload(models.Deuda.cliente), joinedload(models.Deuda.transaccion))
+    .where(models.Deuda.id == bindparam("id"))
+)
+_MEMBRESIA = (
+    select(models.Negocio.shard, models.Negocio.migrando)
+    .join(models.usuarios_negocios, models.Negocio.id == models.usuarios_negocios.c.negocio_id)
+    .where(
+        models.usuarios_negocios.c.negocio_id == bindparam("negocio_id"),
+        models.usuarios_negocios.c.usuario_id == bindparam("usuario_id"),
+        models.Negocio.eliminado_en.is_(None)
+    )
+)
+_SHARD_DEL_NEGOCIO = (
+    select(models.Negocio.shard, models.Negocio.migrando).where(models.Negocio.id == bindparam("negocio_id"))
+)
+
+# Advisory lock (clave, negocio_id): compartido por las escrituras, exclusivo durante un traslado
+CLAVE_TRASLADO = clave_bloqueo("traslado_negocio")
+
+
+def _consulta_balance(con_inicio: bool, con_fin: bool):
+    T = models.Transaccion
+    R = models.ResumenTransacciones
+    negocio_id, fecha_inicio, fecha_fin = bindparam("negocio_id"), bindparam("fecha_inicio"), bindparam("fecha_fin")
+    q_vivas = select(T.tipo.label("tipo"), T.monto.label("monto")).where(T.negocio_id == negocio_id)
+    # Años archivados: sus transacciones sin deuda viven como totales diarios
+    q_archivo = select(R.tipo.label("tipo"), R.total.label("monto")).where(R.negocio_id == negocio_id)
+    if con_inicio:
+        q_vivas = q_vivas.where(T.fecha >= fecha_inicio)
+        q_archivo = q_archivo.where(R.fecha >= fecha_inicio)
+    if con_fin:
+        q_vivas = q_vivas.where(T.fecha <= fecha_fin)
+        q_archivo = q_archivo.where(R.fecha <= fecha_fin)
+    movimientos = union_all(q_vivas, q_archivo).subquery()
+    return select(movimientos.c.tipo, func.sum(movimientos.c.monto)).group_by(movimientos.c.tipo)
+
+
+# Una variante por combinación de filtros de fecha (los filtros cambian el plan)
+_BALANCE = {(i, f): _consulta_balance(i, f) for i in (False, True) for f in (False, True)}
+
+_DEUDA_ABIERTA = models.Deuda.estado != models.EstadoDeuda.saldado
+_RESUMEN_DEUDAS = (
+    select(
+        func.coalesce(func.sum(models.Deuda.monto_total), 0).label("total_deudas"),
+        func.coalesce(func.sum(models.Deuda.saldo_pendiente).filter(_DEUDA_ABIERTA), 0).label("total_pendiente"),
+        func.coalesce(func.sum(models.Deuda.monto_total).filter(~_DEUDA_ABIERTA), 0).label("total_saldado"),
+        func.count(func.distinct(models.Deuda.cliente_id)).filter(_DEUDA_ABIERTA).label("cantidad_clientes_con_deuda"),
+    )
+    .join(models.Cliente)
+    .where(models.Cliente.negocio_id == bindparam("negocio_id"))
+)
 
 
 # Usuarios
 async def get_usuario_por_email(db: AsyncSession, email: str) -> Optional[models.Usuario]:
-    result = await db.execute(select(models.Usuario).where(models.Usuario.email == email))
+    result = await db.execute(_USUARIO_POR_EMAIL, {"email": email})
     return result.scalar_one_or_none()
 
 
@@ -27,21 +100,38 @@ async def create_negocio(db: AsyncSession, negocio_in: schemas.NegocioCreate, us
     )
     db.add(obj)
     await db.flush()
+    obj.shard = shard_para_negocio_nuevo(obj.id)
     await db.execute(models.usuarios_negocios.insert().values(usuario_id=usuario_id, negocio_id=obj.id))
+    if obj.shard != SHARD_PRINCIPAL:
+        # Copia de la fila en su shard para las claves foráneas de sus datos.
+        # Se escribe antes de confirmar el directorio: si este falla, queda
+        # una fila huérfana sin datos y sin consecuencias.
+        async with engines[obj.shard].begin() as conn:
+            await conn.execute(models.Negocio.__table__.insert().values(
+                id=obj.id, nombre=obj.nombre, descripcion=obj.descripcion,
+                fecha_creacion=obj.fecha_creacion, shard=obj.shard
+            ))
     await db.commit()
     await db.refresh(obj)
     return obj
 
 
-async def get_negocios(db: AsyncSession, usuario_id: int):
+async def get_negocios(db: AsyncSession, usuario_id: int, campos: Optional[List[str]] = None):
+    query = select(models.Negocio)
+    if campos is None or "usuarios" in campos:
+        query = query.options(joinedload(models.Negocio.usuarios))
+    if campos is not None:
+        query = query.options(_solo_columnas(models.Negocio, campos))
     result = await db.execute(
-        select(models.Negocio)
-        .options(joinedload(models.Negocio.usuarios))
+        query
         .join(
             models.usuarios_negocios,
             models.usuarios_negocios.c.negocio_id == models.Negocio.id
         )
-        .where(models.usuarios_negocios.c.usuario_id == usuario_id)
+        .where(
+            models.usuarios_negocios.c.usuario_id == usuario_id,
+            models.Negocio.eliminado_en.is_(None)
+        )
         .order_by(models.Negocio.created_at.desc())
     )
     return result.unique().scalars().all()
@@ -53,7 +143,8 @@ async def get_negocio(db: AsyncSession, negocio_id: int, usuario_id: int) -> Opt
         .join(models.usuarios_negocios, models.usuarios_negocios.c.negocio_id == models.Negocio.id)
         .where(
             models.Negocio.id == negocio_id,
-            models.usuarios_negocios.c.usuario_id == usuario_id
+            models.usuarios_negocios.c.usuario_id == usuario_id,
+            models.Negocio.eliminado_en.is_(None)
         )
     )
     return result.scalar_one_or_none()
@@ -68,16 +159,23 @@ Optional[models.Negocio]:
         obj.nombre = negocio_up.nombre
     if negocio_up.descripcion is not None:
         obj.descripcion = negocio_up.descripcion
+    cache_reportes.marcar_modificado(db, negocio_id)
     await db.commit()
     await db.refresh(obj)
     return obj
 
 
 async def delete_negocio(db: AsyncSession, negocio_id: int, usuario_id: int) -> bool:
+    """
+    Marca el negocio como eliminado: desde ese momento no es visible. Sus
+    datos los borra por lotes app/utils/borrado.py.
+    """
     obj = await get_negocio(db, negocio_id, usuario_id)
     if not obj:
         return False
-    await db.delete(obj)
+    obj.eliminado_en = datetime.utcnow()
+    obj.borrado_por = usuario_id
+    cache_reportes.marcar_modificado(db, negocio_id)
     await db.commit()
     return True
 
@@ -86,7 +184,8 @@ async def delete_negocio(db: AsyncSession, negocio_id: int, usuario_id: int) ->
 async def create_cliente(
     db: AsyncSession,
     cliente_in: schemas.ClienteCreate,
-    usuario_id: int
+    usuario_id: int,
+    commit: bool = True
 ) -> dict:
     if not await usuario_en_negocio(db, cliente_in.negocio_id, usuario_id):
         raise HTTPException(status_code=403, detail="No autorizado para este negocio")
@@ -97,8 +196,9 @@ async def create_cliente(
         nombre=cliente_in.nombre
     )
 
+    await _asegurar_escritura(db, obj.negocio_id)
     db.add(obj)
-    await db.commit()
+    await _guardar(db, commit)
     await db.refresh(obj)
 
     # cliente nuevo → deuda = 0
@@ -112,6 +212,33 @@ async def create_cliente(
 
 
 
+async def upsert_clientes(db: AsyncSession, negocio_id: int, filas: List[dict]) -> Tuple[int, int]:
+    """
+    Inserta o actualiza clientes por (negocio_id, identidad) en una sola
+    sentencia y confirma. Devuelve (insertados, actualizados); las filas
+    idénticas a las existentes no se reescriben.
+    """
+    stmt = pg_insert(models.Cliente).values([
+        {"negocio_id": negocio_id, "identidad": f["identidad"], "nombre": f["nombre"]}
+        for f in filas
+    ])
+    stmt = stmt.on_conflict_do_update(
+        constraint="uq_cliente_identidad_negocio",
+        set_={"nombre": stmt.excluded.nombre},
+        where=models.Cliente.nombre.is_distinct_from(stmt.excluded.nombre)
+    ).returning(literal_column("xmax = 0").label("insertado"))
+    await _asegurar_escritura(db, negocio_id)
+    result = await db.execute(stmt)
+    insertados = actualizados = 0
+    for (insertado,) in result:
+        if insertado:
+            insertados += 1
+        else:
+            actualizados += 1
+    await db.commit()
+    return insertados, actualizados
+
+
 async def get_clientes_by_negocio(db: AsyncSession, negocio_id: int, usuario_id: int) -> List[models.Cliente]:
     if not await usuario_en_negocio(db, negocio_id, usuario_id):
         raise HTTPException(status_code=403, detail="No autorizado para este negocio")
@@ -124,8 +251,53 @@ async def get_clientes_by_negocio(db: AsyncSession, negocio_id: int, usuario_id:
     return result.scalars().all()
 
 
+async def buscar_clientes(
+        db: AsyncSession,
+        negocio_id: int,
+        usuario_id: int,
+        q: str,
+        limite: int = 20,
+        offset: int = 0
+) -> List[dict]:
+    """
+    Busca clientes por identidad exacta (índice único) o por nombre parcial o
+    aproximado (índice de trigramas). Primero la coincidencia exacta de
+    identidad y después los nombres más parecidos. Incluye el saldo pendiente.
+    """
+    if not await usuario_en_negocio(db, negocio_id, usuario_id):
+        raise HTTPException(status_code=403, detail="No autorizado para este negocio")
+
+    C = models.Cliente
+    D = models.Deuda
+    q = q.strip()
+    deuda_pendiente = (
+        select(func.coalesce(func.sum(D.saldo_pendiente), 0))
+        .where(D.cliente_id == C.id, D.estado != models.EstadoDeuda.saldado)
+        .scalar_subquery()
+    )
+    result = await db.execute(
+        select(
+            C.id, C.negocio_id, C.identidad, C.nombre, C.created_at,
+            deuda_pendiente.label("deuda_pendiente")
+        )
+        .where(
+            C.negocio_id == negocio_id,
+            (C.identidad == q) | C.nombre.icontains(q, autoescape=True) | C.nombre.op("%")(q)
+        )
+        .order_by(
+            (C.identidad == q).desc(),
+            func.similarity(C.nombre, q).desc(),
+            C.id
+        )
+        .limit(limite)
+        .offset(offset)
+    )
+    return [dict(fila) for fila in result.mappings().all()]
+
+
 async def get_cliente(db: AsyncSession, cliente_id: int) -> Optional[models.Cliente]:
-    result = await db.execute(select(models.Cliente).where(models.Cliente.id == cliente_id))
+    await localizar(db, models.Cliente, cliente_id)
+    result = await db.execute(_CLIENTE_POR_ID, {"id": cliente_id})
     return result.scalar_one_or_none()
 
 
@@ -138,6 +310,7 @@ Optional[models.Cliente]:
     if not await usuario_en_negocio(db, obj.negocio_id, usuario_id):
         raise HTTPException(status_code=403, detail="No autorizado para este negocio")
 
+    await _asegurar_escritura(db, obj.negocio_id)
     if cliente_up.identidad is not None:
         obj.identidad = cliente_up.identidad
     if cliente_up.nombre is not None:
@@ -156,13 +329,16 @@ async def delete_cliente(db: AsyncSession, cliente_id: int, usuario_id: int) ->
     if not await usuario_en_negocio(db, obj.negocio_id, usuario_id):
         raise HTTPException(status_code=403, detail="No autorizado para este negocio")
 
+    # Un solo DELETE: deudas y abonos los borra el ON DELETE CASCADE (passive_deletes)
+    await _asegurar_escritura(db, obj.negocio_id)
     await db.delete(obj)
     await db.commit()
     return True
 
 
 # Transacciones
-async def create_transaccion(db: AsyncSession, tx_in: schemas.TransaccionCreate, usuario_id: int) -> models.Transaccion:
+async def create_transaccion(db: AsyncSession, tx_in: schemas.TransaccionCreate, usuario_id: int,
+                             commit: bool = True) -> models.Transaccion:
     if not await usuario_en_negocio(db, tx_in.negocio_id, usuario_id):
         raise HTTPException(status_code=403, detail="No autorizado para este negocio")
 
@@ -173,34 +349,46 @@ async def create_transaccion(db: AsyncSession, tx_in: schemas.TransaccionCreate,
         descripcion=tx_in.descripcion,
         fecha=date.today(),
     )
+    await _asegurar_escritura(db, obj.negocio_id)
     db.add(obj)
-    await db.commit()
+    await db.flush()
     await db.refresh(obj)
+    _emitir(db, _evento_transaccion("transaccion_creada", obj))
 
-    result = await db.execute(select(models.Usuario).where(models.Usuario.id == usuario_id))
-    usuario = result.scalar_one_or_none()
-
-    if usuario and usuario.telegram_chat_id:
-        mensaje = (
-            f"Transacción registrada por {usuario.nombre}\n\n"
-            f"<b>Tipo:</b> {tx_in.tipo.value}\n"
-            f"<b>Monto:</b> ${tx_in.monto}\n"
-            f"<b>Descripción:</b> {tx_in.descripcion or 'Sin descripción'}\n"
-            f"<b>Negocio ID:</b> {tx_in.negocio_id}"
-        )
-        await enviar_mensaje_telegram(usuario.telegram_chat_id, mensaje)
+    await _notificar_usuario(db, usuario_id, lambda usuario: (
+        f"Transacción registrada por {usuario.nombre}\n\n"
+        f"<b>Tipo:</b> {tx_in.tipo.value}\n"
+        f"<b>Monto:</b> ${tx_in.monto}\n"
+        f"<b>Descripción:</b> {tx_in.descripcion or 'Sin descripción'}\n"
+        f"<b>Negocio ID:</b> {tx_in.negocio_id}"
+    ))
+    await _guardar(db, commit)
 
     return obj
 
 
+def _consulta_texto(q: str) -> Optional[str]:
+    """Convierte el texto del usuario en un tsquery de prefijos: "pago luz" -> "pago:* & luz:*"."""
+    palabras = re.findall(r"\w+", q)
+    if not palabras:
+        return None
+    return " & ".join(f"{palabra}:*" for palabra in palabras)
+
+
 async def get_transacciones_by_negocio(
         db: AsyncSession,
         negocio_id: int,
         tipo: Optional[models.TipoTransaccion] = None,
         fecha_inicio: Optional[date] = None,
-        fecha_fin: Optional[date] = None
+        fecha_fin: Optional[date] = None,
+        q: Optional[str] = None,
+        limite: Optional[int] = None,
+        offset: int = 0,
+        campos: Optional[List[str]] = None
 ) -> List[models.Transaccion]:
     query = select(models.Transaccion).where(models.Transaccion.negocio_id == negocio_id)
+    if campos is not None:
+        query = query.options(_solo_columnas(models.Transaccion, campos))
 
     if tipo:
         query = query.where(models.Transaccion.tipo == tipo)
@@ -209,14 +397,28 @@ async def get_transacciones_by_negocio(
     if fecha_fin:
         query = query.where(models.Transaccion.fecha <= fecha_fin)
 
-    query = query.order_by(models.Transaccion.fecha.desc())
+    consulta = _consulta_texto(q) if q else None
+    if consulta:
+        # Búsqueda de texto completo sobre la descripción (índice GIN por negocio)
+        tsquery = func.to_tsquery("spanish", consulta)
+        query = query.where(models.Transaccion.busqueda.op("@@")(tsquery)).order_by(
+            func.ts_rank_cd(models.Transaccion.busqueda, tsquery).desc(),
+            models.Transaccion.fecha.desc(),
+            models.Transaccion.id.desc()
+        )
+    else:
+        query = query.order_by(models.Transaccion.fecha.desc(), models.Transaccion.id.desc())
+
+    if limite is not None:
+        query = query.limit(limite).offset(offset)
 
     result = await db.execute(query)
     return result.scalars().all()
 
 
 async def get_transaccion(db: AsyncSession, trans_id: int) -> Optional[models.Transaccion]:
-    result = await db.execute(select(models.Transaccion).where(models.Transaccion.id == trans_id))
+    await localizar(db, models.Transaccion, trans_id)
+    result = await db.execute(_TRANSACCION_POR_ID, {"id": trans_id})
     return result.scalar_one_or_none()
 
 
@@ -225,26 +427,22 @@ Optional[models.Transaccion]:
     obj = await get_transaccion(db, trans_id)
     if not obj:
         return None
+    await _asegurar_escritura(db, obj.negocio_id)
     obj.tipo = models.TipoTransaccion(tx_up.tipo.value)
     obj.monto = tx_up.monto
     obj.descripcion = tx_up.descripcion
     obj.fecha = tx_up.fecha
-    await db.commit()
+    _emitir(db, _evento_transaccion("transaccion_actualizada", obj))
+    await _notificar_usuario(db, usuario_id, lambda usuario: (
+        f"{usuario.nombre} ha modificado la transacción a:\n\n"
+        f"<b>Tipo:</b> {tx_up.tipo.value}\n"
+        f"<b>Monto:</b> ${tx_up.monto}\n"
+        f"<b>Descripción:</b> {tx_up.descripcion or 'Sin descripción'}\n"
+        f"<b>Negocio ID:</b> {tx_up.negocio_id}"
+    ))
+    await confirmar(db)
     await db.refresh(obj)
 
-    result = await db.execute(select(models.Usuario).where(models.Usuario.id == usuario_id))
-    usuario = result.scalar_one_or_none()
-
-    if usuario and usuario.telegram_chat_id:
-        mensaje = (
-            f"{usuario.nombre} ha modificado la transacción a:\n\n"
-            f"<b>Tipo:</b> {tx_up.tipo.value}\n"
-            f"<b>Monto:</b> ${tx_up.monto}\n"
-            f"<b>Descripción:</b> {tx_up.descripcion or 'Sin descripción'}\n"
-            f"<b>Negocio ID:</b> {tx_up.negocio_id}"
-        )
-        await enviar_mensaje_telegram(usuario.telegram_chat_id, mensaje)
-
     return obj
 
 
@@ -252,24 +450,21 @@ async def delete_transaccion(db: AsyncSession, trans_id: int, usuario_id: int) -
     obj = await get_transaccion(db, trans_id)
     if not obj:
         return False
+    await _asegurar_escritura(db, obj.negocio_id)
     await db.delete(obj)
-    await db.commit()
-
-    result = await db.execute(select(models.Usuario).where(models.Usuario.id == usuario_id))
-    usuario = result.scalar_one_or_none()
-
-    if usuario and usuario.telegram_chat_id:
-        mensaje = (
-            f"Transacción eliminada por: {usuario.nombre}\n\n"
-            f"<b>User:</b> {usuario.email}\n"
-        )
-        await enviar_mensaje_telegram(usuario.telegram_chat_id, mensaje)
+    _emitir(db, {"tipo": "transaccion_eliminada", "negocio_id": obj.negocio_id, "id": obj.id})
+    await _notificar_usuario(db, usuario_id, lambda usuario: (
+        f"Transacción eliminada por: {usuario.nombre}\n\n"
+        f"<b>User:</b> {usuario.email}\n"
+    ))
+    await confirmar(db)
 
     return True
 
 
 # Deudas
-async def create_deuda(db: AsyncSession, deuda_in: schemas.DeudaCreate, usuario_id: int) -> models.Deuda:
+async def create_deuda(db: AsyncSession, deuda_in: schemas.DeudaCreate, usuario_id: int,
+                       commit: bool = True) -> models.Deuda:
     # Verificar que la transacción existe
     transaccion = await get_transaccion(db, deuda_in.transaccion_id)
     if not transaccion:
@@ -290,11 +485,13 @@ async def create_deuda(db: AsyncSession, deuda_in: schemas.DeudaCreate, usuario_
 
     obj = models.Deuda(
         transaccion_id=deuda_in.transaccion_id,
+        transaccion_fecha=transaccion.fecha,
         cliente_id=deuda_in.cliente_id,
         monto_total=deuda_in.monto_total
     )
+    await _asegurar_escritura(db, transaccion.negocio_id)
     db.add(obj)
-    await db.commit()
+    await _guardar(db, commit)
     await db.refresh(obj)
     return obj
 
@@ -316,48 +513,157 @@ async def get_deudas_by_cliente(db: AsyncSession, cliente_id: int, usuario_id: i
     return result.unique().scalars().all()
 
 
+async def get_estado_cuenta(db: AsyncSession, cliente_id: int, usuario_id: int,
+                            fecha_inicio: Optional[date] = None, fecha_fin: Optional[date] = None) -> dict:
+    """
+    Deudas del cliente con su transacción y sus abonos, los movimientos en
+    orden cronológico con el saldo acumulado y los totales. Una consulta para
+    las deudas (con su transacción) y otra para los abonos de todas ellas. El
+    rango de fechas aplica a la fecha de la deuda; se incluyen todos sus abonos.
+    """
+    cliente = await get_cliente(db, cliente_id)
+    if not cliente:
+        raise HTTPException(status_code=404, detail="Cliente no encontrado")
+
+    if not await usuario_en_negocio(db, cliente.negocio_id, usuario_id):
+        raise HTTPException(status_code=403, detail="No autorizado para este negocio")
+
+    query = (
+        select(models.Deuda)
+        .options(joinedload(models.Deuda.transaccion))
+        .where(models.Deuda.cliente_id == cliente_id)
+        .order_by(models.Deuda.transaccion_fecha, models.Deuda.id)
+    )
+    if fecha_inicio:
+        query = query.where(models.Deuda.transaccion_fecha >= fecha_inicio)
+    if fecha_fin:
+        query = query.where(models.Deuda.transaccion_fecha <= fecha_fin)
+    deudas = (await db.execute(query)).unique().scalars().all()
+
+    abonos_por_deuda: Dict[int, List[models.Abono]] = {deuda.id: [] for deuda in deudas}
+    if deudas:
+        result = await db.execute(
+            select(models.Abono)
+            .where(models.Abono.deuda_id.in_(list(abonos_por_deuda)))
+            .order_by(models.Abono.fecha, models.Abono.id)
+        )
+        for abono in result.scalars().all():
+            abonos_por_deuda[abono.deuda_id].append(abono)
+
+    movimientos = []
+    for deuda in deudas:
+        # Asignados sin marcar cambios ni disparar la carga perezosa de la relación
+        set_committed_value(deuda, "abonos", abonos_por_deuda[deuda.id])
+        movimientos.append((deuda.transaccion_fecha, 0, deuda.id, deuda.id, deuda.monto_total))
+        movimientos.extend((abono.fecha, 1, deuda.id, abono.id, -abono.monto) for abono in deuda.abonos)
+    # Mismo día: primero el cargo y después los abonos
+    movimientos.sort(key=lambda m: (m[0], m[1], m[3]))
+
+    saldo = Decimal("0.00")
+    salida = []
+    for fecha, orden, deuda_id, mov_id, monto in movimientos:
+        saldo += monto
+        salida.append({
+            "fecha": fecha, "tipo": "deuda" if orden == 0 else "abono", "deuda_id": deuda_id,
+            "id": mov_id, "monto": abs(monto), "saldo": saldo
+        })
+
+    return {
+        "cliente": cliente,
+        "fecha_inicio": fecha_inicio,
+        "fecha_fin": fecha_fin,
+        "total_deudas": sum((d.monto_total for d in deudas), Decimal("0.00")),
+        "total_pagado": sum((d.monto_pagado for d in deudas), Decimal("0.00")),
+        "total_pendiente": sum((d.saldo_pendiente for d in deudas), Decimal("0.00")),
+        "deudas": deudas,
+        "movimientos": salida,
+    }
+
+
 async def get_deudas_by_negocio(
         db: AsyncSession,
         negocio_id: int,
         usuario_id: int,
-        estado: Optional[models.EstadoDeuda] = None
-) -> List[models.Deuda]:
+        estado: Optional[models.EstadoDeuda] = None,
+        campos: Optional[List[str]] = None,
+        cliente_id: Optional[int] = None,
+        saldo_min: Optional[Decimal] = None,
+        saldo_max: Optional[Decimal] = None,
+        fecha_inicio: Optional[date] = None,
+        fecha_fin: Optional[date] = None,
+        orden: schemas.OrdenDeuda = schemas.OrdenDeuda.reciente,
+        limite: Optional[int] = None,
+        cursor: Optional[str] = None
+) -> Tuple[List[models.Deuda], Optional[str]]:
+    """
+    Deudas del negocio filtradas y ordenadas en la base de datos. Con `limite`
+    pagina por keyset: devuelve también el cursor de la página siguiente
+    (None si no hay más).
+    """
     if not await usuario_en_negocio(db, negocio_id, usuario_id):
         raise HTTPException(status_code=403, detail="No autorizado para este negocio")
 
     query = (
         select(models.Deuda)
-        .options(
-            joinedload(models.Deuda.cliente),
-            joinedload(models.Deuda.transaccion)
-        )
         .join(models.Cliente)
         .where(models.Cliente.negocio_id == negocio_id)
     )
+    # Las relaciones solo se cargan (JOIN) si se piden
+    if campos is None or "cliente" in campos:
+        query = query.options(joinedload(models.Deuda.cliente))
+    if campos is None or "transaccion" in campos:
+        query = query.options(joinedload(models.Deuda.transaccion))
+
+    columna_orden, descendente = _ORDENES_DEUDA[orden]
+    if campos is not None:
+        # La columna de orden se necesita para construir el cursor
+        query = query.options(_solo_columnas(models.Deuda, campos + ["id", columna_orden.key]))
 
     if estado:
         query = query.where(models.Deuda.estado == estado)
+    if cliente_id is not None:
+        query = query.where(models.Deuda.cliente_id == cliente_id)
+    if saldo_min is not None:
+        query = query.where(models.Deuda.saldo_pendiente >= saldo_min)
+    if saldo_max is not None:
+        query = query.where(models.Deuda.saldo_pendiente <= saldo_max)
+    if fecha_inicio:
+        query = query.where(models.Deuda.transaccion_fecha >= fecha_inicio)
+    if fecha_fin:
+        query = query.where(models.Deuda.transaccion_fecha <= fecha_fin)
 
-    query = query.order_by(models.Deuda.created_at.desc())
+    if cursor:
+        valor, ultimo_id = _leer_cursor(cursor, columna_orden)
+        clave = tuple_(columna_orden, models.Deuda.id)
+        limite_cursor = tuple_(literal(valor, columna_orden.type), literal(ultimo_id, Integer))
+        query = query.where(clave < limite_cursor if descendente else clave > limite_cursor)
+
+    if descendente:
+        query = query.order_by(columna_orden.desc(), models.Deuda.id.desc())
+    else:
+        query = query.order_by(columna_orden.asc(), models.Deuda.id.asc())
+    if limite:
+        query = query.limit(limite)
 
     result = await db.execute(query)
-    return result.unique().scalars().all()
+    deudas = result.unique().scalars().all()
+
+    siguiente = None
+    if limite and len(deudas) == limite:
+        ultima = deudas[-1]
+        siguiente = _crear_cursor(getattr(ultima, columna_orden.key), ultima.id)
+    return deudas, siguiente
 
 
 async def get_deuda(db: AsyncSession, deuda_id: int) -> Optional[models.Deuda]:
-    result = await db.execute(
-        select(models.Deuda)
-        .options(
-            joinedload(models.Deuda.cliente),
-            joinedload(models.Deuda.transaccion)
-        )
-        .where(models.Deuda.id == deuda_id)
-    )
+    await localizar(db, models.Deuda, deuda_id)
+    result = await db.execute(_DEUDA_POR_ID, {"id": deuda_id})
     return result.unique().scalar_one_or_none()
 
 
 # Abonos
-async def create_abono(db: AsyncSession, abono_in: schemas.AbonoCreate, usuario_id: int) -> models.Abono:
+async def create_abono(db: AsyncSession, abono_in: schemas.AbonoCreate, usuario_id: int,
+                       commit: bool = True) -> models.Abono:
     # Obtener la deuda
     deuda = await get_deuda(db, abono_in.deuda_id)
     if not deuda:
@@ -373,6 +679,7 @@ async def create_abono(db: AsyncSession, abono_in: schemas.AbonoCreate, usuario_
             status_code=400,
             detail=f"El abono (${abono_in.monto}) excede el saldo pendiente (${deuda.saldo_pendiente})"
         )
+    await _asegurar_escritura(db, deuda.cliente.negocio_id)
 
     # Crear el abono
     obj = models.Abono(
@@ -387,23 +694,28 @@ async def create_abono(db: AsyncSession, abono_in: schemas.AbonoCreate, usuario_
     deuda.actualizar_estado()
 
     db.add(obj)
-    await db.commit()
+    await db.flush()
     await db.refresh(obj)
     await db.refresh(deuda)
+    _emitir(db, {
+        "tipo": "abono_aplicado",
+        "negocio_id": deuda.cliente.negocio_id,
+        "id": obj.id,
+        "deuda_id": deuda.id,
+        "monto": obj.monto,
+        "saldo_pendiente": deuda.saldo_pendiente,
+        "estado": deuda.estado.value
+    })
 
     # Notificación por Telegram
-    result = await db.execute(select(models.Usuario).where(models.Usuario.id == usuario_id))
-    usuario = result.scalar_one_or_none()
-
-    if usuario and usuario.telegram_chat_id:
-        mensaje = (
-            f"💰 Abono registrado por {usuario.nombre}\n\n"
-            f"<b>Cliente:</b> {deuda.cliente.nombre}\n"
-            f"<b>Monto abono:</b> ${abono_in.monto}\n"
-            f"<b>Saldo pendiente:</b> ${deuda.saldo_pendiente}\n"
-            f"<b>Estado:</b> {deuda.estado.value}"
-        )
-        await enviar_mensaje_telegram(usuario.telegram_chat_id, mensaje)
+    await _notificar_usuario(db, usuario_id, lambda usuario: (
+        f"💰 Abono registrado por {usuario.nombre}\n\n"
+        f"<b>Cliente:</b> {deuda.cliente.nombre}\n"
+        f"<b>Monto abono:</b> ${abono_in.monto}\n"
+        f"<b>Saldo pendiente:</b> ${deuda.saldo_pendiente}\n"
+        f"<b>Estado:</b> {deuda.estado.value}"
+    ))
+    await _guardar(db, commit)
 
     return obj
 
@@ -427,26 +739,22 @@ async def get_abonos_by_deuda(db: AsyncSession, deuda_id: int, usuario_id: int)
 # Balance
 async def get_balance(db: AsyncSession, negocio_id: int, fecha_inicio: Optional[date] = None,
                       fecha_fin: Optional[date] = None):
-    q_ing = select(func.coalesce(func.sum(models.Transaccion.monto), 0)).where(
-        models.Transaccion.negocio_id == negocio_id,
-        models.Transaccion.tipo == models.TipoTransaccion.ingreso
-    )
-    q_eg = select(func.coalesce(func.sum(models.Transaccion.monto), 0)).where(
-        models.Transaccion.negocio_id == negocio_id,
-        models.Transaccion.tipo == models.TipoTransaccion.egreso
+    """Balance del negocio en el rango; se guarda en caché hasta la próxima escritura del negocio."""
+    return await cache_reportes.obtener_o_calcular(
+        "balance", negocio_id, (fecha_inicio, fecha_fin),
+        lambda: _calcular_balance(db, negocio_id, fecha_inicio, fecha_fin)
     )
 
-    if fecha_inicio:
-        q_ing = q_ing.where(models.Transaccion.fecha >= fecha_inicio)
-        q_eg = q_eg.where(models.Transaccion.fecha >= fecha_inicio)
-    if fecha_fin:
-        q_ing = q_ing.where(models.Transaccion.fecha <= fecha_fin)
-        q_eg = q_eg.where(models.Transaccion.fecha <= fecha_fin)
 
-    res_ing = await db.execute(q_ing)
-    total_ing = res_ing.scalar() or Decimal("0.00")
-    res_eg = await db.execute(q_eg)
-    total_eg = res_eg.scalar() or Decimal("0.00")
+async def _calcular_balance(db: AsyncSession, negocio_id: int, fecha_inicio: Optional[date],
+                            fecha_fin: Optional[date]):
+    result = await db.execute(
+        _BALANCE[bool(fecha_inicio), bool(fecha_fin)],
+        {"negocio_id": negocio_id, "fecha_inicio": fecha_inicio, "fecha_fin": fecha_fin}
+    )
+    totales = dict(result.all())
+    total_ing = totales.get(models.TipoTransaccion.ingreso) or Decimal("0.00")
+    total_eg = totales.get(models.TipoTransaccion.egreso) or Decimal("0.00")
     balance = (total_ing or Decimal("0.00")) - (total_eg or Decimal("0.00"))
     return {
         "negocio_id": negocio_id,
@@ -458,64 +766,356 @@ async def get_balance(db: AsyncSession, negocio_id: int, fecha_inicio: Optional[
     }
 
 
+async def get_resumen_negocios(db: AsyncSession, usuario_id: int, fecha_inicio: Optional[date] = None,
+                              fecha_fin: Optional[date] = None):
+    """
+    Balance, deuda pendiente y clientes de todos los negocios del usuario. Los
+    negocios salen del directorio; los totales, de una consulta agrupada por
+    shard, y las de distintos shards se ejecutan a la vez. El rango de fechas
+    aplica al balance. Los totales de cada negocio se guardan en caché y solo
+    se consultan los que falten.
+    """
+    un = models.usuarios_negocios
+    result = await db.execute(
+        select(models.Negocio.id, models.Negocio.nombre, models.Negocio.shard)
+        .join(un, and_(un.c.negocio_id == models.Negocio.id, un.c.usuario_id == usuario_id))
+        .where(models.Negocio.eliminado_en.is_(None))
+        .order_by(models.Negocio.created_at.desc())
+    )
+    negocios = result.all()
+    # Libera la conexión del directorio mientras se consultan los shards
+    await db.commit()
+
+    totales, faltantes = cache_reportes.obtener_varios(
+        "resumen_negocio", [negocio.id for negocio in negocios], (fecha_inicio, fecha_fin)
+    )
+    por_shard: Dict[str, List[int]] = {}
+    for negocio in negocios:
+        if negocio.id in faltantes:
+            por_shard.setdefault(negocio.shard, []).append(negocio.id)
+    for parcial in await asyncio.gather(*(
+        _resumen_en_shard(shard, ids, fecha_inicio, fecha_fin) for shard, ids in por_shard.items()
+    )):
+        totales.update(parcial)
+
+    vacio = {
+        "total_ingresos": Decimal("0.00"), "total_egresos": Decimal("0.00"), "balance": Decimal("0.00"),
+        "deuda_pendiente": Decimal("0.00"), "cantidad_clientes": 0, "cantidad_clientes_con_deuda": 0,
+    }
+    for negocio_id, clave in faltantes.items():
+        cache_reportes.cache.guardar(clave, totales.get(negocio_id, vacio))
+    return [
+        {"negocio_id": negocio.id, "nombre": negocio.nombre, **totales.get(negocio.id, vacio)}
+        for negocio in negocios
+    ]
+
+
+async def _resumen_en_shard(shard: str, negocio_ids: List[int], fecha_inicio: Optional[date],
+                            fecha_fin: Optional[date]) -> Dict[int, dict]:
+    """Totales de los negocios de un shard en una sola consulta agrupada."""
+    T = models.Transaccion
+    R = models.ResumenTransacciones
+    C = models.Cliente
+    D = models.Deuda
+
+    q_vivas = select(T.negocio_id.label("negocio_id"), T.tipo.label("tipo"), T.monto.label("monto")).where(
+        T.negocio_id.in_(negocio_ids)
+    )
+    q_archivo = select(R.negocio_id.label("negocio_id"), R.tipo.label("tipo"), R.total.label("monto")).where(
+        R.negocio_id.in_(negocio_ids)
+    )
+    if fecha_inicio:
+        q_vivas = q_vivas.where(T.fecha >= fecha_inicio)
+        q_archivo = q_archivo.where(R.fecha >= fecha_inicio)
+    if fecha_fin:
+        q_vivas = q_vivas.where(T.fecha <= fecha_fin)
+        q_archivo = q_archivo.where(R.fecha <= fecha_fin)
+    movimientos = union_all(q_vivas, q_archivo).subquery()
+
+    balances = select(
+        movimientos.c.negocio_id,
+        func.sum(case((movimientos.c.tipo == models.TipoTransaccion.ingreso, movimientos.c.monto), else_=0))
+        .label("total_ingresos"),
+        func.sum(case((movimientos.c.tipo == models.TipoTransaccion.egreso, movimientos.c.monto), else_=0))
+        .label("total_egresos")
+    ).group_by(movimientos.c.negocio_id).subquery()
+
+    deudas = select(
+        C.negocio_id,
+        func.sum(D.saldo_pendiente).label("deuda_pendiente"),
+        func.count(func.distinct(D.cliente_id)).label("cantidad_clientes_con_deuda")
+    ).join(C, C.id == D.cliente_id).where(
+        C.negocio_id.in_(negocio_ids),
+        D.estado != models.EstadoDeuda.saldado
+    ).group_by(C.negocio_id).subquery()
+
+    clientes = select(
+        C.negocio_id,
+        func.count().label("cantidad_clientes")
+    ).where(C.negocio_id.in_(negocio_ids)).group_by(C.negocio_id).subquery()
+
+    # La copia de la fila del negocio en el shard sirve de eje para los outer join
+    total_ingresos = func.coalesce(balances.c.total_ingresos, 0)
+    total_egresos = func.coalesce(balances.c.total_egresos, 0)
+    async with engines[shard].connect() as conn:
+        # Fuera de la sesión: el plazo de la petición se aplica aquí
+        sql_plazo = sql_plazo_sentencia()
+        if sql_plazo:
+            await conn.exec_driver_sql(sql_plazo)
+        result = await conn.execute(
+            select(
+                models.Negocio.id.label("negocio_id"),
+                total_ingresos.label("total_ingresos"),
+                total_egresos.label("total_egresos"),
+                (total_ingresos - total_egresos).label("balance"),
+                func.coalesce(deudas.c.deuda_pendiente, 0).label("deuda_pendiente"),
+                func.coalesce(clientes.c.cantidad_clientes, 0).label("cantidad_clientes"),
+                func.coalesce(deudas.c.cantidad_clientes_con_deuda, 0).label("cantidad_clientes_con_deuda")
+            )
+            .outerjoin(balances, balances.c.negocio_id == models.Negocio.id)
+            .outerjoin(deudas, deudas.c.negocio_id == models.Negocio.id)
+            .outerjoin(clientes, clientes.c.negocio_id == models.Negocio.id)
+            .where(models.Negocio.id.in_(negocio_ids))
+        )
+        return {fila["negocio_id"]: dict(fila) for fila in result.mappings().all()}
+
+
 async def get_resumen_deudas(db: AsyncSession, negocio_id: int, usuario_id: int):
     """Obtiene un resumen de todas las deudas del negocio"""
     if not await usuario_en_negocio(db, negocio_id, usuario_id):
         raise HTTPException(status_code=403, detail="No autorizado para este negocio")
-
-    # Total de deudas
-    q_total = select(func.coalesce(func.sum(models.Deuda.monto_total), 0)).join(
-        models.Cliente
-    ).where(models.Cliente.negocio_id == negocio_id)
-
-    # Total pendiente (monto_total - monto_pagado de deudas no saldadas)
-    q_pendiente = select(
-        func.coalesce(func.sum(models.Deuda.monto_total - models.Deuda.monto_pagado), 0)
-    ).join(models.Cliente).where(
-        models.Cliente.negocio_id == negocio_id,
-        models.Deuda.estado != models.EstadoDeuda.saldado
+    return await cache_reportes.obtener_o_calcular(
+        "resumen_deudas", negocio_id, (), lambda: _calcular_resumen_deudas(db, negocio_id)
     )
 
-    # Total saldado
-    q_saldado = select(func.coalesce(func.sum(models.Deuda.monto_total), 0)).join(
-        models.Cliente
-    ).where(
-        models.Cliente.negocio_id == negocio_id,
-        models.Deuda.estado == models.EstadoDeuda.saldado
-    )
 
-    # Cantidad de clientes con deuda pendiente
-    q_clientes = select(func.count(func.distinct(models.Deuda.cliente_id))).join(
-        models.Cliente
-    ).where(
-        models.Cliente.negocio_id == negocio_id,
-        models.Deuda.estado != models.EstadoDeuda.saldado
-    )
+async def _calcular_resumen_deudas(db: AsyncSession, negocio_id: int):
+    # Totales, pendiente, saldado y clientes con deuda en un solo recorrido (agregados con FILTER)
+    fila = (await db.execute(_RESUMEN_DEUDAS, {"negocio_id": negocio_id})).one()
+    return {"negocio_id": negocio_id, **fila._mapping}
 
-    total = (await db.execute(q_total)).scalar()
-    pendiente = (await db.execute(q_pendiente)).scalar()
-    saldado = (await db.execute(q_saldado)).scalar()
-    clientes = (await db.execute(q_clientes)).scalar()
 
+# Utilidades
+async def usuario_en_negocio(db: AsyncSession, negocio_id: int, usuario_id: int) -> bool:
+    # La membresía confirmada (con el shard del negocio) se recuerda durante
+    # la sesión (una petición): varias operaciones sobre el mismo negocio solo
+    # la consultan una vez
+    autorizados = db.info.setdefault("negocios_autorizados", {})
+    shard = autorizados.get((negocio_id, usuario_id))
+    if shard is None:
+        result = await db.execute(_MEMBRESIA, {"negocio_id": negocio_id, "usuario_id": usuario_id})
+        fila = result.first()
+        if fila is None:
+            return False
+        _comprobar_migracion(fila.migrando)
+        shard = autorizados[(negocio_id, usuario_id)] = fila.shard
+    _fijar_shard(db, shard)
+    return True
+
+
+async def fijar_negocio(db: AsyncSession, negocio_id: int):
+    """Fija la sesión al shard del negocio sin comprobar membresía (trabajos internos)."""
+    result = await db.execute(_SHARD_DEL_NEGOCIO, {"negocio_id": negocio_id})
+    fila = result.first()
+    if fila is not None:
+        _comprobar_migracion(fila.migrando)
+        _fijar_shard(db, fila.shard)
+
+
+# Negocio dueño de cada fila que se busca por id
+_NEGOCIO_DE_FILA = {
+    models.Cliente: select(models.Cliente.negocio_id).where(models.Cliente.id == bindparam("id")),
+    models.Transaccion: select(models.Transaccion.negocio_id).where(models.Transaccion.id == bindparam("id")),
+    models.Deuda: (
+        select(models.Cliente.negocio_id)
+        .join(models.Deuda, models.Deuda.cliente_id == models.Cliente.id)
+        .where(models.Deuda.id == bindparam("id"))
+    ),
+}
+
+
+async def localizar(db: AsyncSession, modelo, obj_id: int):
+    """
+    Fija la sesión al shard del negocio dueño de la fila `obj_id` de
+    `modelo`, para las rutas que reciben un id y no el negocio. Se busca
+    primero en el shard que generó el id y, si el negocio se trasladó, en el
+    resto a la vez. Con un solo shard, o con la sesión ya fijada, no consulta nada.
+    """
+    if len(engines) == 1 or "shard" in db.info:
+        return
+    consulta = _NEGOCIO_DE_FILA[modelo]
+
+    async def _buscar(shard: str) -> Optional[int]:
+        async with engines[shard].connect() as conn:
+            # Fuera de la sesión: el plazo de la petición se aplica aquí
+            sql_plazo = sql_plazo_sentencia()
+            if sql_plazo:
+                await conn.exec_driver_sql(sql_plazo)
+            return (await conn.execute(consulta, {"id": obj_id})).scalar()
+
+    propio = shard_por_id(obj_id)
+    negocio_id = await _buscar(propio) if propio is not None else None
+    if negocio_id is None:
+        otros = [shard for shard in engines if shard != propio]
+        negocio_id = next((n for n in await asyncio.gather(*map(_buscar, otros)) if n is not None), None)
+    if negocio_id is not None:
+        # El directorio decide: durante un traslado la fila existe en ambos shards
+        await fijar_negocio(db, negocio_id)
+
+
+def _fijar_shard(db: AsyncSession, shard: str):
+    actual = db.info.get("shard")
+    if actual is not None and actual != shard:
+        # Una sesión trabaja con un solo shard (una sola transacción)
+        raise HTTPException(status_code=400, detail="La operación combina negocios alojados en bases de datos distintas")
+    db.info["shard"] = shard
+
+
+def _comprobar_migracion(migrando: bool):
+    if migrando:
+        raise HTTPException(
+            status_code=503,
+            detail="El negocio se está trasladando; reintente en unos segundos",
+            headers={"Retry-After": "5"}
+        )
+
+
+async def _asegurar_escritura(db: AsyncSession, negocio_id: int):
+    """
+    Antes de escribir datos del negocio. Marca sus reportes para invalidarlos
+    y, con varios shards, toma en la transacción del shard el bloqueo
+    compartido de traslado y confirma en el directorio que el negocio sigue
+    en ese shard y no se está trasladando. app/utils/shards.py toma el mismo
+    bloqueo en exclusiva antes de la copia final: espera a las escrituras ya
+    en curso y las posteriores ven el cambio y responden 503.
+
+    Se llama antes de cualquier cambio en la sesión: un INSERT o UPDATE que
+    llegue al shard antes del bloqueo podría perderse en un traslado.
+    """
+    cache_reportes.marcar_modificado(db, negocio_id)
+    if len(engines) == 1:
+        return
+    asegurados = db.info.setdefault("escrituras_aseguradas", set())
+    if negocio_id in asegurados:
+        return
+    # Sin autoflush: lo pendiente en la sesión se escribe después del bloqueo
+    with db.no_autoflush:
+        await db.execute(
+            select(func.pg_advisory_xact_lock_shared(CLAVE_TRASLADO, negocio_id)),
+            bind_arguments={"mapper": models.Cliente}
+        )
+        fila = (await db.execute(_SHARD_DEL_NEGOCIO, {"negocio_id": negocio_id})).first()
+    if fila is None or fila.migrando or fila.shard != db.info.get("shard", SHARD_PRINCIPAL):
+        _comprobar_migracion(True)
+    asegurados.add(negocio_id)
+
+
+@event.listens_for(SesionEnrutada, "after_transaction_end")
+def _al_terminar_transaccion(sesion, transaccion):
+    # El bloqueo de traslado dura lo que la transacción
+    sesion.info.pop("escrituras_aseguradas", None)
+
+
+async def confirmar(db: AsyncSession):
+    """Confirma la transacción y después publica los eventos acumulados y avisa al outbox."""
+    pendientes = db.info.pop("eventos", [])
+    hay_mensajes = db.info.pop("mensajes_outbox", False)
+    if eventos.EVENTOS_PG_NOTIFY:
+        # NOTIFY es transaccional: solo se entrega si el commit tiene éxito
+        for evento in pendientes:
+            await db.execute(select(func.pg_notify(eventos.CANAL_EVENTOS, eventos.serializar(evento))))
+    await db.commit()
+    if not eventos.EVENTOS_PG_NOTIFY:
+        for evento in pendientes:
+            eventos.bus.publicar(evento)
+    if hay_mensajes:
+        outbox.avisar()
+
+
+async def descartar(db: AsyncSession):
+    """Revierte la transacción junto con los eventos, mensajes del outbox e invalidaciones pendientes."""
+    await db.rollback()
+    db.info.pop("eventos", None)
+    db.info.pop("mensajes_outbox", None)
+    db.info.pop("negocios_modificados", None)
+
+
+def _solo_columnas(modelo, campos: List[str], dependencias: Optional[dict] = None):
+    """load_only con las columnas necesarias para los campos pedidos (fields=)."""
+    columnas = modelo.__table__.columns
+    # La clave primaria siempre: identifica las filas y evita un load_only()
+    # vacío cuando solo se piden relaciones (fields=usuarios)
+    nombres = {columna.key for columna in modelo.__table__.primary_key.columns}
+    for campo in campos:
+        nombres.update((dependencias or {}).get(campo, [campo]))
+    return load_only(*[getattr(modelo, nombre) for nombre in nombres if nombre in columnas])
+
+
+# Columna y sentido de cada ordenamiento del listado de deudas; el id desempata
+_ORDENES_DEUDA = {
+    schemas.OrdenDeuda.reciente: (models.Deuda.created_at, True),
+    schemas.OrdenDeuda.saldo_desc: (models.Deuda.saldo_pendiente, True),
+    schemas.OrdenDeuda.saldo_asc: (models.Deuda.saldo_pendiente, False),
+}
+
+
+def _crear_cursor(valor, ultimo_id: int) -> str:
+    """Cursor opaco de paginación: (valor de la columna de orden, id) en base64."""
+    crudo = json.dumps([str(valor), ultimo_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(crudo.encode()).decode()
+
+
+def _leer_cursor(cursor: str, columna) -> tuple:
+    try:
+        valor, ultimo_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if isinstance(columna.type, Numeric):
+            return Decimal(valor), int(ultimo_id)
+        return datetime.fromisoformat(valor), int(ultimo_id)
+    except (ValueError, TypeError, ArithmeticError):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+
+def _emitir(db: AsyncSession, evento: dict):
+    """
+    Encola un evento para los suscriptores del negocio; se publica al
+    confirmar. La escritura que lo origina invalida los reportes del negocio.
+    """
+    db.info.setdefault("eventos", []).append(evento)
+    cache_reportes.marcar_modificado(db, evento["negocio_id"])
+
+
+def _evento_transaccion(tipo: str, tx: models.Transaccion) -> dict:
     return {
-        "negocio_id": negocio_id,
-        "total_deudas": total,
-        "total_pendiente": pendiente,
-        "total_saldado": saldado,
-        "cantidad_clientes_con_deuda": clientes
+        "tipo": tipo,
+        "negocio_id": tx.negocio_id,
+        "id": tx.id,
+        "tipo_transaccion": tx.tipo.value,
+        "monto": tx.monto,
+        "fecha": tx.fecha
     }
 
 
-# Utilidades
-async def usuario_en_negocio(db: AsyncSession, negocio_id: int, usuario_id: int) -> bool:
-    result = await db.execute(
-        select(models.usuarios_negocios)
-        .where(
-            models.usuarios_negocios.c.negocio_id == negocio_id,
-            models.usuarios_negocios.c.usuario_id == usuario_id
-        )
-    )
-    return result.first() is not None
+async def _guardar(db: AsyncSession, commit: bool):
+    # Con commit=False el llamador agrupa varias escrituras y confirma al final
+    if commit:
+        await confirmar(db)
+    else:
+        await db.flush()
+
+
+async def _notificar_usuario(db: AsyncSession, usuario_id: int, mensaje: Callable[[models.Usuario], str]):
+    """
+    Guarda un mensaje de Telegram para el usuario en el outbox, dentro de la
+    misma transacción que la escritura; se entrega en segundo plano.
+    """
+    if not TELEGRAM_BOT_TOKEN:
+        return
+    result = await db.execute(select(models.Usuario).where(models.Usuario.id == usuario_id))
+    usuario = result.scalar_one_or_none()
+
+    if usuario and usuario.telegram_chat_id:
+        db.add(models.MensajeSaliente(destino=usuario.telegram_chat_id, contenido=mensaje(usuario)))
+        db.info["mensajes_outbox"] = True
 
 
 async def agregar_usuario_a_negocio(db: AsyncSession, negocio_id: int, usuario_id: int):
@@ -1,31 +1,177 @@
 import os
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional
+
 from dotenv import load_dotenv
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-from sqlalchemy.orm import sessionmaker
+from fastapi import Request
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine, async_sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.sql.util import find_tables
+
+from app.utils.metricas import metricas
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# Máximo de conexiones simultáneas que puede abrir este proceso
+MAX_CONEXIONES = POOL_SIZE + MAX_OVERFLOW
+
+# Sentencias compiladas que guarda SQLAlchemy por engine y sentencias
+# preparadas que guarda asyncpg por conexión (las consultas de las rutas
+# frecuentes se reutilizan; ver app/crud.py). Con PgBouncer en modo
+# transacción DB_CACHE_SENTENCIAS debe ser 0.
+DB_CACHE_COMPILADAS = int(os.getenv("DB_CACHE_COMPILADAS", "1000"))
+DB_CACHE_SENTENCIAS = int(os.getenv("DB_CACHE_SENTENCIAS", "500"))
+
+CONNECT_ARGS = {"ssl": True, "prepared_statement_cache_size": DB_CACHE_SENTENCIAS}
+
+# Shards adicionales para los datos de los negocios: "nombre=url;nombre=url".
+# DATABASE_URL es el directorio (usuarios, membresías, negocios) y a la vez el
+# shard "principal". El orden de la lista es estable: fija el rango de ids de cada shard.
+SHARD_PRINCIPAL = "principal"
+DB_SHARDS = os.getenv("DB_SHARDS", "")
+# Shard donde se crean los negocios nuevos (vacío: se reparten por id)
+DB_SHARD_NUEVOS = os.getenv("DB_SHARD_NUEVOS", "")
+# Ids reservados por shard: el shard i numera desde i * BLOQUE_IDS, así un id
+# es único en todos los shards y los datos de un negocio se pueden trasladar
+BLOQUE_IDS = 2 ** 27
+
+# Tablas con datos de un negocio: viven en su shard. Las salientes (outbox) y
+# las claves de idempotencia van con ellos para confirmarse en la misma transacción.
+TABLAS_DE_NEGOCIO = frozenset({
+    "clientes", "transacciones", "deudas", "abonos", "transacciones_resumen", "outbox", "claves_idempotencia",
+})
+
+
+def _crear_engine(url: str) -> AsyncEngine:
+    return create_async_engine(
+        url,
+        echo=False,
+        future=True,
+        connect_args=CONNECT_ARGS,
+        pool_pre_ping=True,     # evita usar conexiones muertas
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        query_cache_size=DB_CACHE_COMPILADAS
+    )
+
+
+engine = _crear_engine(DATABASE_URL)
+
+# Nombre -> engine, en orden de shard (el principal primero)
+engines: Dict[str, AsyncEngine] = {SHARD_PRINCIPAL: engine}
+for _definicion in filter(None, (d.strip() for d in DB_SHARDS.split(";"))):
+    _nombre, _, _url = _definicion.partition("=")
+    engines[_nombre.strip()] = _crear_engine(_url.strip())
+
+
+def indice_shard(nombre: str) -> int:
+    return list(engines).index(nombre)
+
+
+def shard_por_id(obj_id: int) -> Optional[str]:
+    """Shard en cuyo rango se generó el id (los datos pueden haberse trasladado después)."""
+    nombres = list(engines)
+    indice = obj_id // BLOQUE_IDS
+    return nombres[indice] if 0 <= indice < len(nombres) else None
+
+
+def shard_para_negocio_nuevo(negocio_id: int) -> str:
+    if DB_SHARD_NUEVOS:
+        return DB_SHARD_NUEVOS
+    nombres = list(engines)
+    return nombres[negocio_id % len(nombres)]
 
-engine = create_async_engine(
-    DATABASE_URL,
-    echo=False,
-    future=True,
-    connect_args={"ssl": True},
-    pool_pre_ping=True,     # evita usar conexiones muertas
-    pool_size=5,
-    max_overflow=10
-)
+
+class SesionEnrutada(Session):
+    """
+    Envía las tablas de negocio al shard fijado en `info["shard"]` (lo fija
+    crud al comprobar el acceso al negocio) y el resto al directorio. Una
+    sesión trabaja con un solo shard; sin fijar, usa el principal.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        tablas = set()
+        if mapper is not None:
+            tablas.add(mapper.local_table.name)
+        if clause is not None:
+            tablas.update(getattr(t, "name", None) for t in find_tables(clause, include_crud=True))
+        if tablas & TABLAS_DE_NEGOCIO:
+            return engines[self.info.get("shard", SHARD_PRINCIPAL)].sync_engine
+        return engine.sync_engine
 
 
 # Nuevo: async_sessionmaker (SQLAlchemy 2.x)
 async_session_maker = async_sessionmaker(
     bind=engine,
     expire_on_commit=False,
-    class_=AsyncSession
+    class_=AsyncSession,
+    sync_session_class=SesionEnrutada
 )
 
 
-async def get_db():
+def sesion_en_shard(nombre: str) -> AsyncSession:
+    """Sesión fijada a un shard, para trabajos de fondo que recorren todos."""
+    return async_session_maker(info={"shard": nombre})
+
+
+async def cerrar_engines():
+    for motor in engines.values():
+        await motor.dispose()
+
+
+# Ruta que está usando la conexión, para medir cuánto la retiene cada una
+ruta_actual: ContextVar[str] = ContextVar("ruta_actual", default="segundo_plano")
+# statement_timeout (ms) de la petición en curso según su clase de ruta
+# (app/utils/plazos.py); None en los trabajos de fondo: sin límite
+plazo_sentencia_ms: ContextVar[Optional[int]] = ContextVar("plazo_sentencia_ms", default=None)
+
+
+def sql_plazo_sentencia() -> Optional[str]:
+    """SET LOCAL del plazo de la petición en curso, o None si no tiene."""
+    plazo = plazo_sentencia_ms.get()
+    return f"SET LOCAL statement_timeout = {int(plazo)}" if plazo else None
+
+
+@event.listens_for(SesionEnrutada, "after_begin")
+def _aplicar_plazo(session, transaction, connection):
+    # Una vez por transacción y por conexión (directorio y shard); SET LOCAL
+    # termina con la transacción y la conexión vuelve limpia al pool
+    sql = sql_plazo_sentencia()
+    if sql:
+        connection.exec_driver_sql(sql)
+
+
+def _al_tomar_conexion(dbapi_connection, registro, proxy):
+    registro.info["tomada_en"] = time.perf_counter()
+    registro.info["ruta"] = ruta_actual.get()
+
+
+def _al_devolver_conexion(dbapi_connection, registro):
+    tomada_en = registro.info.pop("tomada_en", None)
+    if tomada_en is not None:
+        metricas.observar(
+            "conexion_retenida_ms", (time.perf_counter() - tomada_en) * 1000, registro.info.pop("ruta", "")
+        )
+
+
+for _motor in engines.values():
+    event.listen(_motor.sync_engine.pool, "checkout", _al_tomar_conexion)
+    event.listen(_motor.sync_engine.pool, "checkin", _al_devolver_conexion)
+
+
+async def get_db(request: Request):
+    """
+    Sesión por petición. La sesión no toma conexión del pool hasta la primera
+    consulta y la devuelve al confirmar o al cerrarse. Las rutas la declaran
+    con `Depends(get_db, scope="function")` para que se cierre al terminar la
+    función de la ruta, antes de serializar y enviar la respuesta.
+    """
+    ruta = request.scope.get("route")
+    ruta_actual.set(f"{request.method} {ruta.path}" if ruta is not None else request.url.path)
     async with async_session_maker() as session:  # <-- Fíjate en los ()
         yield session
@@ -1,20 +1,74 @@
+import asyncio
 import os
 from sys import prefix
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from sqlalchemy.exc import DBAPIError
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
-from app.database import engine
-from app import models
-from app.routers import auth, negocios, transacciones, user_negocios, clientes, abonos, deudas
+from app.database import engines, cerrar_engines
+from app.routers import auth, negocios, transacciones, user_negocios, clientes, abonos, deudas, metricas, batch, perfiles
+from app.utils import programador, recordatorios, idempotencia, eventos, particiones, revocacion, borrado, outbox, \
+    conciliacion, shards, calentamiento
+from app.utils.telegram import TELEGRAM_BOT_TOKEN
+from app.utils.admision import AdmisionMiddleware
+from app.utils.plazos import PlazosMiddleware, manejar_error_bd
+from app.utils.perfilador import PerfiladorMiddleware, PERFILADOR_ACTIVO
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     if os.getenv("ENV") == "dev":
-        async with engine.begin() as conn:
-            # Solo para desarrollo: crea tablas si no existen
-            await conn.run_sync(models.Base.metadata.create_all)
+        # Solo para desarrollo: crea tablas si no existen, en el directorio y en cada shard
+        for motor in engines.values():
+            async with motor.begin() as conn:
+                await shards.preparar_esquema(conn)
+    # Cada shard numera sus ids en su propio rango
+    await shards.asegurar_secuencias()
+
+    # Refresh tokens revocados en memoria (filtro de Bloom + conjunto)
+    await revocacion.cargar_revocados()
+
+    # Trabajos en segundo plano
+    tareas = []
+    if recordatorios.RECORDATORIOS_ACTIVOS:
+        tareas.append(programador.iniciar_tarea_periodica(
+            "recordatorios_deudas",
+            recordatorios.RECORDATORIOS_INTERVALO_MINUTOS * 60,
+            recordatorios.enviar_recordatorios
+        ))
+    tareas.append(programador.iniciar_tarea_periodica(
+        "particiones_transacciones", 24 * 3600, particiones.mantener_particiones, retraso_inicial=60
+    ))
+    tareas.append(programador.iniciar_tarea_periodica(
+        "purga_idempotencia", 3600, idempotencia.purgar_claves_vencidas
+    ))
+    if conciliacion.CONCILIACION_INTERVALO_HORAS > 0:
+        tareas.append(programador.iniciar_tarea_periodica(
+            "conciliacion_deudas", conciliacion.CONCILIACION_INTERVALO_HORAS * 3600, conciliacion.conciliar_programado
+        ))
+    tareas.append(programador.iniciar_tarea_periodica(
+        "reanudar_borrados", 600, borrado.reanudar_borrados, retraso_inicial=30
+    ))
+    tareas.append(programador.iniciar_tarea_periodica(
+        "sincronizar_revocados", 60, revocacion.sincronizar_revocados
+    ))
+    tareas.append(programador.iniciar_tarea_periodica(
+        "purga_revocados", 3600, revocacion.purgar_revocados_vencidos
+    ))
+    if TELEGRAM_BOT_TOKEN:
+        # Notificaciones guardadas en el outbox por las escrituras
+        tareas.append(asyncio.create_task(outbox.drenar_outbox(), name="outbox"))
+        tareas.append(programador.iniciar_tarea_periodica("purga_outbox", 3600, outbox.purgar_outbox))
+    # Invalidaciones de la caché de reportes entre workers (y eventos con EVENTOS_PG_NOTIFY)
+    tareas.append(asyncio.create_task(eventos.escuchar_notificaciones(), name="eventos_listen"))
+
+    # Mappers, conexiones y consultas listos antes de recibir tráfico (/listo)
+    await calentamiento.calentar()
     yield
+    calentamiento.estado.listo = False
+    await programador.detener_tareas(tareas)
+    await cerrar_engines()
 app = FastAPI(
     title="Gestor de Negocios - Backend",
     lifespan=lifespan
@@ -26,12 +80,28 @@ origins = [
     "http://localhost:8100/login"
 ]
 
+# Perfilado bajo demanda (cabecera X-Perfilar o muestreo). Solo se registra si
+# está configurado; queda dentro del control de admisión.
+if PERFILADOR_ACTIVO:
+    app.add_middleware(PerfiladorMiddleware)
+
+# Plazo de las consultas por clase de ruta y cancelación de las lecturas cuyo
+# cliente se desconectó. Dentro de la admisión: al cancelar se libera su turno.
+app.add_middleware(PlazosMiddleware)
+app.add_exception_handler(DBAPIError, manejar_error_bd)
+
+# Control de admisión: descarta con 503 en lugar de encolar sin límite en el pool.
+# Se registra antes que CORS para que los 503 también lleven cabeceras CORS.
+app.add_middleware(AdmisionMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Cabeceras propias que el frontend necesita leer
+    expose_headers=["X-Siguiente-Cursor", "Idempotent-Replayed"],
 )
 
 # Rutas
@@ -42,7 +112,16 @@ app.include_router(user_negocios.router, tags=["Usuarios"])
 app.include_router(clientes.router, tags=["Clientes"])
 app.include_router(deudas.router, tags=["Deudas"])
 app.include_router(abonos.router, tags=["Abonos"])
+app.include_router(batch.router, tags=["Batch"])
+app.include_router(metricas.router, tags=["Métricas"])
+app.include_router(perfiles.router, tags=["Perfiles"])
 
 @app.get("/")
 async def root():
     return {"message": "API Gestor de Negocios - Up and running"}
+
+@app.get("/listo")
+async def listo():
+    """Sonda de disponibilidad: 503 hasta que el worker termina de calentarse."""
+    estado = calentamiento.estado.como_dict()
+    return JSONResponse(estado, status_code=200 if estado["listo"] else 503)
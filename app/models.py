@@ -1,7 +1,8 @@
 from sqlalchemy import Column, Integer, String, Text, Date, DateTime, Numeric, ForeignKey, Boolean, Enum, Table, \
-    CheckConstraint, UniqueConstraint
+    BigInteger, CheckConstraint, UniqueConstraint, Index, text, Computed, ForeignKeyConstraint, PrimaryKeyConstraint
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import relationship, declarative_base
+from sqlalchemy.orm import relationship, declarative_base, deferred
 import enum
 from datetime import datetime
 
@@ -41,12 +42,29 @@ class Negocio(Base):
     descripcion = Column(Text, nullable=True)
     fecha_creacion = Column(Date, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
-
-    usuarios = relationship("Usuario", secondary=usuarios_negocios, back_populates="negocios")
-
-    transacciones = relationship("Transaccion", back_populates="negocio", cascade="all, delete-orphan")
-
-    clientes = relationship("Cliente", back_populates="negocio", cascade="all, delete-orphan")
+    # Marcado al pedir su eliminación: el negocio deja de ser visible y sus
+    # datos se borran por lotes en segundo plano (app/utils/borrado.py)
+    eliminado_en = Column(DateTime, nullable=True)
+    # Progreso del borrado, visible desde cualquier worker: quién lo pidió,
+    # etapa, filas borradas y fin (la fila queda hasta BORRADO_CONSERVAR_HORAS)
+    borrado_por = Column(Integer, nullable=True)
+    borrado_etapa = Column(String(30), nullable=True)
+    borrado_filas = Column(BigInteger, nullable=False, default=0, server_default=text("0"))
+    borrado_fin = Column(DateTime, nullable=True)
+    # Base de datos (app/database.py) que guarda sus clientes, transacciones y
+    # deudas; cada shard tiene además una copia de esta fila para sus claves foráneas
+    shard = Column(String(50), nullable=False, default="principal", server_default="principal")
+    # Mientras se traslada a otro shard (app/utils/shards.py) no se admiten accesos
+    migrando = Column(Boolean, nullable=False, default=False, server_default=text("false"))
+
+    # passive_deletes: los hijos los borra el ON DELETE CASCADE de la base de
+    # datos, sin cargarlos en memoria para eliminarlos uno a uno
+    usuarios = relationship("Usuario", secondary=usuarios_negocios, back_populates="negocios", passive_deletes=True)
+
+    transacciones = relationship("Transaccion", back_populates="negocio", cascade="all, delete-orphan",
+                                 passive_deletes=True)
+
+    clientes = relationship("Cliente", back_populates="negocio", cascade="all, delete-orphan", passive_deletes=True)
 
 class Cliente(Base):
     __tablename__ = "clientes"
@@ -57,7 +75,7 @@ class Cliente(Base):
     negocio_id = Column(Integer, ForeignKey("negocios.id", ondelete="CASCADE"), nullable=False, index=True)
 
     negocio = relationship("Negocio", back_populates="clientes")
-    deudas = relationship("Deuda", back_populates="cliente", cascade="all, delete-orphan")
+    deudas = relationship("Deuda", back_populates="cliente", cascade="all, delete-orphan", passive_deletes=True)
 
     @hybrid_property
     def deuda_total(self):
@@ -65,45 +83,80 @@ class Cliente(Base):
 
     __table_args__ = (
         UniqueConstraint('negocio_id', 'identidad', name='uq_cliente_identidad_negocio'),
+        # Búsqueda parcial / aproximada por nombre dentro del negocio (pg_trgm + btree_gin)
+        Index(
+            'ix_clientes_nombre_trgm', 'negocio_id', 'nombre',
+            postgresql_using='gin',
+            postgresql_ops={'nombre': 'gin_trgm_ops'}
+        ),
     )
 
 class Transaccion(Base):
+    """
+    Tabla particionada por rango de `fecha` (una partición por año, ver
+    app/utils/particiones.py). Postgres exige que la clave primaria incluya
+    la columna de partición, por eso es (id, fecha); el id sigue siendo único
+    porque lo asigna una sola secuencia.
+    """
     __tablename__ = "transacciones"
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
     negocio_id = Column(Integer, ForeignKey("negocios.id", ondelete="CASCADE"), nullable=False)
     tipo = Column(Enum(TipoTransaccion), nullable=False)
     monto = Column(Numeric(12, 2), nullable=False)
     descripcion = Column(Text, nullable=True)
-    fecha = Column(Date, nullable=False)
+    fecha = Column(Date, primary_key=True, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Vector de búsqueda mantenido por Postgres; diferido para no cargarlo en los listados
+    busqueda = deferred(Column(
+        TSVECTOR,
+        Computed("to_tsvector('spanish', coalesce(descripcion, ''))", persisted=True)
+    ))
 
     negocio = relationship("Negocio", back_populates="transacciones")
-    deuda = relationship("Deuda", back_populates="transaccion", uselist=False, cascade="all, delete-orphan")
+    deuda = relationship("Deuda", back_populates="transaccion", uselist=False, cascade="all, delete-orphan",
+                         passive_deletes=True)
+
+    __table_args__ = (
+        # GIN compuesto (requiere la extensión btree_gin): búsqueda acotada al negocio
+        Index('ix_transacciones_negocio_busqueda', 'negocio_id', 'busqueda', postgresql_using='gin'),
+        Index('ix_transacciones_negocio_fecha', 'negocio_id', 'fecha'),
+        {'postgresql_partition_by': 'RANGE (fecha)'},
+    )
 
 class Deuda(Base):
     __tablename__ = "deudas"
     id = Column(Integer, primary_key=True, index=True)
-    transaccion_id = Column(Integer, ForeignKey("transacciones.id", ondelete="CASCADE"), nullable=False, unique=True)
-    cliente_id = Column(Integer, ForeignKey("clientes.id", ondelete="CASCADE"), nullable=False)
+    transaccion_id = Column(Integer, nullable=False, unique=True)
+    # Copia de la fecha de la transacción: forma parte de su clave y permite
+    # que los joins deuda → transacción solo toquen la partición necesaria
+    transaccion_fecha = Column(Date, nullable=False)
+    cliente_id = Column(Integer, ForeignKey("clientes.id", ondelete="CASCADE"), nullable=False, index=True)
     monto_total = Column(Numeric(12, 2), nullable=False)
     monto_pagado = Column(Numeric(12, 2), default=0, nullable=False)
+    # Columna generada por Postgres: exacta (Decimal) y utilizable en filtros y ordenamientos
+    saldo_pendiente = Column(Numeric(12, 2), Computed("monto_total - monto_pagado", persisted=True))
     estado = Column(Enum(EstadoDeuda), default=EstadoDeuda.pendiente, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
 
     transaccion = relationship("Transaccion", back_populates="deuda")
     cliente = relationship("Cliente", back_populates="deudas")
-    abonos = relationship("Abono", back_populates="deuda", cascade="all, delete-orphan")
+    abonos = relationship("Abono", back_populates="deuda", cascade="all, delete-orphan", passive_deletes=True)
 
     __table_args__ = (
+        ForeignKeyConstraint(
+            ['transaccion_id', 'transaccion_fecha'],
+            ['transacciones.id', 'transacciones.fecha'],
+            ondelete='CASCADE',
+            onupdate='CASCADE'
+        ),
         CheckConstraint('monto_pagado <= monto_total', name='check_monto_pagado_deuda'),
         CheckConstraint('monto_total > 0', name='check_monto_total_positivo'),
+        # Índice parcial: los recorridos de deudas abiertas (recordatorios) no tocan las saldadas
+        Index('ix_deudas_abiertas', 'id', 'created_at', postgresql_where=text("estado <> 'saldado'")),
+        # Ordenamiento y paginación por saldo, siempre dentro de un cliente o negocio
+        Index('ix_deudas_cliente_saldo', 'cliente_id', 'saldo_pendiente', 'id'),
     )
 
-    @hybrid_property
-    def saldo_pendiente(self):
-        """Calcula el saldo pendiente de la deuda"""
-        return float(self.monto_total) - float(self.monto_pagado)
-
     def actualizar_estado(self):
         """Actualiza el estado de la deuda basado en el monto pagado"""
         if self.monto_pagado == 0:
@@ -117,7 +170,7 @@ class Deuda(Base):
 class Abono(Base):
     __tablename__ = "abonos"
     id = Column(Integer, primary_key=True, index=True)
-    deuda_id = Column(Integer, ForeignKey("deudas.id", ondelete="CASCADE"), nullable=False)
+    deuda_id = Column(Integer, ForeignKey("deudas.id", ondelete="CASCADE"), nullable=False, index=True)
     monto = Column(Numeric(12, 2), nullable=False)
     fecha = Column(Date, nullable=False)
     notas = Column(Text, nullable=True)
@@ -127,4 +180,71 @@ class Abono(Base):
 
     __table_args__ = (
         CheckConstraint('monto > 0', name='check_monto_abono_positivo'),
-    )
\ No newline at end of file
+    )
+
+class ClaveIdempotencia(Base):
+    """Respuesta guardada de una petición POST con cabecera Idempotency-Key."""
+    __tablename__ = "claves_idempotencia"
+    # Sin clave foránea: la tabla vive en el shard del negocio y los usuarios
+    # en el directorio; las claves caducan solas (purgar_claves_vencidas)
+    usuario_id = Column(Integer, primary_key=True)
+    clave = Column(String(255), primary_key=True)
+    ruta = Column(String(100), nullable=False)
+    huella = Column(String(64), nullable=False)  # sha256 de ruta + cuerpo de la petición
+    respuesta = Column(Text, nullable=False)  # JSON de la respuesta original
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+class EstadoMensaje(str, enum.Enum):
+    pendiente = "pendiente"
+    enviado = "enviado"
+    fallido = "fallido"
+
+class MensajeSaliente(Base):
+    """
+    Outbox: notificaciones escritas en la misma transacción que la operación
+    que las origina. Las entrega app/utils/outbox.py en segundo plano.
+    """
+    __tablename__ = "outbox"
+    id = Column(Integer, primary_key=True)
+    canal = Column(String(20), nullable=False, default="telegram")
+    destino = Column(String(50), nullable=False)  # chat_id
+    contenido = Column(Text, nullable=False)
+    estado = Column(Enum(EstadoMensaje), default=EstadoMensaje.pendiente, nullable=False)
+    intentos = Column(Integer, default=0, nullable=False)
+    # No se reclama antes de esta fecha (reintentos con espera y mensajes en curso)
+    disponible_en = Column(DateTime, default=datetime.utcnow, nullable=False)
+    ultimo_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    enviado_en = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # Solo los pendientes: la cola se recorre sin tocar el histórico
+        Index('ix_outbox_pendientes', 'disponible_en', 'id', postgresql_where=text("estado = 'pendiente'")),
+    )
+
+class TokenRevocado(Base):
+    """
+    Refresh tokens ya usados (rotados) o revocados. El identificador es el
+    `jti` del token o el de su familia, cuando se revoca la cadena completa.
+    """
+    __tablename__ = "tokens_revocados"
+    identificador = Column(String(64), primary_key=True)
+    usuario_id = Column(Integer, ForeignKey("usuarios.id", ondelete="CASCADE"), nullable=False)
+    expira_en = Column(DateTime, nullable=False, index=True)  # Después de esto el token ya no es válido de todos modos
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+class ResumenTransacciones(Base):
+    """
+    Totales diarios de transacciones archivadas (años cerrados). Mantienen
+    exacto el balance para cualquier rango de fechas sin guardar cada fila.
+    """
+    __tablename__ = "transacciones_resumen"
+    negocio_id = Column(Integer, ForeignKey("negocios.id", ondelete="CASCADE"), nullable=False)
+    fecha = Column(Date, nullable=False)
+    tipo = Column(Enum(TipoTransaccion), nullable=False)
+    total = Column(Numeric(14, 2), nullable=False)
+    cantidad = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('negocio_id', 'fecha', 'tipo'),
+    )
@@ -1,10 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, status, Header, Response
+from typing import List, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import schemas, crud, models
 from app.database import get_db
 from app.auth import get_current_user
+from app.utils.idempotencia import ejecutar_idempotente
 
 router = APIRouter(prefix="/abonos", tags=["abonos"])
 
@@ -12,7 +13,9 @@ router = APIRouter(prefix="/abonos", tags=["abonos"])
 @router.post("", response_model=schemas.AbonoOut, status_code=status.HTTP_201_CREATED)
 async def create_abono(
         abono_in: schemas.AbonoCreate,
-        db: AsyncSession = Depends(get_db),
+        response: Response,
+        idempotency_key: Optional[str] = Header(None, max_length=255),
+        db: AsyncSession = Depends(get_db, scope="function"),
         current_user: models.Usuario = Depends(get_current_user)
 ):
     """
@@ -23,5 +26,16 @@ async def create_abono(
     - Actualiza el estado de la deuda (pendiente/parcial/saldado)
     - Valida que el abono no exceda el saldo pendiente
     - Envía notificación por Telegram si está configurado
+
+    Con la cabecera Idempotency-Key los reintentos devuelven el abono ya
+    registrado en lugar de crear otro.
     """
-    return await crud.create_abono(db, abono_in, current_user.id)
\ No newline at end of file
+    if idempotency_key is None:
+        return await crud.create_abono(db, abono_in, current_user.id)
+    # La clave se guarda junto al abono: en el shard del negocio de la deuda
+    await crud.localizar(db, models.Deuda, abono_in.deuda_id)
+    return await ejecutar_idempotente(
+        db, current_user.id, idempotency_key, "POST /abonos", abono_in,
+        lambda: crud.create_abono(db, abono_in, current_user.id, commit=False),
+        schemas.AbonoOut, response
+    )
\ No newline at end of file
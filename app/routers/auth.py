@@ -1,3 +1,5 @@
+from datetime import datetime, timedelta
+
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -6,12 +8,15 @@ from sqlalchemy.future import select
 from app import schemas, crud
 from app.models import Usuario
 from app.database import get_db
-from app.auth import hash_password, verify_password, create_access_token
+from app.auth import hash_password, verify_password, create_access_token, create_refresh_token, \
+    decode_refresh_token, REFRESH_TOKEN_EXPIRE_DAYS
+from app.utils import revocacion
+from app.utils.metricas import metricas
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
 @router.post("/register", response_model=schemas.UsuarioOut)
-async def register(user_in: schemas.UsuarioCreate, db: AsyncSession = Depends(get_db)):
+async def register(user_in: schemas.UsuarioCreate, db: AsyncSession = Depends(get_db, scope="function")):
     email = user_in.email.strip().lower()
     existing = await crud.get_usuario_por_email(db, email)
     if len(user_in.password) < 6:
@@ -29,10 +34,59 @@ async def register(user_in: schemas.UsuarioCreate, db: AsyncSession = Depends(ge
     return user
 
 @router.post("/login")
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db, scope="function")):
     result = await db.execute(select(Usuario).where(Usuario.email == form_data.username))
     user = result.scalar_one_or_none()
     if not user or not verify_password(form_data.password, user.hashed_password):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Credenciales incorrectas")
-    access_token = create_access_token({"sub": str(user.id), "email": user.email})
-    return {"access_token": access_token, "token_type": "bearer", "user": user.nombre, "email": user.email}
+    claims = {"sub": str(user.id), "email": user.email}
+    access_token = create_access_token(claims)
+    refresh_token = create_refresh_token(claims)
+    return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer",
+            "user": user.nombre, "email": user.email}
+
+@router.post("/refresh")
+async def refresh(datos: schemas.RefreshIn, db: AsyncSession = Depends(get_db, scope="function")):
+    """
+    Entrega un nuevo par de tokens a cambio de un refresh token válido, sin
+    bcrypt ni consulta del usuario. El token recibido queda revocado
+    (rotación); si se presenta otra vez se revoca toda su familia.
+    """
+    payload = decode_refresh_token(datos.refresh_token)
+    usuario_id = int(payload["sub"])
+    jti, familia = payload["jti"], payload["fam"]
+
+    # Solo en memoria: las revocaciones de otros workers llegan por NOTIFY
+    if revocacion.registro.contiene(familia):
+        metricas.incrementar("refresh_tokens", "rechazados")
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Refresh token revocado")
+
+    # Una sola escritura por clave primaria: si el jti ya estaba, es una reutilización
+    usado = revocacion.registro.contiene(jti)
+    if not usado:
+        usado = not await revocacion.revocar(db, jti, usuario_id, datetime.utcfromtimestamp(payload["exp"]))
+    if usado:
+        await revocacion.revocar(
+            db, familia, usuario_id, datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+        )
+        await db.commit()
+        metricas.incrementar("refresh_tokens", "reutilizados")
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Refresh token revocado")
+    await db.commit()
+
+    metricas.incrementar("refresh_tokens", "rotados")
+    claims = {"sub": payload["sub"], "email": payload.get("email")}
+    return {
+        "access_token": create_access_token(claims),
+        "refresh_token": create_refresh_token(claims, familia),
+        "token_type": "bearer"
+    }
+
+@router.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+async def logout(datos: schemas.RefreshIn, db: AsyncSession = Depends(get_db, scope="function")):
+    """Revoca el refresh token y todos los emitidos a partir del mismo login."""
+    payload = decode_refresh_token(datos.refresh_token)
+    await revocacion.revocar(
+        db, payload["fam"], int(payload["sub"]), datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    )
+    await db.commit()
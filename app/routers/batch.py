@@ -0,0 +1,98 @@
+from typing import Any, Dict, List
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from pydantic import ValidationError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import schemas, crud, models
+from app.database import get_db
+from app.auth import get_current_user
+
+router = APIRouter(prefix="/batch", tags=["batch"])
+
+# op -> (esquema de entrada, función de crud, esquema de salida)
+OPERACIONES = {
+    "crear_cliente": (schemas.ClienteCreate, crud.create_cliente, schemas.ClienteOut),
+    "crear_transaccion": (schemas.TransaccionCreate, crud.create_transaccion, schemas.TransaccionOut),
+    "crear_deuda": (schemas.DeudaCreate, crud.create_deuda, schemas.DeudaOut),
+    "crear_abono": (schemas.AbonoCreate, crud.create_abono, schemas.AbonoOut),
+}
+
+
+# Únicos campos que admiten referencias; el resto de textos con "$" son datos
+CAMPOS_REFERENCIABLES = frozenset({"cliente_id", "transaccion_id", "deuda_id"})
+
+
+def _resolver_referencias(datos: Dict[str, Any], por_indice: List[int], por_ref: Dict[str, int]) -> Dict[str, Any]:
+    """Sustituye en los campos *_id los valores "$indice" o "$ref" por el id creado en esa operación previa."""
+    resueltos = {}
+    for campo, valor in datos.items():
+        if campo in CAMPOS_REFERENCIABLES and isinstance(valor, str) and valor.startswith("$"):
+            ref = valor[1:]
+            if ref.isdigit():
+                if int(ref) >= len(por_indice):
+                    raise HTTPException(status_code=400, detail=f"Referencia desconocida: {valor}")
+                valor = por_indice[int(ref)]
+            else:
+                if ref not in por_ref:
+                    raise HTTPException(status_code=400, detail=f"Referencia desconocida: {valor}")
+                valor = por_ref[ref]
+        resueltos[campo] = valor
+    return resueltos
+
+
+@router.post("", response_model=schemas.BatchOut)
+async def ejecutar_batch(
+        batch_in: schemas.BatchIn,
+        db: AsyncSession = Depends(get_db, scope="function"),
+        current_user: models.Usuario = Depends(get_current_user)
+):
+    """
+    Ejecuta varias operaciones de creación en orden y en una sola transacción.
+
+    Los campos cliente_id, transaccion_id y deuda_id de una operación pueden
+    referenciar el id creado por una anterior con "$<indice>" o "$<ref>". Si alguna falla no se guarda nada y
+    la respuesta indica qué operación falló.
+    """
+    por_indice: List[int] = []
+    por_ref: Dict[str, int] = {}
+    resultados = []
+    for indice, operacion in enumerate(batch_in.operaciones):
+        esquema_in, crear, esquema_out = OPERACIONES[operacion.op]
+        try:
+            datos = esquema_in.model_validate(_resolver_referencias(operacion.datos, por_indice, por_ref))
+            obj = await crear(db, datos, current_user.id, commit=False)
+        except ValidationError as e:
+            await crud.descartar(db)
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail={"indice": indice, "op": operacion.op, "error": e.errors(include_url=False, include_context=False)}
+            )
+        except IntegrityError:
+            await crud.descartar(db)
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail={"indice": indice, "op": operacion.op, "error": "Conflicto con datos existentes"}
+            )
+        except HTTPException as e:
+            await crud.descartar(db)
+            raise HTTPException(
+                status_code=e.status_code,
+                detail={"indice": indice, "op": operacion.op, "error": e.detail}
+            )
+
+        salida = esquema_out.model_validate(obj)
+        por_indice.append(salida.id)
+        if operacion.ref:
+            por_ref[operacion.ref] = salida.id
+        resultados.append({
+            "indice": indice,
+            "op": operacion.op,
+            "ref": operacion.ref,
+            "id": salida.id,
+            "resultado": salida.model_dump(mode="json"),
+        })
+
+    await crud.confirmar(db)
+    return {"resultados": resultados}
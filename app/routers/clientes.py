@@ -1,10 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Query
+from datetime import date
+from typing import List, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import schemas, crud, models
 from app.database import get_db
 from app.auth import get_current_user
+from app.utils.importacion import importar_clientes
 
 router = APIRouter(prefix="/clientes", tags=["clientes"])
 
@@ -12,27 +14,57 @@ router = APIRouter(prefix="/clientes", tags=["clientes"])
 @router.post("", response_model=schemas.ClienteOut, status_code=status.HTTP_201_CREATED)
 async def create_cliente(
         cliente_in: schemas.ClienteCreate,
-        db: AsyncSession = Depends(get_db),
+        db: AsyncSession = Depends(get_db, scope="function"),
         current_user: models.Usuario = Depends(get_current_user)
 ):
     """Crear un nuevo cliente"""
     return await crud.create_cliente(db, cliente_in, current_user.id)
 
 
+@router.post("/negocio/{negocio_id}/importar", response_model=schemas.ImportacionClientesOut)
+async def importar_clientes_negocio(
+        negocio_id: int,
+        request: Request,
+        db: AsyncSession = Depends(get_db, scope="function"),
+        current_user: models.Usuario = Depends(get_current_user)
+):
+    """
+    Importación masiva de clientes. El cuerpo es CSV (`text/csv`, con cabecera
+    identidad,nombre) o NDJSON (`application/x-ndjson`, un objeto por línea).
+    Los clientes existentes (misma identidad) se actualizan.
+    """
+    return await importar_clientes(
+        db, negocio_id, current_user.id, request.stream(), request.headers.get("content-type", "")
+    )
+
+
 @router.get("/negocio/{negocio_id}", response_model=List[schemas.ClienteOut])
 async def list_clientes(
         negocio_id: int,
-        db: AsyncSession = Depends(get_db),
+        db: AsyncSession = Depends(get_db, scope="function"),
         current_user: models.Usuario = Depends(get_current_user)
 ):
     """Listar todos los clientes de un negocio"""
     return await crud.get_clientes_by_negocio(db, negocio_id, current_user.id)
 
 
+@router.get("/negocio/{negocio_id}/buscar", response_model=List[schemas.ClienteBusquedaOut])
+async def buscar_clientes(
+        negocio_id: int,
+        q: str = Query(..., min_length=2, max_length=200, description="Identidad exacta o parte del nombre"),
+        limite: int = Query(20, ge=1, le=100),
+        offset: int = Query(0, ge=0),
+        db: AsyncSession = Depends(get_db, scope="function"),
+        current_user: models.Usuario = Depends(get_current_user)
+):
+    """Buscar clientes de un negocio por identidad o nombre, con su saldo pendiente"""
+    return await crud.buscar_clientes(db, negocio_id, current_user.id, q, limite, offset)
+
+
 @router.get("/{cliente_id}", response_model=schemas.ClienteOut)
 async def get_cliente(
         cliente_id: int,
-        db: AsyncSession = Depends(get_db),
+        db: AsyncSession = Depends(get_db, scope="function"),
         current_user: models.Usuario = Depends(get_current_user)
 ):
     """Obtener un cliente específico"""
@@ -52,7 +84,7 @@ async def get_cliente(
 async def update_cliente(
         cliente_id: int,
         cliente_up: schemas.ClienteUpdate,
-        db: AsyncSession = Depends(get_db),
+        db: AsyncSession = Depends(get_db, scope="function"),
         current_user: models.Usuario = Depends(get_current_user)
 ):
     """Actualizar un cliente"""
@@ -65,7 +97,7 @@ async def update_cliente(
 @router.delete("/{cliente_id}")
 async def delete_cliente(
         cliente_id: int,
-        db: AsyncSession = Depends(get_db),
+        db: AsyncSession = Depends(get_db, scope="function"),
         current_user: models.Usuario = Depends(get_current_user)
 ):
     """Eliminar un cliente"""
@@ -78,8 +110,24 @@ async def delete_cliente(
 @router.get("/{cliente_id}/deudas", response_model=List[schemas.DeudaOut])
 async def get_deudas_cliente(
         cliente_id: int,
-        db: AsyncSession = Depends(get_db),
+        db: AsyncSession = Depends(get_db, scope="function"),
         current_user: models.Usuario = Depends(get_current_user)
 ):
     """Obtener todas las deudas de un cliente"""
-    return await crud.get_deudas_by_cliente(db, cliente_id, current_user.id)
\ No newline at end of file
+    return await crud.get_deudas_by_cliente(db, cliente_id, current_user.id)
+
+
+@router.get("/{cliente_id}/estado-cuenta", response_model=schemas.EstadoCuentaOut)
+async def get_estado_cuenta(
+        cliente_id: int,
+        fecha_inicio: Optional[date] = None,
+        fecha_fin: Optional[date] = None,
+        db: AsyncSession = Depends(get_db, scope="function"),
+        current_user: models.Usuario = Depends(get_current_user)
+):
+    """
+    Estado de cuenta del cliente: sus deudas con la transacción y los abonos
+    de cada una, los movimientos con el saldo acumulado y los totales.
+    Reemplaza consultar /clientes/{id}/deudas y después /deudas/{id}/abonos por deuda.
+    """
+    return await crud.get_estado_cuenta(db, cliente_id, current_user.id, fecha_inicio, fecha_fin)
@@ -1,10 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request
 from typing import List, Optional
+from datetime import date
+from decimal import Decimal
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import schemas, crud, models
 from app.database import get_db
 from app.auth import get_current_user
+from app.utils.respuestas import campos_solicitados, serializar, responder
 
 router = APIRouter(prefix="/deudas", tags=["deudas"])
 
@@ -12,7 +15,7 @@ router = APIRouter(prefix="/deudas", tags=["deudas"])
 @router.post("", response_model=schemas.DeudaOut, status_code=status.HTTP_201_CREATED)
 async def create_deuda(
         deuda_in: schemas.DeudaCreate,
-        db: AsyncSession = Depends(get_db),
+        db: AsyncSession = Depends(get_db, scope="function"),
         current_user: models.Usuario = Depends(get_current_user)
 ):
     """Crear una nueva deuda asociada a una transacción y cliente"""
@@ -22,18 +25,43 @@ async def create_deuda(
 @router.get("/negocio/{negocio_id}", response_model=List[schemas.DeudaDetalle])
 async def list_deudas_negocio(
         negocio_id: int,
+        request: Request,
         estado: Optional[schemas.EstadoDeuda] = Query(None, description="Filtrar por estado de deuda"),
-        db: AsyncSession = Depends(get_db),
+        cliente_id: Optional[int] = Query(None, description="Filtrar por cliente"),
+        saldo_min: Optional[Decimal] = Query(None, ge=0, description="Saldo pendiente mínimo"),
+        saldo_max: Optional[Decimal] = Query(None, ge=0, description="Saldo pendiente máximo"),
+        fecha_inicio: Optional[date] = Query(None, description="Fecha de la transacción desde"),
+        fecha_fin: Optional[date] = Query(None, description="Fecha de la transacción hasta"),
+        orden: schemas.OrdenDeuda = Query(schemas.OrdenDeuda.reciente, description="Ordenar por fecha o saldo"),
+        limite: Optional[int] = Query(None, ge=1, le=500, description="Tamaño de página"),
+        cursor: Optional[str] = Query(None, description="Cursor devuelto en X-Siguiente-Cursor"),
+        fields: Optional[str] = Query(None, description="Campos a incluir, separados por coma"),
+        db: AsyncSession = Depends(get_db, scope="function"),
         current_user: models.Usuario = Depends(get_current_user)
 ):
-    """Listar todas las deudas de un negocio con opción de filtrar por estado"""
-    return await crud.get_deudas_by_negocio(db, negocio_id, current_user.id, estado)
+    """Listar las deudas de un negocio con filtros, orden por saldo y paginación por cursor"""
+    campos = campos_solicitados(fields, schemas.DeudaDetalle)
+    deudas, siguiente = await crud.get_deudas_by_negocio(
+        db, negocio_id, current_user.id, estado, campos,
+        cliente_id=cliente_id,
+        saldo_min=saldo_min,
+        saldo_max=saldo_max,
+        fecha_inicio=fecha_inicio,
+        fecha_fin=fecha_fin,
+        orden=orden,
+        limite=limite,
+        cursor=cursor
+    )
+    respuesta = responder(request, serializar(deudas, schemas.DeudaDetalle, campos))
+    if siguiente:
+        respuesta.headers["X-Siguiente-Cursor"] = siguiente
+    return respuesta
 
 
 @router.get("/negocio/{negocio_id}/resumen", response_model=schemas.ResumenDeudasOut)
 async def get_resumen_deudas(
         negocio_id: int,
-        db: AsyncSession = Depends(get_db),
+        db: AsyncSession = Depends(get_db, scope="function"),
         current_user: models.Usuario = Depends(get_current_user)
 ):
     """Obtener resumen estadístico de deudas del negocio"""
@@ -43,7 +71,7 @@ async def get_resumen_deudas(
 @router.get("/{deuda_id}", response_model=schemas.DeudaDetalle)
 async def get_deuda(
         deuda_id: int,
-        db: AsyncSession = Depends(get_db),
+        db: AsyncSession = Depends(get_db, scope="function"),
         current_user: models.Usuario = Depends(get_current_user)
 ):
     """Obtener detalle de una deuda específica"""
@@ -62,7 +90,7 @@ async def get_deuda(
 @router.get("/{deuda_id}/abonos", response_model=List[schemas.AbonoOut])
 async def get_abonos_deuda(
         deuda_id: int,
-        db: AsyncSession = Depends(get_db),
+        db: AsyncSession = Depends(get_db, scope="function"),
         current_user: models.Usuario = Depends(get_current_user)
 ):
     """Obtener historial de abonos de una deuda"""
@@ -0,0 +1,44 @@
+import hmac
+import os
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, status
+
+from app.database import engine, engines, SHARD_PRINCIPAL
+from app.utils.metricas import metricas
+
+# Sin token las métricas no se exponen (rutas, cargas y estado interno del proceso)
+METRICAS_TOKEN = os.getenv("METRICAS_TOKEN")
+
+
+def _verificar_token(x_metricas_token: Optional[str] = Header(None)):
+    if not METRICAS_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Métricas desactivadas")
+    if x_metricas_token is None or not hmac.compare_digest(x_metricas_token, METRICAS_TOKEN):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Token de métricas inválido")
+
+
+router = APIRouter(prefix="/metricas", tags=["metricas"], dependencies=[Depends(_verificar_token)])
+
+
+def _estado_pool(motor=engine):
+    pool = motor.pool
+    return {
+        "tamano": pool.size(),
+        "en_uso": pool.checkedout(),
+        "libres": pool.checkedin(),
+        "desborde": pool.overflow(),
+    }
+
+
+metricas.registrar_medidor("pool_conexiones", _estado_pool)
+# Un pool por shard adicional
+for _nombre, _motor in engines.items():
+    if _nombre != SHARD_PRINCIPAL:
+        metricas.registrar_medidor(f"pool_conexiones_{_nombre}", lambda motor=_motor: _estado_pool(motor))
+
+
+@router.get("")
+async def obtener_metricas():
+    """Métricas internas del proceso (admisión, pool de conexiones...); requiere la cabecera X-Metricas-Token"""
+    return metricas.instantanea()
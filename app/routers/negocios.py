@@ -1,5 +1,10 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from typing import List
+import asyncio
+
+from datetime import date
+
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request
+from fastapi.responses import StreamingResponse
+from typing import List, Optional
 
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -7,42 +12,76 @@ from sqlalchemy.orm import selectinload
 
 from app import schemas, crud, models
 from app.database import get_db
-from app.auth import get_current_user
+from app.auth import get_current_user, create_ticket_eventos, decode_ticket_eventos, EVENTOS_TICKET_SEGUNDOS
 from app.models import Negocio, Usuario
+from app.utils import eventos, borrado
+from app.utils.respuestas import campos_solicitados, serializar, responder
+
+# Comentario SSE periódico para que proxies y navegadores no cierren la conexión
+EVENTOS_PING_SEGUNDOS = 15
 
 router = APIRouter(prefix="/negocios", tags=["negocios"])
 
 @router.post("", response_model=schemas.NegocioCreateOut)
-async def create_negocio(negocio_in: schemas.NegocioCreate, db: AsyncSession = Depends(get_db), current_user: models.Usuario = Depends(get_current_user)):
+async def create_negocio(negocio_in: schemas.NegocioCreate, db: AsyncSession = Depends(get_db, scope="function"), current_user: models.Usuario = Depends(get_current_user)):
     return await crud.create_negocio(db, negocio_in, current_user.id)
 
 @router.get("", response_model=List[schemas.NegocioOut])
-async def list_negocios(db: AsyncSession = Depends(get_db), current_user: models.Usuario = Depends(get_current_user)):
-    return await crud.get_negocios(db, current_user.id)
+async def list_negocios(request: Request,
+                        fields: Optional[str] = Query(None, description="Campos a incluir, separados por coma"),
+                        db: AsyncSession = Depends(get_db, scope="function"), current_user: models.Usuario = Depends(get_current_user)):
+    campos = campos_solicitados(fields, schemas.NegocioOut)
+    negocios = await crud.get_negocios(db, current_user.id, campos)
+    return responder(request, serializar(negocios, schemas.NegocioOut, campos))
+
+@router.get("/resumen", response_model=List[schemas.ResumenNegocioOut])
+async def resumen_negocios(fecha_inicio: Optional[date] = None, fecha_fin: Optional[date] = None,
+                           db: AsyncSession = Depends(get_db, scope="function"), current_user: models.Usuario = Depends(get_current_user)):
+    """Balance, deuda pendiente y clientes de cada negocio del usuario en una sola consulta"""
+    return await crud.get_resumen_negocios(db, current_user.id, fecha_inicio, fecha_fin)
 
 @router.get("/{negocio_id}", response_model=schemas.NegocioOut)
-async def get_negocio(negocio_id: int, db: AsyncSession = Depends(get_db), current_user: models.Usuario = Depends(get_current_user)):
+async def get_negocio(negocio_id: int, db: AsyncSession = Depends(get_db, scope="function"), current_user: models.Usuario = Depends(get_current_user)):
     obj = await crud.get_negocio(db, negocio_id, current_user.id)
     if not obj:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Negocio no encontrado")
     return obj
 
 @router.put("/{negocio_id}")
-async def update_negocio(negocio_id: int, negocio_up: schemas.NegocioUpdate, db: AsyncSession = Depends(get_db), current_user: models.Usuario = Depends(get_current_user)):
+async def update_negocio(negocio_id: int, negocio_up: schemas.NegocioUpdate, db: AsyncSession = Depends(get_db, scope="function"), current_user: models.Usuario = Depends(get_current_user)):
     obj = await crud.update_negocio(db, negocio_id, current_user.id, negocio_up)
     if not obj:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Negocio no encontrado")
     return {"mensaje": "Negocio Modificado"}
 
-@router.delete("/{negocio_id}")
-async def delete_negocio(negocio_id: int, db: AsyncSession = Depends(get_db), current_user: models.Usuario = Depends(get_current_user)):
+@router.delete("/{negocio_id}", status_code=status.HTTP_202_ACCEPTED)
+async def delete_negocio(negocio_id: int, db: AsyncSession = Depends(get_db, scope="function"), current_user: models.Usuario = Depends(get_current_user)):
+    """El negocio deja de ser visible al instante; sus datos se borran por lotes en segundo plano."""
     obj = await crud.delete_negocio(db, negocio_id, current_user.id)
     if not obj:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Negocio no encontrado")
-    return {"detail": "Negocio eliminado"}
+    borrado.programar_borrado(negocio_id)
+    return {"detail": "Negocio en eliminación", "progreso": f"/negocios/{negocio_id}/borrado"}
+
+@router.get("/{negocio_id}/borrado")
+async def progreso_borrado(negocio_id: int, db: AsyncSession = Depends(get_db, scope="function"), current_user: models.Usuario = Depends(get_current_user)):
+    """Progreso del borrado de un negocio eliminado, desde cualquier worker"""
+    encontrado = await borrado.leer_progreso(negocio_id)
+    if encontrado is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Borrado no encontrado")
+    solicitante, progreso = encontrado
+    if solicitante != current_user.id:
+        # Los miembros se quitan al terminar: hasta entonces también pueden verlo
+        result = await db.execute(select(models.usuarios_negocios).where(
+            models.usuarios_negocios.c.negocio_id == negocio_id,
+            models.usuarios_negocios.c.usuario_id == current_user.id
+        ))
+        if result.first() is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Borrado no encontrado")
+    return progreso
 
 @router.get("/{negocio_id}/usuarios", response_model=List[schemas.UsuarioOut])
-async def obtener_usuarios_negocio(negocio_id: int, db: AsyncSession = Depends(get_db)):
+async def obtener_usuarios_negocio(negocio_id: int, db: AsyncSession = Depends(get_db, scope="function")):
     result = await db.execute(select(Negocio).options(selectinload(Negocio.usuarios)).where(Negocio.id == negocio_id))
     negocio = result.scalar_one_or_none()
     if not negocio:
@@ -50,7 +89,7 @@ async def obtener_usuarios_negocio(negocio_id: int, db: AsyncSession = Depends(g
     return negocio.usuarios
 
 @router.post("/{negocio_id}/usuarios/{usuario_id}")
-async def agregar_usuario_a_negocio(negocio_id: int, usuario_id: int, db: AsyncSession = Depends(get_db), current_user: models.Usuario = Depends(get_current_user)):
+async def agregar_usuario_a_negocio(negocio_id: int, usuario_id: int, db: AsyncSession = Depends(get_db, scope="function"), current_user: models.Usuario = Depends(get_current_user)):
 
     is_member = await  crud.usuario_en_negocio(db, negocio_id, current_user.id)
     if not is_member:
@@ -58,4 +97,49 @@ async def agregar_usuario_a_negocio(negocio_id: int, usuario_id: int, db: AsyncS
     return await crud.agregar_usuario_a_negocio(db, negocio_id, usuario_id)
 
 
+@router.post("/{negocio_id}/eventos/ticket", response_model=schemas.TicketEventosOut)
+async def ticket_eventos(negocio_id: int, db: AsyncSession = Depends(get_db, scope="function"), current_user: models.Usuario = Depends(get_current_user)):
+    """
+    Ticket para abrir el flujo de eventos con EventSource, que no puede
+    enviar la cabecera Authorization: /negocios/{id}/eventos?ticket=...
+    Vence a los EVENTOS_TICKET_SEGUNDOS; al reconectar se pide otro.
+    """
+    if not await crud.usuario_en_negocio(db, negocio_id, current_user.id):
+        raise HTTPException(status_code=403, detail="No autorizado para este negocio")
+    return {"ticket": create_ticket_eventos(current_user.id, negocio_id), "expira_en_segundos": EVENTOS_TICKET_SEGUNDOS}
+
+
+@router.get("/{negocio_id}/eventos")
+async def eventos_negocio(negocio_id: int, ticket: str = Query(..., description="Ticket de POST /negocios/{id}/eventos/ticket"),
+                          db: AsyncSession = Depends(get_db, scope="function")):
+    """
+    Flujo server-sent events con los cambios del negocio (transacciones,
+    abonos y balance actualizado) para no tener que consultar periódicamente.
+    """
+    usuario_id = decode_ticket_eventos(ticket, negocio_id)
+    # La membresía se vuelve a comprobar: pudo retirarse después de emitir el ticket
+    if not await crud.usuario_en_negocio(db, negocio_id, usuario_id):
+        raise HTTPException(status_code=403, detail="No autorizado para este negocio")
+    # El flujo puede durar horas: no debe retener una conexión del pool
+    await db.close()
+
+    cola = eventos.bus.suscribir(negocio_id)
+
+    async def generar():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    evento = await asyncio.wait_for(cola.get(), EVENTOS_PING_SEGUNDOS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                yield f"event: {evento['tipo']}\ndata: {eventos.serializar(evento)}\n\n"
+        finally:
+            eventos.bus.desuscribir(negocio_id, cola)
 
+    return StreamingResponse(
+        generar(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -0,0 +1,47 @@
+from fastapi import APIRouter, Header, HTTPException, Query, status
+from fastapi.responses import PlainTextResponse, Response
+from typing import Literal, Optional
+
+from app.utils import perfilador
+
+router = APIRouter(prefix="/perfiles", tags=["perfiles"])
+
+
+def _verificar_token(token: Optional[str]):
+    # Sin perfilador configurado las rutas no existen a efectos prácticos
+    if not perfilador.PERFILADOR_ACTIVO:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Perfilador desactivado")
+    if not perfilador.token_valido(token):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Token de perfilador inválido")
+
+
+@router.get("")
+async def listar_perfiles(x_perfilar: Optional[str] = Header(None)):
+    """Perfiles capturados, del más reciente al más antiguo"""
+    _verificar_token(x_perfilar)
+    return perfilador.anillo.listar()
+
+
+@router.get("/{perfil_id}")
+async def descargar_perfil(
+        perfil_id: int,
+        formato: Literal["speedscope", "folded"] = Query("speedscope"),
+        x_perfilar: Optional[str] = Header(None)
+):
+    """Descarga un perfil para abrirlo en speedscope.app o generar un flamegraph"""
+    _verificar_token(x_perfilar)
+    perfil = perfilador.anillo.obtener(perfil_id)
+    if perfil is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Perfil no encontrado")
+
+    nombre = f"perfil-{perfil.id}"
+    if formato == "folded":
+        return PlainTextResponse(
+            perfilador.a_folded(perfil),
+            headers={"Content-Disposition": f'attachment; filename="{nombre}.folded"'}
+        )
+    return Response(
+        perfilador.a_speedscope(perfil),
+        media_type="application/json",
+        headers={"Content-Disposition": f'attachment; filename="{nombre}.speedscope.json"'}
+    )
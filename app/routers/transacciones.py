@@ -1,38 +1,60 @@
 # app/routers/transacciones.py
 from datetime import date
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, Header, Response, Query, Request
 from typing import List, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import schemas, crud, models
 from app.database import get_db
 from app.auth import get_current_user
+from app.utils.idempotencia import ejecutar_idempotente
+from app.utils.respuestas import campos_solicitados, serializar, responder
 
 router = APIRouter(prefix="/transacciones", tags=["transacciones"])
 
 @router.post("", response_model=schemas.TransaccionOut)
 async def create_transaccion(tx_in: schemas.TransaccionCreate,
-                             db: AsyncSession = Depends(get_db),
+                             response: Response,
+                             idempotency_key: Optional[str] = Header(None, max_length=255),
+                             db: AsyncSession = Depends(get_db, scope="function"),
                              current_user: models.Usuario = Depends(get_current_user)):
     is_member = await crud.usuario_en_negocio(db, tx_in.negocio_id, current_user.id)
     if not is_member:
         raise HTTPException(status_code=403, detail="No autorizado para este negocio")
-    return await crud.create_transaccion(db, tx_in, current_user.id)
+    if idempotency_key is None:
+        return await crud.create_transaccion(db, tx_in, current_user.id)
+    return await ejecutar_idempotente(
+        db, current_user.id, idempotency_key, "POST /transacciones", tx_in,
+        lambda: crud.create_transaccion(db, tx_in, current_user.id, commit=False),
+        schemas.TransaccionOut, response
+    )
 
 @router.get("/negocio/{negocio_id}", response_model=List[schemas.TransaccionOut])
-async def list_transacciones(negocio_id: int, tipo: Optional[schemas.TipoTransaccion] = None, fecha_inicio: Optional[date] = None,
-                             fecha_fin: Optional[date] = None, db: AsyncSession = Depends(get_db),
+async def list_transacciones(negocio_id: int, request: Request, tipo: Optional[schemas.TipoTransaccion] = None, fecha_inicio: Optional[date] = None,
+                             fecha_fin: Optional[date] = None,
+                             q: Optional[str] = Query(None, max_length=200, description="Buscar en la descripción (admite prefijos)"),
+                             limite: Optional[int] = Query(None, ge=1, le=500),
+                             offset: int = Query(0, ge=0),
+                             fields: Optional[str] = Query(None, description="Campos a incluir, separados por coma"),
+                             db: AsyncSession = Depends(get_db, scope="function"),
                              current_user: models.Usuario = Depends(get_current_user)):
     is_member = await crud.usuario_en_negocio(db, negocio_id, current_user.id)
     if not is_member:
         raise HTTPException(status_code=403, detail="No autorizado para este negocio")
-    return await crud.get_transacciones_by_negocio(db, negocio_id, tipo, fecha_inicio, fecha_fin)
+    campos = campos_solicitados(fields, schemas.TransaccionOut)
+    if q and limite is None:
+        # Las búsquedas siempre se paginan
+        limite = 50
+    transacciones = await crud.get_transacciones_by_negocio(
+        db, negocio_id, tipo, fecha_inicio, fecha_fin, q, limite, offset, campos
+    )
+    return responder(request, serializar(transacciones, schemas.TransaccionOut, campos))
 
 @router.get("/{trans_id}", response_model=schemas.TransaccionOut)
 async def get_transaccion(
         trans_id: int,
-        db: AsyncSession = Depends(get_db),
+        db: AsyncSession = Depends(get_db, scope="function"),
         current_user: models.Usuario = Depends(get_current_user)):
     obj = await crud.get_transaccion(db, trans_id)
     if not obj:
@@ -40,7 +62,7 @@ async def get_transaccion(
     return obj
 
 @router.put("/{trans_id}", response_model=schemas.TransaccionOut)
-async def update_transaccion(trans_id: int, tx_up: schemas.TransaccionCreate, db: AsyncSession = Depends(get_db), current_user: models.Usuario = Depends(get_current_user)):
+async def update_transaccion(trans_id: int, tx_up: schemas.TransaccionCreate, db: AsyncSession = Depends(get_db, scope="function"), current_user: models.Usuario = Depends(get_current_user)):
     trans = await crud.get_transaccion(db, trans_id)
     if not trans:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Transacción no encontrada")
@@ -51,7 +73,7 @@ async def update_transaccion(trans_id: int, tx_up: schemas.TransaccionCreate, db
     return await crud.update_transaccion(db, trans_id, tx_up, current_user.id)
 
 @router.delete("/{trans_id}")
-async def delete_transaccion(trans_id: int, db: AsyncSession = Depends(get_db), current_user: models.Usuario = Depends(get_current_user)):
+async def delete_transaccion(trans_id: int, db: AsyncSession = Depends(get_db, scope="function"), current_user: models.Usuario = Depends(get_current_user)):
     trans = await crud.get_transaccion(db, trans_id)
     if not trans:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Transacción no encontrada")
@@ -62,7 +84,7 @@ async def delete_transaccion(trans_id: int, db: AsyncSession = Depends(get_db),
     return {"detail": "Transacción eliminada"}
 
 @router.get("/negocio/{negocio_id}/balance", response_model=schemas.BalanceOut)
-async def get_balance(negocio_id: int, fecha_inicio: Optional[date] = None, fecha_fin: Optional[date] = None, db: AsyncSession = Depends(get_db), current_user: models.Usuario = Depends(get_current_user)):
+async def get_balance(negocio_id: int, fecha_inicio: Optional[date] = None, fecha_fin: Optional[date] = None, db: AsyncSession = Depends(get_db, scope="function"), current_user: models.Usuario = Depends(get_current_user)):
     is_member = await crud.usuario_en_negocio(db, negocio_id, current_user.id)
     if not is_member:
         raise HTTPException(status_code=403, detail="No autorizado")
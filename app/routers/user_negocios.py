@@ -10,7 +10,7 @@ from app import models
 router = APIRouter(prefix="/usuarios", tags=["Usuarios"])
 
 @router.get("/buscar", response_model=List[UsuarioShema])
-async def buscar_usuarios(query: str = Query(..., min_length=4), db: AsyncSession = Depends(get_db)):
+async def buscar_usuarios(query: str = Query(..., min_length=4), db: AsyncSession = Depends(get_db, scope="function")):
     query_lower = f"%{query.lower()}%"
 
     result = await db.execute(
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, EmailStr
-from typing import Optional, List
+from typing import Optional, List, Dict, Any, Literal
 from datetime import date, datetime
 from decimal import Decimal
 from enum import Enum as PyEnum
@@ -13,6 +13,11 @@ class EstadoDeuda(str, PyEnum):
     parcial = "parcial"
     saldado = "saldado"
 
+class OrdenDeuda(str, PyEnum):
+    reciente = "reciente"
+    saldo_desc = "saldo_desc"
+    saldo_asc = "saldo_asc"
+
 # Usuario
 class UsuarioBase(BaseModel):
     id: int
@@ -36,6 +41,13 @@ class UsuarioOut(UsuarioBase):
     class Config:
         from_attributes = True
 
+class RefreshIn(BaseModel):
+    refresh_token: str
+
+class TicketEventosOut(BaseModel):
+    ticket: str
+    expira_en_segundos: int
+
 # Negocio
 class NegocioBase(BaseModel):
     nombre: str = Field(..., max_length=200)
@@ -84,6 +96,21 @@ class ClienteOut(ClienteBase):
     class Config:
         from_attributes = True
 
+class ClienteBusquedaOut(ClienteOut):
+    """Cliente encontrado, con su saldo pendiente total"""
+    deuda_pendiente: Decimal
+
+class ErrorImportacion(BaseModel):
+    fila: int
+    error: str
+
+class ImportacionClientesOut(BaseModel):
+    insertados: int
+    actualizados: int
+    sin_cambios: int
+    errores: int
+    detalle_errores: List[ErrorImportacion] = []
+
 # Transacción
 class TransaccionBase(BaseModel):
     negocio_id: int
@@ -156,6 +183,34 @@ class AbonoOut(AbonoBase):
     class Config:
         from_attributes = True
 
+# Estado de cuenta de un cliente
+class DeudaEstadoCuenta(DeudaOut):
+    """Deuda con su transacción y sus abonos"""
+    transaccion: TransaccionOut
+    abonos: List[AbonoOut]
+
+    class Config:
+        from_attributes = True
+
+class MovimientoEstadoCuenta(BaseModel):
+    """Cargo (deuda) o abono, en orden cronológico, con el saldo del cliente tras aplicarlo"""
+    fecha: date
+    tipo: Literal["deuda", "abono"]
+    deuda_id: int
+    id: int
+    monto: Decimal
+    saldo: Decimal
+
+class EstadoCuentaOut(BaseModel):
+    cliente: ClienteOut
+    fecha_inicio: Optional[date] = None
+    fecha_fin: Optional[date] = None
+    total_deudas: Decimal
+    total_pagado: Decimal
+    total_pendiente: Decimal
+    deudas: List[DeudaEstadoCuenta]
+    movimientos: List[MovimientoEstadoCuenta]
+
 # Balance
 class BalanceOut(BaseModel):
     negocio_id: int
@@ -165,10 +220,42 @@ class BalanceOut(BaseModel):
     fecha_inicio: Optional[date] = None
     fecha_fin: Optional[date] = None
 
+# Resumen consolidado de los negocios de un usuario
+class ResumenNegocioOut(BaseModel):
+    negocio_id: int
+    nombre: str
+    total_ingresos: Decimal
+    total_egresos: Decimal
+    balance: Decimal
+    deuda_pendiente: Decimal
+    cantidad_clientes: int
+    cantidad_clientes_con_deuda: int
+
 # Resumen de Deudas por Negocio
 class ResumenDeudasOut(BaseModel):
     negocio_id: int
     total_deudas: Decimal
     total_pendiente: Decimal
     total_saldado: Decimal
-    cantidad_clientes_con_deuda: int
\ No newline at end of file
+    cantidad_clientes_con_deuda: int
+
+# Operaciones por lotes
+class OperacionBatch(BaseModel):
+    op: Literal["crear_cliente", "crear_transaccion", "crear_deuda", "crear_abono"]
+    # Nombre opcional para referenciar el id creado desde operaciones posteriores ("$nombre");
+    # no puede empezar por un dígito para no confundirse con "$<indice>"
+    ref: Optional[str] = Field(None, max_length=50, pattern=r"^[A-Za-z_]\w*$")
+    datos: Dict[str, Any]
+
+class BatchIn(BaseModel):
+    operaciones: List[OperacionBatch] = Field(..., min_length=1, max_length=100)
+
+class ResultadoOperacion(BaseModel):
+    indice: int
+    op: str
+    ref: Optional[str] = None
+    id: int
+    resultado: Dict[str, Any]
+
+class BatchOut(BaseModel):
+    resultados: List[ResultadoOperacion]
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import math
+import os
+from typing import Dict, Optional
+
+from app.database import MAX_CONEXIONES
+from app.utils.metricas import metricas
+
+# Tiempo máximo que una petición espera turno antes de responder 503
+ADMISION_ESPERA_MAXIMA_MS = int(os.getenv("ADMISION_ESPERA_MAXIMA_MS", "2000"))
+# Tamaño de la cola de espera de cada clase, como múltiplo de su límite
+ADMISION_FACTOR_COLA = int(os.getenv("ADMISION_FACTOR_COLA", "4"))
+
+# Rutas que nunca se limitan (salud, métricas y documentación)
+RUTAS_EXENTAS = ("/", "/listo", "/metricas", "/docs", "/redoc", "/openapi.json")
+# Flujos de larga duración (SSE): no usan conexión del pool mientras están abiertos
+SUFIJOS_EXENTOS = ("/eventos",)
+
+LECTURA = "lectura"
+REPORTE = "reporte"
+ESCRITURA = "escritura"
+AUTH = "auth"
+
+
+def _limite_desde_env(clase: str, por_defecto: int) -> int:
+    return max(1, int(os.getenv(f"ADMISION_LIMITE_{clase.upper()}", por_defecto)))
+
+
+def _repartir_conexiones(total: int) -> Dict[str, int]:
+    """Reparte `total` conexiones entre las clases; la suma no pasa de `total` (salvo total < 4)."""
+    escritura = max(1, total * 3 // 10)
+    reporte = max(1, total * 3 // 20)
+    # bcrypt consume CPU del event loop: pocas a la vez
+    auth = max(1, min(4, os.cpu_count() or 1, total // 10))
+    return {
+        LECTURA: max(1, total - escritura - reporte - auth),
+        ESCRITURA: escritura,
+        REPORTE: reporte,
+        AUTH: auth,
+    }
+
+
+# Los límites se reparten las conexiones del pool: así una ráfaga no deja
+# peticiones esperando conexión hasta el timeout del pool.
+LIMITES_POR_DEFECTO = {
+    clase: _limite_desde_env(clase, limite) for clase, limite in _repartir_conexiones(MAX_CONEXIONES).items()
+}
+
+
+def clasificar_ruta(metodo: str, ruta: str) -> str:
+    """Clase de la ruta para control de admisión: lectura, reporte, escritura o auth."""
+    # El refresco de tokens no usa bcrypt: no compite con los logins
+    if ruta.startswith("/auth") and ruta != "/auth/refresh":
+        return AUTH
+    if ruta.endswith(("/balance", "/resumen")):
+        return REPORTE
+    if metodo in ("POST", "PUT", "PATCH", "DELETE"):
+        return ESCRITURA
+    return LECTURA
+
+
+class LimiteConcurrencia:
+    """Semáforo con cola de espera acotada y plazo máximo de espera."""
+
+    def __init__(self, clase: str, limite: int, max_en_cola: int, espera_maxima: float):
+        self.clase = clase
+        self.limite = limite
+        self.max_en_cola = max_en_cola
+        self.espera_maxima = espera_maxima
+        self.en_curso = 0
+        self.en_cola = 0
+        self._semaforo = asyncio.Semaphore(limite)
+
+    async def adquirir(self) -> bool:
+        """Devuelve False si la petición debe descartarse (cola llena o plazo vencido)."""
+        if self._semaforo.locked():
+            if self.en_cola >= self.max_en_cola:
+                metricas.incrementar("admision_rechazadas_cola_llena", self.clase)
+                return False
+            self.en_cola += 1
+            try:
+                await asyncio.wait_for(self._semaforo.acquire(), self.espera_maxima)
+            except asyncio.TimeoutError:
+                metricas.incrementar("admision_rechazadas_espera", self.clase)
+                return False
+            finally:
+                self.en_cola -= 1
+        else:
+            await self._semaforo.acquire()
+        self.en_curso += 1
+        metricas.incrementar("admision_admitidas", self.clase)
+        return True
+
+    def liberar(self):
+        self.en_curso -= 1
+        self._semaforo.release()
+
+
+class AdmisionMiddleware:
+    """
+    Control de admisión por clase de ruta. Cuando una clase está saturada
+    las peticiones esperan en una cola acotada; si la cola está llena o la
+    espera supera el plazo se responde 503 con Retry-After en lugar de
+    dejar que todas se degraden esperando conexión del pool.
+    """
+
+    def __init__(self, app, limites: Optional[Dict[str, int]] = None):
+        self.app = app
+        espera = ADMISION_ESPERA_MAXIMA_MS / 1000
+        self.retry_after = str(max(1, math.ceil(espera)))
+        self.limites = {
+            clase: LimiteConcurrencia(clase, limite, limite * ADMISION_FACTOR_COLA, espera)
+            for clase, limite in (limites or LIMITES_POR_DEFECTO).items()
+        }
+        metricas.registrar_medidor("admision", lambda: {
+            clase: {"limite": l.limite, "en_curso": l.en_curso, "en_cola": l.en_cola}
+            for clase, l in self.limites.items()
+        })
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or scope["method"] == "OPTIONS"
+                or scope["path"] in RUTAS_EXENTAS or scope["path"].endswith(SUFIJOS_EXENTOS)):
+            await self.app(scope, receive, send)
+            return
+
+        limite = self.limites[clasificar_ruta(scope["method"], scope["path"])]
+        if not await limite.adquirir():
+            await self._rechazar(send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limite.liberar()
+
+    async def _rechazar(self, send):
+        cuerpo = json.dumps({"detail": "Servidor ocupado, intente de nuevo en unos segundos"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(cuerpo)).encode()),
+                (b"retry-after", self.retry_after.encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": cuerpo})
@@ -0,0 +1,194 @@
+"""
+Borrado por lotes de negocios grandes.
+
+Al pedir la eliminación el negocio solo se marca (`eliminado_en`) y la API
+responde de inmediato; este módulo borra sus filas en lotes acotados, cada
+uno en su propia transacción, para no retener bloqueos durante minutos. Las
+deudas y abonos caen por el ON DELETE CASCADE de cada lote. Los lotes se
+ejecutan en el shard del negocio.
+
+El progreso se guarda en la fila del negocio en el directorio (borrado_*),
+así cualquier worker lo informa y un borrado retomado conserva quién lo
+pidió. Al terminar se quitan los miembros y la fila queda, invisible, hasta
+BORRADO_CONSERVAR_HORAS para que quien lo pidió vea que terminó.
+"""
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import select, delete, update, func, tuple_
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app import models
+from app.database import engine, engines, SHARD_PRINCIPAL
+from app.utils.metricas import metricas
+from app.utils.programador import bloqueo_asesor
+
+logger = logging.getLogger(__name__)
+
+BORRADO_LOTE = int(os.getenv("BORRADO_LOTE", "5000"))
+# Pausa entre lotes para dejar pasar al resto de la carga
+BORRADO_PAUSA_MS = int(os.getenv("BORRADO_PAUSA_MS", "50"))
+# Tiempo que la fila de un negocio ya borrado se conserva para consultar el resultado
+BORRADO_CONSERVAR_HORAS = int(os.getenv("BORRADO_CONSERVAR_HORAS", "24"))
+
+COMPLETADO = "completado"
+
+
+@dataclass
+class ProgresoBorrado:
+    negocio_id: int
+    etapa: str = "pendiente"
+    filas_borradas: Dict[str, int] = field(default_factory=dict)
+    # Con True cada lote se registra en la fila del negocio (borrado de negocios;
+    # no en la limpieza de un traslado entre shards)
+    registrar: bool = False
+
+
+# Borrados en curso en este proceso
+_tareas: Dict[int, asyncio.Task] = {}
+
+
+async def _registrar(progreso: ProgresoBorrado, borradas: int = 0):
+    async with engine.begin() as conn:
+        await conn.execute(
+            update(models.Negocio).where(models.Negocio.id == progreso.negocio_id)
+            .values(borrado_etapa=progreso.etapa, borrado_filas=models.Negocio.borrado_filas + borradas)
+        )
+
+
+def _lotes_por_tabla(negocio_id: int):
+    """(nombre, sentencia que borra un lote) en el orden en que se vacían las tablas."""
+    T = models.Transaccion
+    C = models.Cliente
+    R = models.ResumenTransacciones
+    transacciones = select(T.id, T.fecha).where(T.negocio_id == negocio_id).limit(BORRADO_LOTE)
+    clientes = select(C.id).where(C.negocio_id == negocio_id).limit(BORRADO_LOTE)
+    resumen = select(R.fecha, R.tipo).where(R.negocio_id == negocio_id).limit(BORRADO_LOTE)
+    return [
+        # Cada transacción se lleva su deuda y los abonos de esta
+        ("transacciones", delete(T).where(tuple_(T.id, T.fecha).in_(transacciones))),
+        # Clientes restantes (y deudas que no colgaban de una transacción del lote)
+        ("clientes", delete(C).where(C.id.in_(clientes))),
+        ("transacciones_resumen", delete(R).where(
+            R.negocio_id == negocio_id, tuple_(R.fecha, R.tipo).in_(resumen)
+        )),
+    ]
+
+
+async def _shard_del_negocio(negocio_id: int) -> Optional[str]:
+    async with engine.connect() as conn:
+        return (await conn.execute(
+            select(models.Negocio.shard).where(models.Negocio.id == negocio_id)
+        )).scalar()
+
+
+async def vaciar_negocio(motor: AsyncEngine, negocio_id: int, progreso: ProgresoBorrado):
+    """Borra por lotes los datos del negocio en un shard (no la fila del negocio)."""
+    for nombre, sentencia in _lotes_por_tabla(negocio_id):
+        progreso.etapa = nombre
+        while True:
+            async with motor.begin() as conn:
+                borradas = (await conn.execute(sentencia)).rowcount
+            progreso.filas_borradas[nombre] = progreso.filas_borradas.get(nombre, 0) + borradas
+            metricas.incrementar("borrado_filas", nombre, borradas)
+            if progreso.registrar:
+                await _registrar(progreso, borradas)
+            if borradas < BORRADO_LOTE:
+                break
+            await asyncio.sleep(BORRADO_PAUSA_MS / 1000)
+
+
+async def _borrar(negocio_id: int, progreso: ProgresoBorrado):
+    shard = await _shard_del_negocio(negocio_id)
+    if shard is None:
+        return
+    motor = engines[shard]
+    await vaciar_negocio(motor, negocio_id, progreso)
+
+    # Lo que queda es pequeño: la copia de la fila del negocio en el shard y
+    # los miembros. La fila del directorio queda con el resultado
+    progreso.etapa = COMPLETADO
+    if shard != SHARD_PRINCIPAL:
+        async with motor.begin() as conn:
+            await conn.execute(delete(models.Negocio).where(models.Negocio.id == negocio_id))
+    async with engine.begin() as conn:
+        await conn.execute(delete(models.usuarios_negocios).where(models.usuarios_negocios.c.negocio_id == negocio_id))
+        ahora = datetime.utcnow()
+        await conn.execute(
+            update(models.Negocio).where(models.Negocio.id == negocio_id)
+            .values(borrado_etapa=COMPLETADO, borrado_fin=ahora,
+                    eliminado_en=func.coalesce(models.Negocio.eliminado_en, ahora))
+        )
+
+
+async def ejecutar_borrado(negocio_id: int):
+    """Borra el negocio por lotes; solo un worker a la vez trabaja sobre cada negocio."""
+    progreso = ProgresoBorrado(negocio_id, registrar=True)
+    inicio = time.perf_counter()
+    try:
+        async with bloqueo_asesor(f"borrado_negocio_{negocio_id}") as obtenido:
+            if not obtenido:
+                return
+            await _borrar(negocio_id, progreso)
+        logger.info("Negocio %s eliminado en %.1f s: %s", negocio_id, time.perf_counter() - inicio,
+                    progreso.filas_borradas)
+    except Exception:
+        # Queda marcado: la tarea de recuperación lo retomará
+        logger.exception("Fallo borrando el negocio %s", negocio_id)
+    finally:
+        _tareas.pop(negocio_id, None)
+
+
+def programar_borrado(negocio_id: int):
+    """Lanza el borrado en segundo plano si este proceso no lo está ejecutando ya."""
+    if negocio_id in _tareas:
+        return
+    _tareas[negocio_id] = asyncio.get_running_loop().create_task(
+        ejecutar_borrado(negocio_id), name=f"borrado_negocio_{negocio_id}"
+    )
+
+
+async def leer_progreso(negocio_id: int) -> Optional[Tuple[Optional[int], dict]]:
+    """(usuario que pidió el borrado, progreso) de un negocio eliminado; None si no hay borrado."""
+    N = models.Negocio
+    async with engine.connect() as conn:
+        fila = (await conn.execute(
+            select(N.eliminado_en, N.borrado_por, N.borrado_etapa, N.borrado_filas, N.borrado_fin)
+            .where(N.id == negocio_id)
+        )).first()
+    if fila is None or fila.eliminado_en is None:
+        return None
+    return fila.borrado_por, {
+        "negocio_id": negocio_id,
+        "estado": COMPLETADO if fila.borrado_fin is not None else "en_curso",
+        "etapa": fila.borrado_etapa or "pendiente",
+        "filas_borradas": fila.borrado_filas,
+        "segundos": round(((fila.borrado_fin or datetime.utcnow()) - fila.eliminado_en).total_seconds(), 1),
+    }
+
+
+async def reanudar_borrados():
+    """
+    Tarea periódica: retoma los negocios marcados cuyo borrado quedó a medias
+    (reinicio del proceso, error) y quita los terminados hace más de
+    BORRADO_CONSERVAR_HORAS. El advisory lock evita duplicar trabajo.
+    """
+    async with engine.begin() as conn:
+        await conn.execute(delete(models.Negocio).where(
+            models.Negocio.borrado_fin < datetime.utcnow() - timedelta(hours=BORRADO_CONSERVAR_HORAS)
+        ))
+        result = await conn.execute(
+            select(models.Negocio.id).where(
+                models.Negocio.eliminado_en.is_not(None), models.Negocio.borrado_fin.is_(None)
+            )
+        )
+        marcados = [fila.id for fila in result]
+    for negocio_id in marcados:
+        if negocio_id not in _tareas:
+            await ejecutar_borrado(negocio_id)
+
@@ -0,0 +1,184 @@
+"""
+Caché en memoria de los reportes agregados por negocio (balance, resumen de
+deudas, totales del resumen de negocios).
+
+La clave incluye la versión de escritura del negocio: cada escritura de crud
+marca el negocio en la sesión y, al confirmar, su versión sube y sus entradas
+se descartan. La invalidación llega a los demás workers por NOTIFY en el
+canal CANAL_INVALIDACION (app/utils/eventos.py, siempre activo); mientras el
+worker no está escuchando ese canal la caché no se usa. El TTL acota lo que
+cambie fuera de la aplicación (conciliación desde la línea de comandos,
+restauraciones).
+
+La memoria se limita por tamaño estimado (pickle) con desalojo LRU, y las
+peticiones simultáneas de un mismo reporte ausente esperan a un solo cálculo.
+"""
+import asyncio
+import os
+import pickle
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, NamedTuple, Optional, Set, Tuple
+
+from sqlalchemy import event
+
+from app.database import SesionEnrutada
+from app.utils.metricas import metricas
+
+REPORTES_CACHE_BYTES = int(os.getenv("REPORTES_CACHE_BYTES", str(16 * 1024 * 1024)))
+REPORTES_CACHE_TTL_SEGUNDOS = int(os.getenv("REPORTES_CACHE_TTL_SEGUNDOS", "60"))
+CANAL_INVALIDACION = "reportes_invalidados"
+
+
+class _Entrada(NamedTuple):
+    valor: Any
+    tamano: int
+    creada: float  # time.monotonic()
+
+
+# (reporte, negocio_id, versión del negocio, parámetros)
+_Clave = Tuple[str, int, int, tuple]
+
+
+class CacheReportes:
+    """LRU acotado en bytes, con invalidación por negocio y cálculos en curso."""
+
+    def __init__(self, max_bytes: int, ttl_segundos: float):
+        self.max_bytes = max_bytes
+        self.ttl_segundos = ttl_segundos
+        self._entradas: "OrderedDict[_Clave, _Entrada]" = OrderedDict()
+        self._por_negocio: Dict[int, Set[_Clave]] = {}
+        self._versiones: Dict[int, int] = {}
+        self._bytes = 0
+        self.en_vuelo: Dict[_Clave, asyncio.Future] = {}
+        # Solo con el LISTEN de invalidaciones activo: sin él otro worker
+        # podría cambiar un negocio sin que este se entere
+        self.escuchando = False
+        metricas.registrar_medidor("cache_reportes_bytes", lambda: self._bytes)
+        metricas.registrar_medidor("cache_reportes_entradas", lambda: len(self._entradas))
+        metricas.registrar_medidor("cache_reportes_tasa_aciertos", _tasa_aciertos)
+
+    def clave(self, reporte: str, negocio_id: int, parametros: tuple) -> _Clave:
+        return reporte, negocio_id, self._versiones.get(negocio_id, 0), parametros
+
+    def obtener(self, clave: _Clave) -> Optional[_Entrada]:
+        if not self.escuchando:
+            return None
+        entrada = self._entradas.get(clave)
+        if entrada is None:
+            return None
+        if time.monotonic() - entrada.creada > self.ttl_segundos:
+            self._quitar(clave)
+            return None
+        self._entradas.move_to_end(clave)
+        return entrada
+
+    def guardar(self, clave: _Clave, valor: Any):
+        _, negocio_id, version, _ = clave
+        # El negocio cambió mientras se calculaba: el resultado ya no vale
+        if not self.escuchando or version != self._versiones.get(negocio_id, 0):
+            return
+        tamano = len(pickle.dumps(valor, protocol=pickle.HIGHEST_PROTOCOL))
+        if tamano > self.max_bytes:
+            return
+        self._quitar(clave)
+        self._entradas[clave] = _Entrada(valor, tamano, time.monotonic())
+        self._por_negocio.setdefault(negocio_id, set()).add(clave)
+        self._bytes += tamano
+        while self._bytes > self.max_bytes:
+            self._quitar(next(iter(self._entradas)))
+            metricas.incrementar("cache_reportes_desalojos")
+
+    def invalidar(self, negocio_ids: Iterable[int]):
+        for negocio_id in negocio_ids:
+            self._versiones[negocio_id] = self._versiones.get(negocio_id, 0) + 1
+            for clave in self._por_negocio.pop(negocio_id, ()):
+                entrada = self._entradas.pop(clave)
+                self._bytes -= entrada.tamano
+
+    def vaciar(self):
+        self.invalidar(list(self._por_negocio))
+
+    def _quitar(self, clave: _Clave):
+        entrada = self._entradas.pop(clave, None)
+        if entrada is None:
+            return
+        self._bytes -= entrada.tamano
+        claves = self._por_negocio[clave[1]]
+        claves.discard(clave)
+        if not claves:
+            del self._por_negocio[clave[1]]
+
+
+def _tasa_aciertos() -> float:
+    aciertos = metricas.contador("cache_reportes", "acierto")
+    total = aciertos + metricas.contador("cache_reportes", "fallo")
+    return round(aciertos / total, 4) if total else 0.0
+
+
+cache = CacheReportes(REPORTES_CACHE_BYTES, REPORTES_CACHE_TTL_SEGUNDOS)
+
+
+async def obtener_o_calcular(reporte: str, negocio_id: int, parametros: tuple,
+                             calcular: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Devuelve el reporte desde la caché o lo calcula con `calcular`. Si otra
+    petición de este proceso ya lo está calculando, espera su resultado; si
+    esa petición falla, se reintenta desde el principio. El llamador
+    comprueba antes el acceso al negocio.
+    """
+    while True:
+        clave = cache.clave(reporte, negocio_id, parametros)
+        entrada = cache.obtener(clave)
+        if entrada is not None:
+            metricas.incrementar("cache_reportes", "acierto")
+            return entrada.valor
+
+        en_curso = cache.en_vuelo.get(clave)
+        if en_curso is None:
+            break
+        metricas.incrementar("cache_reportes", "coalescida")
+        await asyncio.shield(en_curso)
+
+    metricas.incrementar("cache_reportes", "fallo")
+    en_curso = asyncio.get_running_loop().create_future()
+    cache.en_vuelo[clave] = en_curso
+    try:
+        valor = await calcular()
+        cache.guardar(clave, valor)
+        return valor
+    finally:
+        del cache.en_vuelo[clave]
+        en_curso.set_result(None)
+
+
+def obtener_varios(reporte: str, negocio_ids: Iterable[int], parametros: tuple) -> \
+        Tuple[Dict[int, Any], Dict[int, _Clave]]:
+    """
+    Reportes de varios negocios a la vez: los que están en caché y las claves
+    de los que faltan, para guardarlos con `cache.guardar` tras calcularlos.
+    """
+    encontrados: Dict[int, Any] = {}
+    faltantes: Dict[int, _Clave] = {}
+    for negocio_id in negocio_ids:
+        clave = cache.clave(reporte, negocio_id, parametros)
+        entrada = cache.obtener(clave)
+        if entrada is None:
+            metricas.incrementar("cache_reportes", "fallo")
+            faltantes[negocio_id] = clave
+        else:
+            metricas.incrementar("cache_reportes", "acierto")
+            encontrados[negocio_id] = entrada.valor
+    return encontrados, faltantes
+
+
+def marcar_modificado(db, negocio_id: int):
+    """Invalida los reportes del negocio cuando la sesión confirme."""
+    db.info.setdefault("negocios_modificados", set()).add(negocio_id)
+
+
+@event.listens_for(SesionEnrutada, "after_commit")
+def _al_confirmar(sesion):
+    modificados = sesion.info.pop("negocios_modificados", None)
+    if modificados:
+        cache.invalidar(modificados)
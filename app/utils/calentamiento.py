@@ -0,0 +1,93 @@
+"""
+Calentamiento del worker antes de aceptar tráfico.
+
+Las primeras peticiones de un worker nuevo pagan la configuración de los
+mappers, el handshake TLS de las conexiones a Postgres, la compilación de
+las consultas (SQLAlchemy y sentencias preparadas de asyncpg) y la carga del
+backend de bcrypt. `calentar()` hace todo eso en el lifespan; el worker
+responde en /listo solo cuando terminó.
+"""
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.orm import configure_mappers
+
+from app import crud
+from app.auth import pwd_context
+from app.database import engines, sesion_en_shard, POOL_SIZE
+from app.utils.metricas import metricas
+
+logger = logging.getLogger(__name__)
+
+CALENTAMIENTO_ACTIVO = os.getenv("CALENTAMIENTO_ACTIVO", "1") == "1"
+# Conexiones que se abren por adelantado en cada pool (quedan en él, hasta pool_size)
+CALENTAMIENTO_CONEXIONES = min(POOL_SIZE, int(os.getenv("CALENTAMIENTO_CONEXIONES", "2")))
+
+# Id que no existe: las consultas se compilan y preparan sin leer filas
+_SIN_FILAS = -1
+
+
+@dataclass
+class EstadoArranque:
+    listo: bool = False
+    etapas_ms: Dict[str, float] = field(default_factory=dict)
+
+    def como_dict(self) -> dict:
+        return {"listo": self.listo, "calentamiento_ms": {k: round(v, 1) for k, v in self.etapas_ms.items()}}
+
+
+estado = EstadoArranque()
+
+
+async def _abrir_conexiones(motor: AsyncEngine, cantidad: int):
+    """Abre `cantidad` conexiones a la vez (handshakes TLS en paralelo) y las deja en el pool."""
+    async def _abrir():
+        conn = await motor.connect()
+        await conn.execute(text("SELECT 1"))
+        return conn
+
+    conexiones = await asyncio.gather(*(_abrir() for _ in range(cantidad)))
+    for conn in conexiones:
+        await conn.close()
+
+
+async def _consultas_calientes(shard: str):
+    """Las lecturas más frecuentes de crud, una vez, sobre un id inexistente."""
+    async with sesion_en_shard(shard) as db:
+        await crud.get_usuario_por_email(db, "")
+        await crud.usuario_en_negocio(db, _SIN_FILAS, _SIN_FILAS)
+        await crud.get_negocios(db, _SIN_FILAS)
+        await crud.get_cliente(db, _SIN_FILAS)
+        await crud.get_transaccion(db, _SIN_FILAS)
+        await crud.get_deuda(db, _SIN_FILAS)
+        await crud.get_transacciones_by_negocio(db, _SIN_FILAS)
+        await crud.get_balance(db, _SIN_FILAS)
+        await crud.get_resumen_negocios(db, _SIN_FILAS)
+
+
+async def calentar():
+    """Ejecuta las etapas de calentamiento y marca el worker como listo."""
+    async def _etapa(nombre: str, funcion):
+        inicio = time.perf_counter()
+        resultado = funcion()
+        if asyncio.iscoroutine(resultado):
+            await resultado
+        estado.etapas_ms[nombre] = (time.perf_counter() - inicio) * 1000
+        metricas.observar("calentamiento_ms", estado.etapas_ms[nombre], nombre)
+
+    if CALENTAMIENTO_ACTIVO:
+        await _etapa("mappers", configure_mappers)
+        # bcrypt carga su backend en el primer login si no se hace aquí
+        await _etapa("bcrypt", lambda: pwd_context.handler("bcrypt").get_backend())
+        await _etapa("conexiones", lambda: asyncio.gather(*(
+            _abrir_conexiones(motor, CALENTAMIENTO_CONEXIONES) for motor in engines.values()
+        )))
+        await _etapa("consultas", lambda: asyncio.gather(*(_consultas_calientes(shard) for shard in engines)))
+        logger.info("Worker calentado: %s", estado.como_dict()["calentamiento_ms"])
+    estado.listo = True
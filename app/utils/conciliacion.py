@@ -0,0 +1,199 @@
+"""
+Conciliación de deudas contra sus abonos.
+
+Verifica que `monto_pagado` y `estado` de cada deuda coincidan con la suma
+de sus abonos. Recorre `deudas` por rangos de id independientes que se
+procesan en paralelo, cada uno con una consulta agregada. Con varios shards
+se recorren los rangos de todos a la vez.
+
+Uso desde la línea de comandos:
+    python -m app.utils.conciliacion [--reparar] [--lote N] [--conexiones N]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import List
+
+from sqlalchemy import select, update, func, case, or_
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app import models
+from app.database import engines, POOL_SIZE, cerrar_engines
+from app.utils import cache_reportes
+from app.utils.metricas import metricas
+from app.utils.programador import bloqueo_asesor
+
+logger = logging.getLogger(__name__)
+
+CONCILIACION_LOTE = int(os.getenv("CONCILIACION_LOTE", "20000"))
+# Rangos procesados a la vez (cada uno ocupa una conexión del pool)
+CONCILIACION_CONEXIONES = int(os.getenv("CONCILIACION_CONEXIONES", str(max(1, POOL_SIZE // 2))))
+# La tarea programada corrige los descuadres solo si se habilita
+CONCILIACION_REPARAR = os.getenv("CONCILIACION_REPARAR") == "1"
+CONCILIACION_INTERVALO_HORAS = int(os.getenv("CONCILIACION_INTERVALO_HORAS", "24"))
+# Ids de deudas descuadradas incluidos en el informe
+MAX_IDS_INFORME = 100
+
+D = models.Deuda
+A = models.Abono
+
+
+@dataclass
+class InformeConciliacion:
+    revisadas: int = 0
+    descuadradas: int = 0
+    reparadas: int = 0
+    rangos: int = 0
+    segundos: float = 0.0
+    ids_descuadrados: List[int] = field(default_factory=list)
+
+    @property
+    def deudas_por_segundo(self) -> float:
+        return self.revisadas / self.segundos if self.segundos else 0.0
+
+    def como_dict(self) -> dict:
+        return {
+            "revisadas": self.revisadas,
+            "descuadradas": self.descuadradas,
+            "reparadas": self.reparadas,
+            "rangos": self.rangos,
+            "segundos": round(self.segundos, 2),
+            "deudas_por_segundo": round(self.deudas_por_segundo),
+            "ids_descuadrados": self.ids_descuadrados,
+        }
+
+
+def _calculo_rango(desde: int, hasta: int):
+    """Deudas del rango con lo que deberían tener según sus abonos."""
+    pagado = (
+        select(A.deuda_id, func.sum(A.monto).label("pagado"))
+        .where(A.deuda_id >= desde, A.deuda_id < hasta)
+        .group_by(A.deuda_id)
+        .subquery()
+    )
+    pagado_real = func.coalesce(pagado.c.pagado, 0)
+    # Mismas reglas que Deuda.actualizar_estado: lo pagado nunca supera el total
+    monto_pagado = func.least(pagado_real, D.monto_total)
+    estado = case(
+        (pagado_real == 0, models.EstadoDeuda.pendiente.name),
+        (pagado_real >= D.monto_total, models.EstadoDeuda.saldado.name),
+        else_=models.EstadoDeuda.parcial.name
+    ).cast(D.estado.type)
+    return (
+        select(D.id, monto_pagado.label("monto_pagado"), estado.label("estado"))
+        .outerjoin(pagado, pagado.c.deuda_id == D.id)
+        .where(D.id >= desde, D.id < hasta)
+        .subquery()
+    )
+
+
+async def _conciliar_rango(motor: AsyncEngine, desde: int, hasta: int, reparar: bool, informe: InformeConciliacion):
+    calculo = _calculo_rango(desde, hasta)
+    descuadradas = (
+        select(D.id)
+        .join(calculo, calculo.c.id == D.id)
+        .where(or_(D.monto_pagado != calculo.c.monto_pagado, D.estado != calculo.c.estado))
+        .order_by(D.id)
+    )
+    if reparar:
+        descuadradas = descuadradas.with_for_update(of=D)
+
+    async with motor.begin() as conn:
+        revisadas = (await conn.execute(
+            select(func.count()).where(D.id >= desde, D.id < hasta)
+        )).scalar()
+        ids = (await conn.execute(descuadradas)).scalars().all()
+
+        reparadas = 0
+        if ids and reparar:
+            # Las filas ya están bloqueadas: esta sentencia (con instantánea nueva)
+            # ve los abonos que otras transacciones acaben de confirmar
+            calculo = _calculo_rango(desde, hasta)
+            result = await conn.execute(
+                update(D)
+                .where(D.id == calculo.c.id)
+                .where(or_(D.monto_pagado != calculo.c.monto_pagado, D.estado != calculo.c.estado))
+                .values(monto_pagado=calculo.c.monto_pagado, estado=calculo.c.estado)
+                .returning(D.id)
+            )
+            reparadas = len(result.all())
+
+    informe.revisadas += revisadas
+    informe.descuadradas += len(ids)
+    informe.reparadas += reparadas
+    informe.rangos += 1
+    espacio = MAX_IDS_INFORME - len(informe.ids_descuadrados)
+    if espacio > 0:
+        informe.ids_descuadrados.extend(ids[:espacio])
+
+
+async def conciliar(reparar: bool = False, lote: int = None, conexiones: int = None) -> InformeConciliacion:
+    """Concilia todas las deudas por rangos de `lote` ids, `conexiones` rangos a la vez."""
+    lote = lote or CONCILIACION_LOTE
+    limite = asyncio.Semaphore(conexiones or CONCILIACION_CONEXIONES)
+    informe = InformeConciliacion()
+    inicio = time.perf_counter()
+
+    rangos = []
+    for motor in engines.values():
+        async with motor.connect() as conn:
+            minimo, maximo = (await conn.execute(select(func.min(D.id), func.max(D.id)))).one()
+        if minimo is not None:
+            rangos.extend((motor, desde) for desde in range(minimo, maximo + 1, lote))
+
+    async def _con_limite(motor: AsyncEngine, desde: int):
+        async with limite:
+            await _conciliar_rango(motor, desde, desde + lote, reparar, informe)
+
+    # Los rangos son independientes: un fallo en uno no detiene al resto
+    resultados = await asyncio.gather(
+        *(_con_limite(motor, desde) for motor, desde in rangos),
+        return_exceptions=True
+    )
+    errores = [r for r in resultados if isinstance(r, Exception)]
+    for error in errores:
+        logger.error("Fallo conciliando un rango de deudas", exc_info=error)
+
+    informe.segundos = time.perf_counter() - inicio
+    metricas.incrementar("conciliacion_deudas", "revisadas", informe.revisadas)
+    metricas.incrementar("conciliacion_deudas", "descuadradas", informe.descuadradas)
+    metricas.incrementar("conciliacion_deudas", "reparadas", informe.reparadas)
+    metricas.observar("conciliacion_segundos", informe.segundos)
+    if informe.reparadas:
+        # Los resúmenes de deudas en caché (de este proceso; el resto caduca por TTL) ya no cuadran
+        cache_reportes.cache.vaciar()
+    if errores:
+        raise RuntimeError(f"{len(errores)} rangos de deudas no se pudieron conciliar")
+    return informe
+
+
+async def conciliar_programado():
+    """Tarea periódica: concilia (y repara si CONCILIACION_REPARAR=1) en un solo worker."""
+    async with bloqueo_asesor("conciliacion_deudas") as obtenido:
+        if not obtenido:
+            return
+        informe = await conciliar(reparar=CONCILIACION_REPARAR)
+    nivel = logging.WARNING if informe.descuadradas else logging.INFO
+    logger.log(nivel, "Conciliación de deudas: %s", informe.como_dict())
+
+
+async def _main(argumentos):
+    parser = argparse.ArgumentParser(description="Concilia deudas contra la suma de sus abonos")
+    parser.add_argument("--reparar", action="store_true", help="corrige monto_pagado y estado descuadrados")
+    parser.add_argument("--lote", type=int, default=CONCILIACION_LOTE, help="ids por rango")
+    parser.add_argument("--conexiones", type=int, default=CONCILIACION_CONEXIONES, help="rangos en paralelo")
+    opciones = parser.parse_args(argumentos)
+
+    informe = await conciliar(opciones.reparar, opciones.lote, opciones.conexiones)
+    for clave, valor in informe.como_dict().items():
+        print(f"{clave}: {valor}")
+    await cerrar_engines()
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main(sys.argv[1:]))
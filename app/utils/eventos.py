@@ -0,0 +1,173 @@
+import asyncio
+import json
+import logging
+import os
+from collections import defaultdict
+from typing import Dict, Set
+
+from sqlalchemy import event, select, func
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+
+from app.database import DATABASE_URL, CONNECT_ARGS, SesionEnrutada
+from app.utils import cache_reportes, revocacion
+from app.utils.metricas import metricas
+
+logger = logging.getLogger(__name__)
+
+# Con EVENTOS_PG_NOTIFY=1 los eventos viajan por LISTEN/NOTIFY y llegan a
+# los suscriptores de todos los workers; si no, solo a los de este proceso.
+EVENTOS_PG_NOTIFY = os.getenv("EVENTOS_PG_NOTIFY") == "1"
+# Eventos pendientes por suscriptor antes de pedirle que se resincronice
+EVENTOS_BUFFER = int(os.getenv("EVENTOS_BUFFER", "100"))
+CANAL_EVENTOS = "eventos_negocio"
+
+# Eventos tras los que los suscriptores reciben el balance actualizado
+EVENTOS_CON_BALANCE = {"transaccion_creada", "transaccion_actualizada", "transaccion_eliminada"}
+# Eventos que no provienen de una escritura (no invalidan los reportes en caché)
+EVENTOS_DERIVADOS = {"balance", "resincronizar"}
+
+
+def serializar(evento: dict) -> str:
+    return json.dumps(evento, default=str, separators=(",", ":"))
+
+
+class BusEventos:
+    """
+    Difusión en memoria de eventos por negocio. Cada suscriptor tiene una
+    cola acotada: si se llena (cliente lento) se vacía y se le envía un
+    evento "resincronizar" para que vuelva a consultar los listados.
+    """
+
+    def __init__(self, tamano_buffer: int):
+        self.tamano_buffer = tamano_buffer
+        self._suscriptores: Dict[int, Set[asyncio.Queue]] = defaultdict(set)
+        self._balances_pendientes: Set[int] = set()
+        metricas.registrar_medidor("eventos_suscriptores", lambda: sum(len(s) for s in self._suscriptores.values()))
+
+    def suscribir(self, negocio_id: int) -> asyncio.Queue:
+        cola = asyncio.Queue(maxsize=self.tamano_buffer)
+        self._suscriptores[negocio_id].add(cola)
+        return cola
+
+    def desuscribir(self, negocio_id: int, cola: asyncio.Queue):
+        suscriptores = self._suscriptores.get(negocio_id)
+        if suscriptores is None:
+            return
+        suscriptores.discard(cola)
+        if not suscriptores:
+            del self._suscriptores[negocio_id]
+
+    def hay_suscriptores(self, negocio_id: int) -> bool:
+        return negocio_id in self._suscriptores
+
+    def publicar(self, evento: dict):
+        negocio_id = evento["negocio_id"]
+        # Por NOTIFY el evento puede llegar antes que la invalidación de la
+        # misma escritura: el balance que se publique a continuación no debe salir de la caché
+        if evento["tipo"] not in EVENTOS_DERIVADOS:
+            cache_reportes.cache.invalidar((negocio_id,))
+        for cola in self._suscriptores.get(negocio_id, ()):
+            if cola.full():
+                metricas.incrementar("eventos_desbordados")
+                while not cola.empty():
+                    cola.get_nowait()
+                cola.put_nowait({"tipo": "resincronizar", "negocio_id": negocio_id})
+            else:
+                cola.put_nowait(evento)
+
+        if evento["tipo"] in EVENTOS_CON_BALANCE and self.hay_suscriptores(negocio_id):
+            self._programar_balance(negocio_id)
+
+    def _programar_balance(self, negocio_id: int):
+        # Varias transacciones seguidas generan un solo cálculo de balance
+        if negocio_id in self._balances_pendientes:
+            return
+        self._balances_pendientes.add(negocio_id)
+        asyncio.get_running_loop().create_task(self._publicar_balance(negocio_id))
+
+    async def _publicar_balance(self, negocio_id: int):
+        # Importación diferida: crud publica eventos a través de este módulo
+        from app import crud
+        from app.database import async_session_maker
+
+        try:
+            async with async_session_maker() as db:
+                await crud.fijar_negocio(db, negocio_id)
+                balance = await crud.get_balance(db, negocio_id)
+            self.publicar({
+                "tipo": "balance",
+                "negocio_id": negocio_id,
+                "total_ingresos": balance["total_ingresos"],
+                "total_egresos": balance["total_egresos"],
+                "balance": balance["balance"],
+            })
+        except Exception:
+            logger.exception("No se pudo calcular el balance del negocio %s", negocio_id)
+        finally:
+            self._balances_pendientes.discard(negocio_id)
+
+
+bus = BusEventos(EVENTOS_BUFFER)
+
+
+@event.listens_for(SesionEnrutada, "before_commit")
+def _notificar_invalidacion(sesion):
+    # Siempre, con o sin EVENTOS_PG_NOTIFY: los demás workers descartan los
+    # reportes de estos negocios cuando el commit tiene éxito
+    modificados = sesion.info.get("negocios_modificados")
+    if modificados:
+        sesion.execute(select(func.pg_notify(
+            cache_reportes.CANAL_INVALIDACION, ",".join(str(n) for n in sorted(modificados))
+        )))
+
+
+async def escuchar_notificaciones():
+    """
+    Escucha las invalidaciones de reportes, las revocaciones de tokens y,
+    con EVENTOS_PG_NOTIFY, los eventos, que reparte en el bus local. Usa una conexión propia (fuera del
+    pool) y se reconecta si cae; sin conexión la caché de reportes no se usa.
+    """
+    engine_escucha = create_async_engine(DATABASE_URL, poolclass=NullPool, connect_args=CONNECT_ARGS)
+
+    def _recibir(_conexion, _pid, _canal, payload):
+        try:
+            bus.publicar(json.loads(payload))
+        except Exception:
+            logger.exception("Evento inválido recibido por NOTIFY")
+
+    def _invalidar(_conexion, _pid, _canal, payload):
+        cache_reportes.cache.invalidar(int(n) for n in payload.split(","))
+
+    def _revocados(_conexion, _pid, _canal, payload):
+        revocacion.recibir_revocados(payload)
+
+    def _desconectada(_conexion):
+        cache_reportes.cache.escuchando = False
+
+    try:
+        while True:
+            try:
+                async with engine_escucha.connect() as conn:
+                    raw = await conn.get_raw_connection()
+                    asyncpg_conn = raw.driver_connection
+                    if EVENTOS_PG_NOTIFY:
+                        await asyncpg_conn.add_listener(CANAL_EVENTOS, _recibir)
+                    await asyncpg_conn.add_listener(cache_reportes.CANAL_INVALIDACION, _invalidar)
+                    await asyncpg_conn.add_listener(revocacion.CANAL_REVOCACION, _revocados)
+                    asyncpg_conn.add_termination_listener(_desconectada)
+                    # Lo invalidado mientras no se escuchaba se perdió
+                    cache_reportes.cache.vaciar()
+                    cache_reportes.cache.escuchando = True
+                    await revocacion.sincronizar_revocados()
+                    while not asyncpg_conn.is_closed():
+                        await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Conexión LISTEN perdida; reintentando")
+            finally:
+                cache_reportes.cache.escuchando = False
+            await asyncio.sleep(5)
+    finally:
+        await engine_escucha.dispose()
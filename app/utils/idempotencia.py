@@ -0,0 +1,182 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, NamedTuple, Optional, Tuple, Type
+
+from fastapi import HTTPException, Response
+from pydantic import BaseModel
+from sqlalchemy import select, delete
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import crud, models
+from app.database import engines, sesion_en_shard
+
+IDEMPOTENCIA_TTL_HORAS = int(os.getenv("IDEMPOTENCIA_TTL_HORAS", "24"))
+IDEMPOTENCIA_LRU_TAMANO = int(os.getenv("IDEMPOTENCIA_LRU_TAMANO", "10000"))
+
+
+class _Entrada(NamedTuple):
+    huella: str
+    respuesta: dict
+    creada: float  # time.time()
+
+
+_Clave = Tuple[int, str]
+
+
+class CacheIdempotencia:
+    """LRU en memoria de respuestas ya guardadas y registro de ejecuciones en curso."""
+
+    def __init__(self, tamano: int, ttl_segundos: float):
+        self.tamano = tamano
+        self.ttl_segundos = ttl_segundos
+        self._entradas: "OrderedDict[_Clave, _Entrada]" = OrderedDict()
+        self.en_vuelo: Dict[_Clave, asyncio.Future] = {}
+
+    def obtener(self, clave: _Clave) -> Optional[_Entrada]:
+        entrada = self._entradas.get(clave)
+        if entrada is None:
+            return None
+        if time.time() - entrada.creada > self.ttl_segundos:
+            del self._entradas[clave]
+            return None
+        self._entradas.move_to_end(clave)
+        return entrada
+
+    def guardar(self, clave: _Clave, entrada: _Entrada):
+        self._entradas[clave] = entrada
+        self._entradas.move_to_end(clave)
+        while len(self._entradas) > self.tamano:
+            self._entradas.popitem(last=False)
+
+
+cache = CacheIdempotencia(IDEMPOTENCIA_LRU_TAMANO, IDEMPOTENCIA_TTL_HORAS * 3600)
+
+
+def _huella(ruta: str, cuerpo: BaseModel) -> str:
+    return hashlib.sha256(f"{ruta}\n{cuerpo.model_dump_json()}".encode()).hexdigest()
+
+
+def _responder(entrada: _Entrada, huella: str, response: Response, repetida: bool) -> dict:
+    if entrada.huella != huella:
+        raise HTTPException(
+            status_code=422,
+            detail="La clave de idempotencia ya se usó con una petición distinta"
+        )
+    if repetida:
+        response.headers["Idempotent-Replayed"] = "true"
+    return entrada.respuesta
+
+
+def _vencimiento() -> datetime:
+    return datetime.utcnow() - timedelta(hours=IDEMPOTENCIA_TTL_HORAS)
+
+
+async def _leer_guardada(db: AsyncSession, clave: _Clave) -> Optional[_Entrada]:
+    usuario_id, valor = clave
+    result = await db.execute(
+        select(models.ClaveIdempotencia).where(
+            models.ClaveIdempotencia.usuario_id == usuario_id,
+            models.ClaveIdempotencia.clave == valor,
+            models.ClaveIdempotencia.created_at >= _vencimiento()
+        )
+    )
+    fila = result.scalar_one_or_none()
+    if fila is None:
+        return None
+    return _Entrada(fila.huella, json.loads(fila.respuesta), fila.created_at.timestamp())
+
+
+async def ejecutar_idempotente(
+        db: AsyncSession,
+        usuario_id: int,
+        clave: str,
+        ruta: str,
+        cuerpo: BaseModel,
+        crear: Callable[[], Awaitable[Any]],
+        esquema_out: Type[BaseModel],
+        response: Response
+) -> dict:
+    """
+    Ejecuta `crear` (una función de crud llamada con commit=False) una sola vez
+    por (usuario, Idempotency-Key).
+
+    - Si la clave ya tiene respuesta (LRU o tabla) se devuelve sin escribir nada.
+    - Si otra petición con la misma clave está en curso en este proceso, se
+      espera a que termine y se devuelve su respuesta.
+    - La respuesta se guarda en la misma transacción que la escritura; si otro
+      worker se adelantó, la clave primaria lo detecta y se devuelve la suya.
+    """
+    llave = (usuario_id, clave)
+    huella = _huella(ruta, cuerpo)
+
+    while True:
+        entrada = cache.obtener(llave)
+        if entrada is not None:
+            return _responder(entrada, huella, response, repetida=True)
+
+        en_curso = cache.en_vuelo.get(llave)
+        if en_curso is None:
+            break
+        # Si la ejecución original falla, se reintenta desde el principio
+        await asyncio.shield(en_curso)
+
+    en_curso = asyncio.get_running_loop().create_future()
+    cache.en_vuelo[llave] = en_curso
+    try:
+        entrada = await _leer_guardada(db, llave)
+        if entrada is not None:
+            cache.guardar(llave, entrada)
+            return _responder(entrada, huella, response, repetida=True)
+
+        # Una clave vencida que la purga aún no borró ocuparía la clave primaria
+        await db.execute(
+            delete(models.ClaveIdempotencia).where(
+                models.ClaveIdempotencia.usuario_id == usuario_id,
+                models.ClaveIdempotencia.clave == clave,
+                models.ClaveIdempotencia.created_at < _vencimiento()
+            )
+        )
+        obj = await crear()
+        respuesta = esquema_out.model_validate(obj).model_dump(mode="json")
+        db.add(models.ClaveIdempotencia(
+            usuario_id=usuario_id,
+            clave=clave,
+            ruta=ruta,
+            huella=huella,
+            respuesta=json.dumps(respuesta)
+        ))
+        try:
+            await crud.confirmar(db)
+        except IntegrityError:
+            # Otro worker guardó la misma clave primero: se descarta esta escritura
+            await crud.descartar(db)
+            entrada = await _leer_guardada(db, llave)
+            if entrada is None:
+                raise
+            cache.guardar(llave, entrada)
+            return _responder(entrada, huella, response, repetida=True)
+
+        entrada = _Entrada(huella, respuesta, time.time())
+        cache.guardar(llave, entrada)
+        return _responder(entrada, huella, response, repetida=False)
+    finally:
+        del cache.en_vuelo[llave]
+        en_curso.set_result(None)
+
+
+async def purgar_claves_vencidas():
+    """Elimina de la tabla (en cada shard) las claves más antiguas que el TTL."""
+    for shard in engines:
+        async with sesion_en_shard(shard) as db:
+            await db.execute(
+                delete(models.ClaveIdempotencia).where(
+                    models.ClaveIdempotencia.created_at < _vencimiento()
+                )
+            )
+            await db.commit()
@@ -0,0 +1,121 @@
+import codecs
+import csv
+import json
+import os
+from typing import AsyncIterator, Dict, List, Tuple
+
+from fastapi import HTTPException
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import crud, schemas
+
+# Filas por INSERT ... ON CONFLICT (4 parámetros por fila; asyncpg admite 32767)
+IMPORTACION_LOTE = int(os.getenv("IMPORTACION_LOTE", "5000"))
+# Errores detallados que se devuelven; el resto solo se cuenta
+IMPORTACION_MAX_ERRORES = int(os.getenv("IMPORTACION_MAX_ERRORES", "100"))
+
+TIPOS_CSV = ("text/csv", "application/csv")
+TIPOS_NDJSON = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+
+async def _lineas(cuerpo: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Parte el cuerpo en líneas a medida que llega, sin cargarlo completo en memoria."""
+    decodificador = codecs.getincrementaldecoder("utf-8-sig")()
+    resto = ""
+    async for bloque in cuerpo:
+        texto = resto + decodificador.decode(bloque)
+        *lineas, resto = texto.split("\n")
+        for linea in lineas:
+            yield linea.rstrip("\r")
+    resto += decodificador.decode(b"", final=True)
+    if resto:
+        yield resto.rstrip("\r")
+
+
+async def _registros(cuerpo: AsyncIterator[bytes], content_type: str) -> AsyncIterator[Tuple[int, object]]:
+    """(número de fila, dict o mensaje de error) por cada registro del archivo."""
+    tipo = content_type.split(";")[0].strip().lower()
+    if tipo in TIPOS_CSV:
+        columnas = None
+        fila = 0
+        async for linea in _lineas(cuerpo):
+            if not linea.strip():
+                continue
+            # Campos entre comillas con saltos de línea no se admiten: una fila por línea
+            valores = next(csv.reader([linea]))
+            if columnas is None:
+                columnas = [c.strip().lower() for c in valores]
+                continue
+            fila += 1
+            if len(valores) != len(columnas):
+                yield fila, f"Se esperaban {len(columnas)} columnas"
+                continue
+            yield fila, dict(zip(columnas, (v.strip() for v in valores)))
+    elif tipo in TIPOS_NDJSON:
+        fila = 0
+        async for linea in _lineas(cuerpo):
+            if not linea.strip():
+                continue
+            fila += 1
+            try:
+                yield fila, json.loads(linea)
+            except ValueError:
+                yield fila, "JSON inválido"
+    else:
+        raise HTTPException(status_code=415, detail="Formato no soportado: use text/csv o application/x-ndjson")
+
+
+async def importar_clientes(
+        db: AsyncSession,
+        negocio_id: int,
+        usuario_id: int,
+        cuerpo: AsyncIterator[bytes],
+        content_type: str
+) -> dict:
+    """
+    Importa clientes validando cada fila con ClienteCreate y haciendo upsert
+    por (negocio_id, identidad) en lotes. Cada lote se confirma por separado:
+    si la importación se corta, volver a ejecutarla no duplica nada.
+    """
+    if not await crud.usuario_en_negocio(db, negocio_id, usuario_id):
+        raise HTTPException(status_code=403, detail="No autorizado para este negocio")
+    # Libera la conexión mientras llega el cuerpo; cada lote toma una al escribir
+    await db.commit()
+
+    resultado = {"insertados": 0, "actualizados": 0, "sin_cambios": 0, "errores": 0, "detalle_errores": []}
+    # Por identidad: dentro de un mismo INSERT ... ON CONFLICT una clave no puede repetirse
+    lote: Dict[str, dict] = {}
+
+    def _error(fila: int, mensaje: str):
+        resultado["errores"] += 1
+        if len(resultado["detalle_errores"]) < IMPORTACION_MAX_ERRORES:
+            resultado["detalle_errores"].append({"fila": fila, "error": mensaje})
+
+    async def _vaciar():
+        filas: List[dict] = list(lote.values())
+        lote.clear()
+        insertados, actualizados = await crud.upsert_clientes(db, negocio_id, filas)
+        resultado["insertados"] += insertados
+        resultado["actualizados"] += actualizados
+        resultado["sin_cambios"] += len(filas) - insertados - actualizados
+
+    async for fila, registro in _registros(cuerpo, content_type):
+        if isinstance(registro, str):
+            _error(fila, registro)
+            continue
+        if not isinstance(registro, dict):
+            _error(fila, "Se esperaba un objeto")
+            continue
+        try:
+            cliente = schemas.ClienteCreate.model_validate({**registro, "negocio_id": negocio_id})
+        except ValidationError as e:
+            _error(fila, "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()))
+            continue
+        lote[cliente.identidad] = {"identidad": cliente.identidad, "nombre": cliente.nombre}
+        if len(lote) >= IMPORTACION_LOTE:
+            await _vaciar()
+
+    if lote:
+        await _vaciar()
+    return resultado
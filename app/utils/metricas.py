@@ -0,0 +1,56 @@
+from collections import defaultdict
+from threading import Lock
+from typing import Callable, Dict, Optional
+
+
+class Metricas:
+    """
+    Registro de métricas en memoria del proceso.
+
+    - Contadores: solo crecen (peticiones rechazadas, aciertos de caché...).
+    - Medidores: valores instantáneos calculados al leer (conexiones en uso...).
+    - Resúmenes: cantidad, suma y máximo de observaciones (duraciones).
+
+    Cada métrica puede llevar una etiqueta (ruta, clase de ruta...).
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._contadores: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        self._resumenes: Dict[str, Dict[str, Dict[str, float]]] = defaultdict(dict)
+        self._medidores: Dict[str, Callable[[], object]] = {}
+
+    def incrementar(self, nombre: str, etiqueta: str = "", valor: float = 1):
+        with self._lock:
+            self._contadores[nombre][etiqueta] += valor
+
+    def observar(self, nombre: str, valor: float, etiqueta: str = ""):
+        with self._lock:
+            resumen = self._resumenes[nombre].get(etiqueta)
+            if resumen is None:
+                resumen = self._resumenes[nombre][etiqueta] = {"cantidad": 0, "suma": 0.0, "max": 0.0}
+            resumen["cantidad"] += 1
+            resumen["suma"] += valor
+            resumen["max"] = max(resumen["max"], valor)
+
+    def registrar_medidor(self, nombre: str, funcion: Callable[[], object]):
+        self._medidores[nombre] = funcion
+
+    def contador(self, nombre: str, etiqueta: str = "") -> float:
+        return self._contadores.get(nombre, {}).get(etiqueta, 0)
+
+    def instantanea(self, prefijo: Optional[str] = None) -> dict:
+        with self._lock:
+            contadores = {n: dict(v) for n, v in self._contadores.items()}
+            resumenes = {
+                n: {e: {**r, "promedio": r["suma"] / r["cantidad"] if r["cantidad"] else 0} for e, r in v.items()}
+                for n, v in self._resumenes.items()
+            }
+        medidores = {n: f() for n, f in self._medidores.items()}
+        datos = {"contadores": contadores, "medidores": medidores, "resumenes": resumenes}
+        if prefijo:
+            datos = {tipo: {n: v for n, v in grupo.items() if n.startswith(prefijo)} for tipo, grupo in datos.items()}
+        return datos
+
+
+metricas = Metricas()
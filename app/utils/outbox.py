@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import List
+
+from sqlalchemy import select, update, delete, literal_column
+
+from app import models
+from app.database import engines, sesion_en_shard
+from app.utils.metricas import metricas
+from app.utils.telegram import EmisorTelegram, TELEGRAM_BOT_TOKEN
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_LOTE = int(os.getenv("OUTBOX_LOTE", "50"))
+OUTBOX_MAX_INTENTOS = int(os.getenv("OUTBOX_MAX_INTENTOS", "8"))
+# Espera máxima entre revisiones de la tabla cuando no llegan avisos de este proceso
+OUTBOX_INTERVALO_SEGUNDOS = float(os.getenv("OUTBOX_INTERVALO_SEGUNDOS", "5"))
+# Tiempo que un lote reclamado queda reservado; si el proceso muere, otro lo retoma
+OUTBOX_RESERVA_SEGUNDOS = int(os.getenv("OUTBOX_RESERVA_SEGUNDOS", "120"))
+OUTBOX_RETENCION_DIAS = int(os.getenv("OUTBOX_RETENCION_DIAS", "7"))
+
+M = models.MensajeSaliente
+
+# Se activa al confirmar una escritura con mensajes para entregarlos sin esperar al intervalo
+_aviso = asyncio.Event()
+
+
+def avisar():
+    _aviso.set()
+
+
+def _espera_reintento(intentos: int) -> timedelta:
+    # 10s, 20s, 40s... hasta una hora
+    return timedelta(seconds=min(3600, 10 * 2 ** (intentos - 1)))
+
+
+async def _reclamar_lote(shard: str) -> List:
+    """
+    Reserva hasta OUTBOX_LOTE mensajes vencidos. SKIP LOCKED permite que
+    varios workers drenen a la vez sin bloquearse ni repetir mensajes.
+    """
+    ahora = datetime.utcnow()
+    candidatos = (
+        select(M.id)
+        # Literal (no parámetro) para que el planificador use el índice parcial
+        .where(M.estado == literal_column("'pendiente'"), M.disponible_en <= ahora)
+        .order_by(M.disponible_en, M.id)
+        .limit(OUTBOX_LOTE)
+        .with_for_update(skip_locked=True)
+    )
+    async with sesion_en_shard(shard) as db:
+        result = await db.execute(
+            update(M)
+            .where(M.id.in_(candidatos.scalar_subquery()))
+            .values(intentos=M.intentos + 1, disponible_en=ahora + timedelta(seconds=OUTBOX_RESERVA_SEGUNDOS))
+            .returning(M.id, M.destino, M.contenido, M.intentos)
+        )
+        lote = result.all()
+        await db.commit()
+    return lote
+
+
+async def _entregar(emisor: EmisorTelegram, mensaje) -> tuple:
+    try:
+        if await emisor.enviar(mensaje.destino, mensaje.contenido):
+            return mensaje, None
+        return mensaje, "Telegram rechazó el mensaje"
+    except Exception as e:
+        return mensaje, repr(e)
+
+
+async def _registrar_resultados(shard: str, resultados):
+    ahora = datetime.utcnow()
+    enviados = [mensaje.id for mensaje, error in resultados if error is None]
+    async with sesion_en_shard(shard) as db:
+        if enviados:
+            await db.execute(
+                update(M).where(M.id.in_(enviados))
+                .values(estado=models.EstadoMensaje.enviado, enviado_en=ahora, ultimo_error=None)
+            )
+        for mensaje, error in resultados:
+            if error is None:
+                continue
+            agotado = mensaje.intentos >= OUTBOX_MAX_INTENTOS
+            await db.execute(
+                update(M).where(M.id == mensaje.id).values(
+                    estado=models.EstadoMensaje.fallido if agotado else models.EstadoMensaje.pendiente,
+                    disponible_en=ahora + _espera_reintento(mensaje.intentos),
+                    ultimo_error=error
+                )
+            )
+        await db.commit()
+    metricas.incrementar("outbox_mensajes", "enviados", len(enviados))
+    metricas.incrementar("outbox_mensajes", "fallidos", len(resultados) - len(enviados))
+
+
+async def drenar_pendientes(emisor: EmisorTelegram) -> int:
+    """
+    Entrega lotes hasta vaciar los mensajes vencidos de cada shard (el outbox
+    vive junto a los datos del negocio); devuelve cuántos se procesaron.
+    Sin bot configurado no reclama nada: reclamar cuenta un intento y los
+    mensajes acabarían como fallidos por falta de configuración.
+    """
+    if not TELEGRAM_BOT_TOKEN:
+        return 0
+    total = 0
+    for shard in engines:
+        while True:
+            lote = await _reclamar_lote(shard)
+            if not lote:
+                break
+            # El emisor espacia los envíos según el límite de Telegram
+            resultados = await asyncio.gather(*(_entregar(emisor, mensaje) for mensaje in lote))
+            await _registrar_resultados(shard, resultados)
+            total += len(lote)
+            if len(lote) < OUTBOX_LOTE:
+                break
+    return total
+
+
+async def drenar_outbox():
+    """Tarea de fondo: entrega los mensajes del outbox al recibir un aviso o cada intervalo."""
+    if not TELEGRAM_BOT_TOKEN:
+        # Sin bot no se escriben mensajes (crud._notificar_usuario) ni hay a quién entregarlos
+        return
+    async with EmisorTelegram() as emisor:
+        while True:
+            try:
+                await asyncio.wait_for(_aviso.wait(), OUTBOX_INTERVALO_SEGUNDOS)
+            except asyncio.TimeoutError:
+                pass
+            _aviso.clear()
+            try:
+                await drenar_pendientes(emisor)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Fallo drenando el outbox")
+
+
+async def purgar_outbox():
+    """Borra los mensajes enviados más antiguos que la retención."""
+    for shard in engines:
+        async with sesion_en_shard(shard) as db:
+            await db.execute(
+                delete(M).where(
+                    M.estado == models.EstadoMensaje.enviado,
+                    M.enviado_en < datetime.utcnow() - timedelta(days=OUTBOX_RETENCION_DIAS)
+                )
+            )
+            await db.commit()
+
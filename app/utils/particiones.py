@@ -0,0 +1,270 @@
+"""
+Particiones anuales de `transacciones` y archivo de años cerrados, en
+cada shard.
+
+Uso desde la línea de comandos:
+    python -m app.utils.particiones migrar
+    python -m app.utils.particiones asegurar
+    python -m app.utils.particiones archivar 2022
+
+`migrar` convierte una `transacciones` sin particionar (bases creadas antes
+de las particiones) en la tabla particionada del modelo. Renombra la tabla,
+así que debe correr con la aplicación detenida.
+"""
+import asyncio
+import logging
+import os
+import sys
+from datetime import date
+from typing import Optional
+
+from sqlalchemy import text, select, delete, exists, and_, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from app import models
+from app.database import engines, cerrar_engines
+from app.utils.programador import bloqueo_asesor
+
+logger = logging.getLogger(__name__)
+
+# Primer año para el que se crean particiones y cuántos años se crean por adelantado
+PARTICIONES_DESDE = int(os.getenv("PARTICIONES_DESDE", str(date.today().year - 5)))
+PARTICIONES_ANIOS_ADELANTE = int(os.getenv("PARTICIONES_ANIOS_ADELANTE", "1"))
+
+TABLA = models.Transaccion.__tablename__
+ANTIGUA = f"{TABLA}_antigua"
+# Columnas propias de la tabla sin particionar (la de búsqueda la genera Postgres)
+COLUMNAS_MIGRADAS = "id, negocio_id, tipo, monto, descripcion, fecha, created_at"
+
+
+def _nombre_particion(anio: int) -> str:
+    return f"{TABLA}_{anio}"
+
+
+async def _existe_tabla(conn: AsyncConnection, nombre: str) -> bool:
+    return (await conn.execute(select(func.to_regclass(nombre)))).scalar() is not None
+
+
+async def _particionada(conn: AsyncConnection) -> bool:
+    return (await conn.execute(
+        text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:tabla))"),
+        {"tabla": TABLA}
+    )).scalar()
+
+
+async def asegurar_particiones(conn: AsyncConnection, hasta: int = None, desde: int = None):
+    """
+    Crea la partición por defecto y una partición por año de `desde` a
+    `hasta` (por defecto de PARTICIONES_DESDE al año actual más
+    PARTICIONES_ANIOS_ADELANTE). Es idempotente.
+    """
+    hasta = hasta or date.today().year + PARTICIONES_ANIOS_ADELANTE
+    desde = desde or PARTICIONES_DESDE
+    defecto = f"{TABLA}_default"
+    await conn.execute(text(f"CREATE TABLE IF NOT EXISTS {defecto} PARTITION OF {TABLA} DEFAULT"))
+
+    for anio in range(desde, hasta + 1):
+        particion = _nombre_particion(anio)
+        if await _existe_tabla(conn, particion):
+            continue
+        # Si la partición por defecto ya recibió filas de ese año, Postgres no
+        # permite crearla: hay que moverlas a mano antes.
+        ocupada = (await conn.execute(text(
+            f"SELECT 1 FROM {defecto} WHERE fecha >= :inicio AND fecha < :fin LIMIT 1"
+        ), {"inicio": date(anio, 1, 1), "fin": date(anio + 1, 1, 1)})).first()
+        if ocupada:
+            logger.warning("La partición por defecto tiene filas de %s; no se crea %s", anio, particion)
+            continue
+        await conn.execute(text(
+            f"CREATE TABLE {particion} PARTITION OF {TABLA} "
+            f"FOR VALUES FROM ('{anio}-01-01') TO ('{anio + 1}-01-01')"
+        ))
+        logger.info("Partición %s creada", particion)
+
+
+async def mantener_particiones():
+    """Tarea periódica: crea por adelantado las particiones de los próximos años."""
+    async with bloqueo_asesor("particiones_transacciones") as obtenido:
+        if not obtenido:
+            return
+        for nombre, motor in engines.items():
+            async with motor.begin() as conn:
+                if not await _particionada(conn):
+                    logger.error(
+                        "%s del shard %s no está particionada: ejecute python -m app.utils.particiones migrar",
+                        TABLA, nombre
+                    )
+                    continue
+                await asegurar_particiones(conn)
+
+
+async def migrar_a_particionada(conn: AsyncConnection) -> Optional[int]:
+    """
+    Convierte la tabla sin particionar en la particionada del modelo, dentro
+    de la transacción de `conn` (si algo falla no queda nada a medias).
+    Devuelve las transacciones copiadas, o None si ya estaba particionada.
+
+    1. Se quitan las claves foráneas que apuntan a la tabla (deudas.transaccion_id).
+    2. La tabla, sus índices y su secuencia pasan a llamarse *_antigua.
+    3. Se crean la tabla particionada y sus particiones, desde el año de la
+       transacción más antigua (antes de copiar: con filas en la partición
+       por defecto Postgres no deja crear la de su año).
+    4. Se copian las filas y la secuencia nueva sigue donde iba la vieja.
+    5. Se agrega y rellena deudas.transaccion_fecha.
+    6. Se crea la clave foránea compuesta (transaccion_id, transaccion_fecha).
+    7. Se borra la tabla antigua.
+    """
+    if await _particionada(conn):
+        return None
+
+    # 1.
+    referencias = (await conn.execute(text(
+        "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+        "WHERE contype = 'f' AND confrelid = to_regclass(:tabla)"
+    ), {"tabla": TABLA})).all()
+    for tabla, restriccion in referencias:
+        await conn.execute(text(f'ALTER TABLE {tabla} DROP CONSTRAINT "{restriccion}"'))
+
+    # 2. Deja libres los nombres que usa el modelo (transacciones_pkey, ix_..., la secuencia)
+    secuencia = (await conn.execute(select(func.pg_get_serial_sequence(TABLA, "id")))).scalar()
+    await conn.execute(text(f"ALTER TABLE {TABLA} RENAME TO {ANTIGUA}"))
+    indices = (await conn.execute(text(
+        "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = :tabla"
+    ), {"tabla": ANTIGUA})).scalars().all()
+    for indice in indices:
+        await conn.execute(text(f'ALTER INDEX "{indice}" RENAME TO "{indice}_antigua"'))
+    if secuencia:
+        await conn.execute(text(f"ALTER SEQUENCE {secuencia} RENAME TO {TABLA}_id_seq_antigua"))
+        secuencia = f"{TABLA}_id_seq_antigua"
+
+    # 3. El índice GIN compuesto necesita btree_gin
+    await conn.execute(text("CREATE EXTENSION IF NOT EXISTS btree_gin"))
+    await conn.run_sync(lambda c: models.Base.metadata.create_all(c, tables=[models.Transaccion.__table__]))
+    primera = (await conn.execute(text(f"SELECT min(fecha) FROM {ANTIGUA}"))).scalar()
+    await asegurar_particiones(conn, desde=min(primera.year, PARTICIONES_DESDE) if primera else None)
+
+    # 4.
+    copiadas = (await conn.execute(text(
+        f"INSERT INTO {TABLA} ({COLUMNAS_MIGRADAS}) SELECT {COLUMNAS_MIGRADAS} FROM {ANTIGUA}"
+    ))).rowcount
+    nueva = (await conn.execute(select(func.pg_get_serial_sequence(TABLA, "id")))).scalar()
+    if secuencia:
+        ultimo, usado = (await conn.execute(text(f"SELECT last_value, is_called FROM {secuencia}"))).one()
+        await conn.execute(select(func.setval(nueva, ultimo, usado)))
+    elif copiadas:
+        await conn.execute(text(f"SELECT setval('{nueva}', (SELECT max(id) FROM {TABLA}))"))
+
+    # 5.
+    await conn.execute(text("ALTER TABLE deudas ADD COLUMN IF NOT EXISTS transaccion_fecha date"))
+    await conn.execute(text(
+        f"UPDATE deudas SET transaccion_fecha = t.fecha FROM {ANTIGUA} t "
+        "WHERE t.id = deudas.transaccion_id AND deudas.transaccion_fecha IS NULL"
+    ))
+    await conn.execute(text("ALTER TABLE deudas ALTER COLUMN transaccion_fecha SET NOT NULL"))
+
+    # 6. Como la declara models.Deuda
+    await conn.execute(text(
+        f"ALTER TABLE deudas ADD FOREIGN KEY (transaccion_id, transaccion_fecha) "
+        f"REFERENCES {TABLA} (id, fecha) ON DELETE CASCADE ON UPDATE CASCADE"
+    ))
+
+    # 7.
+    await conn.execute(text(f"DROP TABLE {ANTIGUA}"))
+    return copiadas
+
+
+async def migrar() -> dict:
+    """Migra cada shard; devuelve las filas copiadas por shard (None: ya estaba particionado)."""
+    async with bloqueo_asesor("particiones_transacciones") as obtenido:
+        if not obtenido:
+            raise RuntimeError("Otro proceso está manteniendo las particiones")
+        resultado = {}
+        for nombre, motor in engines.items():
+            async with motor.begin() as conn:
+                resultado[nombre] = await migrar_a_particionada(conn)
+            logger.info("Shard %s: %s", nombre, resultado[nombre])
+        return resultado
+
+
+async def archivar_anio(anio: int) -> int:
+    """
+    Archiva un año cerrado: las transacciones sin deuda asociada se
+    sustituyen por totales diarios en `transacciones_resumen`. Borrado y
+    resumen ocurren en una sola sentencia, así el balance nunca cambia.
+    Devuelve la cantidad de transacciones archivadas.
+    """
+    if anio >= date.today().year:
+        raise ValueError("Solo se pueden archivar años cerrados")
+
+    T = models.Transaccion
+    R = models.ResumenTransacciones
+    sin_deuda = ~exists().where(and_(
+        models.Deuda.transaccion_id == T.id,
+        models.Deuda.transaccion_fecha == T.fecha
+    ))
+    movidas = (
+        delete(T)
+        .where(T.fecha >= date(anio, 1, 1), T.fecha < date(anio + 1, 1, 1), sin_deuda)
+        .returning(T.negocio_id, T.fecha, T.tipo, T.monto)
+        .cte("movidas")
+    )
+    resumen = select(
+        movidas.c.negocio_id,
+        movidas.c.fecha,
+        movidas.c.tipo,
+        func.sum(movidas.c.monto),
+        func.count()
+    ).group_by(movidas.c.negocio_id, movidas.c.fecha, movidas.c.tipo)
+    # El DELETE ... RETURNING debe ir en el WITH de nivel superior
+    insercion = pg_insert(R).add_cte(movidas).from_select(
+        ["negocio_id", "fecha", "tipo", "total", "cantidad"], resumen
+    )
+    insercion = insercion.on_conflict_do_update(
+        index_elements=[R.negocio_id, R.fecha, R.tipo],
+        set_={
+            "total": R.total + insercion.excluded.total,
+            "cantidad": R.cantidad + insercion.excluded.cantidad,
+        }
+    )
+
+    async with bloqueo_asesor("particiones_transacciones") as obtenido:
+        if not obtenido:
+            raise RuntimeError("Otro proceso está manteniendo las particiones")
+        archivadas = 0
+        for motor in engines.values():
+            async with motor.begin() as conn:
+                # Solo cuenta lo insertado en esta ejecución
+                antes = (await conn.execute(
+                    select(func.coalesce(func.sum(R.cantidad), 0))
+                    .where(R.fecha >= date(anio, 1, 1), R.fecha < date(anio + 1, 1, 1))
+                )).scalar()
+                await conn.execute(insercion)
+                despues = (await conn.execute(
+                    select(func.coalesce(func.sum(R.cantidad), 0))
+                    .where(R.fecha >= date(anio, 1, 1), R.fecha < date(anio + 1, 1, 1))
+                )).scalar()
+            archivadas += despues - antes
+    return archivadas
+
+
+async def _main(argumentos):
+    if argumentos[:1] == ["migrar"]:
+        for nombre, copiadas in (await migrar()).items():
+            print(f"{nombre}: " + ("ya particionada" if copiadas is None else f"{copiadas} transacciones migradas"))
+    elif argumentos[:1] == ["asegurar"]:
+        for motor in engines.values():
+            async with motor.begin() as conn:
+                await asegurar_particiones(conn)
+    elif len(argumentos) == 2 and argumentos[0] == "archivar":
+        archivadas = await archivar_anio(int(argumentos[1]))
+        print(f"Transacciones archivadas: {archivadas}")
+    else:
+        print(__doc__)
+        sys.exit(1)
+    await cerrar_engines()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main(sys.argv[1:]))
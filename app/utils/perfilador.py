@@ -0,0 +1,163 @@
+"""
+Perfilado estadístico de peticiones bajo demanda.
+
+Se activa con PERFILADOR_TOKEN (y la librería pyinstrument instalada). Una
+petición se perfila si trae la cabecera `X-Perfilar: <token>` o si cae en la
+muestra aleatoria PERFILADOR_MUESTREO. Los perfiles incluyen el tiempo en
+`await` (consultas, red) y se guardan en un anillo acotado en memoria; se
+descargan desde /perfiles en formato speedscope o "folded" (flamegraph.pl).
+
+Sin token el middleware ni siquiera se registra: costo cero.
+"""
+import hmac
+import itertools
+import os
+import random
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional
+
+from app.utils.metricas import metricas
+
+PERFILADOR_TOKEN = os.getenv("PERFILADOR_TOKEN")
+
+Profiler = None
+if PERFILADOR_TOKEN:
+    # Solo se importa si se va a usar: no encarece el arranque de cada worker
+    try:
+        from pyinstrument import Profiler
+        from pyinstrument.renderers import SpeedscopeRenderer
+    except ImportError:  # pragma: no cover
+        Profiler = None
+# Fracción de peticiones perfiladas sin cabecera (0 = solo a pedido)
+PERFILADOR_MUESTREO = float(os.getenv("PERFILADOR_MUESTREO", "0"))
+PERFILADOR_CAPACIDAD = int(os.getenv("PERFILADOR_CAPACIDAD", "50"))
+PERFILADOR_INTERVALO_MS = float(os.getenv("PERFILADOR_INTERVALO_MS", "1"))
+# Perfiles simultáneos como máximo; el resto de peticiones no se perfila
+PERFILADOR_MAX_SIMULTANEOS = int(os.getenv("PERFILADOR_MAX_SIMULTANEOS", "2"))
+
+PERFILADOR_ACTIVO = bool(PERFILADOR_TOKEN) and Profiler is not None
+
+CABECERA = b"x-perfilar"
+RUTAS_EXCLUIDAS = ("/perfiles",)
+
+
+def token_valido(valor: Optional[str]) -> bool:
+    return bool(PERFILADOR_TOKEN) and valor is not None and hmac.compare_digest(valor, PERFILADOR_TOKEN)
+
+
+@dataclass
+class Perfil:
+    id: int
+    metodo: str
+    ruta: str
+    estado: int
+    duracion_ms: float
+    fecha: float
+    sesion: Any  # pyinstrument Session
+
+    def resumen(self) -> dict:
+        return {
+            "id": self.id,
+            "metodo": self.metodo,
+            "ruta": self.ruta,
+            "estado": self.estado,
+            "duracion_ms": round(self.duracion_ms, 1),
+            "fecha": self.fecha,
+        }
+
+
+class AnilloPerfiles:
+    """Últimos N perfiles; al llenarse se descartan los más antiguos."""
+
+    def __init__(self, capacidad: int):
+        self._perfiles: Deque[Perfil] = deque(maxlen=capacidad)
+        self._ids = itertools.count(1)
+
+    def agregar(self, metodo: str, ruta: str, estado: int, duracion_ms: float, sesion) -> Perfil:
+        perfil = Perfil(next(self._ids), metodo, ruta, estado, duracion_ms, time.time(), sesion)
+        self._perfiles.append(perfil)
+        return perfil
+
+    def listar(self) -> List[dict]:
+        return [perfil.resumen() for perfil in reversed(self._perfiles)]
+
+    def obtener(self, perfil_id: int) -> Optional[Perfil]:
+        return next((perfil for perfil in self._perfiles if perfil.id == perfil_id), None)
+
+
+anillo = AnilloPerfiles(PERFILADOR_CAPACIDAD)
+
+
+def a_speedscope(perfil: Perfil) -> str:
+    return SpeedscopeRenderer().render(perfil.sesion)
+
+
+def a_folded(perfil: Perfil) -> str:
+    """Pilas "a;b;c microsegundos", una por línea (flamegraph.pl, speedscope, inferno)."""
+    lineas: Dict[str, float] = {}
+
+    def _recorrer(frame, pila: str):
+        nombre = f"{frame.function} ({frame.file_path_short}:{frame.line_no})" if frame.line_no else frame.function
+        pila = f"{pila};{nombre}" if pila else nombre
+        # El tiempo propio y el de espera ya vienen como hijos sintéticos ([self], [await])
+        if not frame.children:
+            lineas[pila] = lineas.get(pila, 0) + frame.time
+        for hijo in frame.children:
+            _recorrer(hijo, pila)
+
+    raiz = perfil.sesion.root_frame()
+    if raiz is not None:
+        _recorrer(raiz, "")
+    return "\n".join(f"{pila} {round(segundos * 1_000_000)}" for pila, segundos in lineas.items()) + "\n"
+
+
+class PerfiladorMiddleware:
+    """Perfila la petición completa (incluidas las esperas async) si se pidió o cae en la muestra."""
+
+    def __init__(self, app):
+        self.app = app
+        self.en_curso = 0
+
+    def _perfilar(self, scope) -> bool:
+        # Ni la descarga de perfiles ni los flujos SSE (duran horas) se perfilan
+        if self.en_curso >= PERFILADOR_MAX_SIMULTANEOS or scope["path"].startswith(RUTAS_EXCLUIDAS) \
+                or scope["path"].endswith("/eventos"):
+            return False
+        for nombre, valor in scope["headers"]:
+            if nombre == CABECERA:
+                return token_valido(valor.decode("latin-1"))
+        return PERFILADOR_MUESTREO > 0 and random.random() < PERFILADOR_MUESTREO
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._perfilar(scope):
+            await self.app(scope, receive, send)
+            return
+
+        estado = 500
+
+        async def _send(mensaje):
+            nonlocal estado
+            if mensaje["type"] == "http.response.start":
+                estado = mensaje["status"]
+            await send(mensaje)
+
+        self.en_curso += 1
+        perfilador = Profiler(interval=PERFILADOR_INTERVALO_MS / 1000, async_mode="enabled")
+        inicio = time.perf_counter()
+        perfilador.start()
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            sesion = perfilador.stop()
+            self.en_curso -= 1
+            ruta = scope.get("route")
+            anillo.agregar(
+                scope["method"],
+                ruta.path if ruta is not None else scope["path"],
+                estado,
+                (time.perf_counter() - inicio) * 1000,
+                sesion
+            )
+            metricas.incrementar("perfiles_capturados")
@@ -0,0 +1,113 @@
+"""
+Plazos de las consultas por clase de ruta y cancelación de las peticiones
+abandonadas.
+
+- Cada petición fija el statement_timeout de sus transacciones según su clase
+  (app/utils/admision.py); Postgres corta la consulta que lo exceda y se
+  responde 504.
+- Si el cliente se desconecta mientras una lectura o un reporte sigue en
+  curso, la petición se cancela: asyncpg envía la cancelación a Postgres y
+  la conexión vuelve al pool sin esperar a que termine la consulta. Las
+  escrituras no se cancelan, para que un reintento encuentre el resultado.
+"""
+import asyncio
+import os
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from sqlalchemy.exc import DBAPIError
+
+from app.database import plazo_sentencia_ms
+from app.utils.admision import clasificar_ruta, LECTURA, REPORTE, ESCRITURA, AUTH, RUTAS_EXENTAS, SUFIJOS_EXENTOS
+from app.utils.metricas import metricas
+
+# query_canceled: statement_timeout vencido (o cancelación explícita)
+SQLSTATE_CANCELADA = "57014"
+
+
+def _plazo_desde_env(clase: str, por_defecto: int) -> int:
+    return max(0, int(os.getenv(f"PLAZO_SENTENCIA_MS_{clase.upper()}", por_defecto)))
+
+
+# Milisegundos por sentencia; 0 desactiva el límite de la clase
+PLAZOS_POR_DEFECTO = {
+    LECTURA: _plazo_desde_env(LECTURA, 10000),
+    ESCRITURA: _plazo_desde_env(ESCRITURA, 10000),
+    REPORTE: _plazo_desde_env(REPORTE, 30000),
+    AUTH: _plazo_desde_env(AUTH, 5000),
+}
+CLASES_CANCELABLES = frozenset({LECTURA, REPORTE})
+
+
+def _etiqueta(scope) -> str:
+    ruta = scope.get("route")
+    return f"{scope['method']} {ruta.path if ruta is not None else scope['path']}"
+
+
+class PlazosMiddleware:
+    """
+    Fija el plazo de las consultas de la petición y vigila la conexión del
+    cliente: el cuerpo de la petición se sigue entregando a la aplicación a
+    través de una cola de un mensaje (sin perder la contrapresión) y un
+    http.disconnect antes de terminar la respuesta cancela la petición.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in RUTAS_EXENTAS or scope["path"].endswith(SUFIJOS_EXENTOS):
+            await self.app(scope, receive, send)
+            return
+
+        clase = clasificar_ruta(scope["method"], scope["path"])
+        plazo_sentencia_ms.set(PLAZOS_POR_DEFECTO[clase] or None)
+        if clase not in CLASES_CANCELABLES:
+            await self.app(scope, receive, send)
+            return
+
+        tarea = asyncio.current_task()
+        cola: asyncio.Queue = asyncio.Queue(maxsize=1)
+        estado = {"respondida": False, "cancelada": False}
+
+        async def _vigilar():
+            while True:
+                mensaje = await receive()
+                if mensaje["type"] == "http.disconnect":
+                    # Tras enviar la respuesta el servidor también informa
+                    # desconexión: solo cuenta si la respuesta no terminó
+                    if not estado["respondida"]:
+                        estado["cancelada"] = True
+                        tarea.cancel()
+                    if not cola.full():
+                        cola.put_nowait(mensaje)
+                    return
+                await cola.put(mensaje)
+
+        async def _send(mensaje):
+            if mensaje["type"] == "http.response.body" and not mensaje.get("more_body", False):
+                estado["respondida"] = True
+            await send(mensaje)
+
+        vigia = asyncio.create_task(_vigilar())
+        try:
+            await self.app(scope, cola.get, _send)
+        except asyncio.CancelledError:
+            if not estado["cancelada"]:
+                raise
+            # La cancelación fue nuestra: la petición termina sin respuesta
+            tarea.uncancel()
+            metricas.incrementar("peticiones_canceladas_desconexion", _etiqueta(scope))
+        finally:
+            vigia.cancel()
+
+
+async def manejar_error_bd(request: Request, exc: DBAPIError):
+    """Consulta cortada por statement_timeout: 504 y métrica por ruta; el resto de errores sigue igual."""
+    if getattr(exc.orig, "sqlstate", None) != SQLSTATE_CANCELADA:
+        raise exc
+    metricas.incrementar("sentencias_vencidas", _etiqueta(request.scope))
+    return JSONResponse(
+        status_code=504,
+        content={"detail": "La consulta excedió el tiempo máximo; acote el rango de fechas o pagine los resultados"}
+    )
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import zlib
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Iterable, Optional
+
+from sqlalchemy import select, func
+
+from app.database import engine
+
+logger = logging.getLogger(__name__)
+
+
+def clave_bloqueo(nombre: str) -> int:
+    """Clave estable (int32) para pg_advisory_lock a partir del nombre del trabajo."""
+    return zlib.crc32(nombre.encode()) & 0x7FFFFFFF
+
+
+@asynccontextmanager
+async def bloqueo_asesor(nombre: str):
+    """
+    Intenta tomar un advisory lock de sesión en Postgres sin esperar.
+
+    Entrega True si este proceso obtuvo el bloqueo (y por tanto debe ejecutar
+    el trabajo) o False si otro worker ya lo tiene. El bloqueo vive en una
+    conexión dedicada que se libera al salir del bloque.
+    """
+    clave = clave_bloqueo(nombre)
+    async with engine.connect() as conn:
+        obtenido = bool((await conn.execute(select(func.pg_try_advisory_lock(clave)))).scalar())
+        # Cerramos la transacción para no dejar la conexión "idle in transaction"
+        await conn.commit()
+        try:
+            yield obtenido
+        finally:
+            if obtenido:
+                await conn.execute(select(func.pg_advisory_unlock(clave)))
+                await conn.commit()
+
+
+def iniciar_tarea_periodica(
+        nombre: str,
+        intervalo_segundos: float,
+        funcion: Callable[[], Awaitable[None]],
+        retraso_inicial: Optional[float] = None
+) -> asyncio.Task:
+    """Ejecuta `funcion` cada `intervalo_segundos` en segundo plano hasta que se cancele."""
+
+    async def _bucle():
+        await asyncio.sleep(intervalo_segundos if retraso_inicial is None else retraso_inicial)
+        while True:
+            try:
+                await funcion()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Fallo en la tarea periódica %s", nombre)
+            await asyncio.sleep(intervalo_segundos)
+
+    return asyncio.create_task(_bucle(), name=nombre)
+
+
+async def detener_tareas(tareas: Iterable[asyncio.Task]):
+    tareas = list(tareas)
+    for tarea in tareas:
+        tarea.cancel()
+    await asyncio.gather(*tareas, return_exceptions=True)
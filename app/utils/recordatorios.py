@@ -0,0 +1,174 @@
+import html
+import logging
+import os
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, List, Set
+
+from sqlalchemy import select, literal_column
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import models
+from app.database import engines, sesion_en_shard
+from app.utils.programador import bloqueo_asesor
+from app.utils.telegram import EmisorTelegram, TELEGRAM_BOT_TOKEN, TELEGRAM_MAX_CARACTERES
+
+logger = logging.getLogger(__name__)
+
+# Cada cuánto se revisan las deudas abiertas (0 desactiva el trabajo)
+RECORDATORIOS_INTERVALO_MINUTOS = int(os.getenv("RECORDATORIOS_INTERVALO_MINUTOS", "1440"))
+# Antigüedad a partir de la cual una deuda pendiente/parcial se considera vencida
+RECORDATORIOS_DIAS_VENCIDA = int(os.getenv("RECORDATORIOS_DIAS_VENCIDA", "30"))
+RECORDATORIOS_TAMANO_LOTE = int(os.getenv("RECORDATORIOS_TAMANO_LOTE", "1000"))
+# Deudas listadas por negocio en cada resumen; el resto solo suma al total
+RECORDATORIOS_MAX_LINEAS = 15
+
+RECORDATORIOS_ACTIVOS = bool(TELEGRAM_BOT_TOKEN) and RECORDATORIOS_INTERVALO_MINUTOS > 0
+
+
+@dataclass
+class _ResumenNegocio:
+    nombre: str
+    cantidad: int = 0
+    total_pendiente: Decimal = Decimal("0.00")
+    lineas: List[str] = field(default_factory=list)
+
+
+async def _leer_lote(db: AsyncSession, desde_id: int, vencidas_antes_de: datetime):
+    """Siguiente bloque de deudas abiertas vencidas, recorrido por id (índice ix_deudas_abiertas)."""
+    result = await db.execute(
+        select(
+            models.Deuda.id,
+            models.Deuda.monto_total,
+            models.Deuda.monto_pagado,
+            models.Deuda.created_at,
+            models.Cliente.nombre,
+            models.Cliente.negocio_id
+        )
+        .join(models.Cliente, models.Cliente.id == models.Deuda.cliente_id)
+        .where(
+            models.Deuda.id > desde_id,
+            # Literal (no parámetro) para que el planificador use el índice parcial
+            models.Deuda.estado != literal_column("'saldado'"),
+            models.Deuda.created_at <= vencidas_antes_de
+        )
+        .order_by(models.Deuda.id)
+        .limit(RECORDATORIOS_TAMANO_LOTE)
+    )
+    return result.all()
+
+
+async def _responsables(db: AsyncSession, negocio_ids: Set[int], shard: str):
+    """
+    Nombre del negocio y chats de Telegram de sus usuarios, solo si el negocio
+    está alojado en `shard` (durante un traslado sus deudas están en dos).
+    """
+    result = await db.execute(
+        select(models.Negocio.id, models.Negocio.nombre, models.Usuario.telegram_chat_id)
+        .join(models.usuarios_negocios, models.usuarios_negocios.c.negocio_id == models.Negocio.id)
+        .join(models.Usuario, models.Usuario.id == models.usuarios_negocios.c.usuario_id)
+        .where(
+            models.Negocio.id.in_(negocio_ids),
+            models.Negocio.shard == shard,
+            models.Usuario.telegram_chat_id.isnot(None),
+            models.Usuario.activo.isnot(False)
+        )
+    )
+    return result.all()
+
+
+def _formatear_resumen(negocios: List[_ResumenNegocio]) -> str:
+    # (línea, deudas que representa): cada línea es HTML completo por sí misma
+    partes = [("⏰ <b>Deudas vencidas pendientes de cobro</b>", 0)]
+    for negocio in negocios:
+        partes.append((
+            f"\n<b>{html.escape(negocio.nombre)}</b> — {negocio.cantidad} deuda(s), "
+            f"total ${negocio.total_pendiente}",
+            0
+        ))
+        partes.extend((linea, 1) for linea in negocio.lineas)
+        if negocio.cantidad > len(negocio.lineas):
+            restantes = negocio.cantidad - len(negocio.lineas)
+            partes.append((f"… y {restantes} más", restantes))
+    mensaje = "\n".join(texto for texto, _ in partes)
+    if len(mensaje) <= TELEGRAM_MAX_CARACTERES:
+        return mensaje
+
+    # Se corta en líneas enteras (nunca dentro de una etiqueta o entidad) y
+    # se reserva lugar para la cola con las deudas que quedaron fuera
+    total = sum(deudas for _, deudas in partes)
+    disponible = TELEGRAM_MAX_CARACTERES - len(f"\n… y {total} deuda(s) más")
+    incluidas, largo = 0, -1
+    for texto, _ in partes:
+        if largo + 1 + len(texto) > disponible:
+            break
+        largo += 1 + len(texto)
+        incluidas += 1
+    omitidas = sum(deudas for _, deudas in partes[incluidas:])
+    lineas = [texto for texto, _ in partes[:incluidas]]
+    lineas.append(f"… y {omitidas} deuda(s) más")
+    return "\n".join(lineas)
+
+
+async def enviar_recordatorios():
+    """
+    Recorre las deudas abiertas vencidas por lotes y envía un único resumen
+    por chat de Telegram, agrupado por negocio.
+    """
+    async with bloqueo_asesor("recordatorios_deudas") as obtenido:
+        if not obtenido:
+            # Otro worker ya está enviando los recordatorios
+            return
+
+        vencidas_antes_de = datetime.utcnow() - timedelta(days=RECORDATORIOS_DIAS_VENCIDA)
+        por_negocio: Dict[int, _ResumenNegocio] = {}
+        por_chat: Dict[str, Set[int]] = {}
+
+        # Deudas de cada shard; los responsables salen del directorio
+        for shard in engines:
+            consultados: Set[int] = set()
+            async with sesion_en_shard(shard) as db:
+                ultimo_id = 0
+                while True:
+                    lote = await _leer_lote(db, ultimo_id, vencidas_antes_de)
+                    if not lote:
+                        break
+                    ultimo_id = lote[-1].id
+
+                    nuevos = {fila.negocio_id for fila in lote} - consultados
+                    if nuevos:
+                        consultados |= nuevos
+                        for negocio_id, nombre, chat_id in await _responsables(db, nuevos, shard):
+                            por_negocio.setdefault(negocio_id, _ResumenNegocio(nombre=nombre))
+                            por_chat.setdefault(chat_id, set()).add(negocio_id)
+
+                    for fila in lote:
+                        resumen = por_negocio.get(fila.negocio_id)
+                        if resumen is None:
+                            # Negocio sin usuarios con Telegram configurado
+                            continue
+                        saldo = fila.monto_total - fila.monto_pagado
+                        resumen.cantidad += 1
+                        resumen.total_pendiente += saldo
+                        if len(resumen.lineas) < RECORDATORIOS_MAX_LINEAS:
+                            resumen.lineas.append(
+                                f"• {html.escape(fila.nombre)}: ${saldo} (desde {fila.created_at:%Y-%m-%d})"
+                            )
+
+                    # Liberamos la conexión entre lotes
+                    await db.commit()
+
+        enviados = 0
+        async with EmisorTelegram() as emisor:
+            for chat_id, negocio_ids in por_chat.items():
+                negocios = [por_negocio[n] for n in sorted(negocio_ids) if por_negocio[n].cantidad]
+                if not negocios:
+                    continue
+                try:
+                    if await emisor.enviar(chat_id, _formatear_resumen(negocios)):
+                        enviados += 1
+                except Exception:
+                    logger.exception("No se pudo enviar el recordatorio al chat %s", chat_id)
+
+        logger.info("Recordatorios de deudas enviados: %s chats", enviados)
@@ -0,0 +1,269 @@
+"""
+Respaldo y restauración de un solo negocio con COPY de Postgres.
+
+Uso desde la línea de comandos:
+    python -m app.utils.respaldos exportar <negocio_id> <archivo>
+    python -m app.utils.respaldos restaurar <archivo> --usuario <id> [--nombre NOMBRE]
+    python -m app.utils.respaldos restaurar <archivo> --negocio <id>
+
+`exportar` vuelca clientes, transacciones (y su resumen archivado), deudas
+y abonos desde una misma instantánea, en COPY binario y comprimido con gzip.
+`restaurar` crea un negocio nuevo para el usuario (clonar) o reemplaza el
+contenido de uno existente (deshacer una edición masiva). Carga las filas
+en tablas temporales y las inserta con ids nuevos de las secuencias, todo
+en una sola transacción.
+
+Formato del archivo (gzip):
+    línea MAGIA, línea JSON del manifiesto (versión, negocio, tablas y columnas),
+    por cada tabla bloques "longitud (4 bytes) + datos COPY" terminados en un
+    bloque vacío, y una línea JSON final con las filas de cada tabla.
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import os
+import struct
+import time
+from datetime import datetime
+from typing import AsyncIterator, BinaryIO, Dict, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+from app import crud, models, schemas
+from app.database import engine, engines, async_session_maker, cerrar_engines
+from app.utils import borrado
+from app.utils.programador import bloqueo_asesor
+from app.utils.shards import tablas_del_negocio, TABLAS_CON_SECUENCIA
+
+logger = logging.getLogger(__name__)
+
+MAGIA = b"GESTOR-NEGOCIOS-RESPALDO\n"
+VERSION = 1
+# gzip: 1 es el más rápido; subir si importa más el tamaño que el tiempo
+RESPALDOS_COMPRESION = int(os.getenv("RESPALDOS_COMPRESION", "1"))
+
+_LONGITUD = struct.Struct(">I")
+# Columna -> tabla cuyo id referencia (se traduce al id nuevo al restaurar)
+_REFERENCIAS = {"cliente_id": "clientes", "transaccion_id": "transacciones", "deuda_id": "deudas"}
+
+
+def _columnas(tabla) -> List[str]:
+    # Las columnas generadas (saldo_pendiente, busqueda) las recalcula Postgres
+    return [c.name for c in tabla.columns if c.computed is None]
+
+
+def _sql(consulta) -> str:
+    return str(consulta.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+
+
+async def _negocio(negocio_id: int) -> Optional[dict]:
+    async with engine.connect() as conn:
+        fila = (await conn.execute(
+            select(models.Negocio.__table__).where(
+                models.Negocio.id == negocio_id, models.Negocio.eliminado_en.is_(None)
+            )
+        )).mappings().first()
+    return dict(fila) if fila is not None else None
+
+
+async def exportar(negocio_id: int, destino: BinaryIO) -> Dict[str, int]:
+    """Escribe el respaldo del negocio en `destino` (abierto en binario); devuelve filas por tabla."""
+    negocio = await _negocio(negocio_id)
+    if negocio is None:
+        raise ValueError(f"Negocio {negocio_id} no encontrado")
+    tablas = tablas_del_negocio(negocio_id)
+    manifiesto = {
+        "version": VERSION,
+        "creado_en": datetime.utcnow().isoformat(),
+        "negocio": {
+            "id": negocio_id,
+            "nombre": negocio["nombre"],
+            "descripcion": negocio["descripcion"],
+            "fecha_creacion": negocio["fecha_creacion"].isoformat(),
+        },
+        "tablas": [{"nombre": tabla.name, "columnas": _columnas(tabla)} for tabla, _ in tablas],
+    }
+
+    with gzip.GzipFile(fileobj=destino, mode="wb", compresslevel=RESPALDOS_COMPRESION) as archivo:
+        archivo.write(MAGIA)
+        archivo.write(json.dumps(manifiesto).encode() + b"\n")
+
+        async def _escribir(datos: bytes):
+            archivo.write(_LONGITUD.pack(len(datos)))
+            archivo.write(datos)
+
+        filas: Dict[str, int] = {}
+        async with engines[negocio["shard"]].connect() as conn:
+            pg = (await conn.get_raw_connection()).driver_connection
+            # Una sola instantánea para todas las tablas: el respaldo es coherente
+            async with pg.transaction(isolation="repeatable_read", readonly=True):
+                for tabla, filtro in tablas:
+                    columnas = [tabla.c[nombre] for nombre in _columnas(tabla)]
+                    estado = await pg.copy_from_query(
+                        _sql(select(*columnas).where(filtro)), output=_escribir, format="binary"
+                    )
+                    archivo.write(_LONGITUD.pack(0))
+                    filas[tabla.name] = int(estado.split()[-1])
+        archivo.write(json.dumps({"filas": filas}).encode() + b"\n")
+    return filas
+
+
+def _leer_exacto(archivo, cantidad: int) -> bytes:
+    datos = archivo.read(cantidad)
+    if len(datos) != cantidad:
+        raise ValueError("Respaldo truncado")
+    return datos
+
+
+async def _bloques(archivo) -> AsyncIterator[bytes]:
+    """Datos COPY de una tabla, bloque a bloque, hasta el bloque vacío."""
+    while True:
+        longitud, = _LONGITUD.unpack(_leer_exacto(archivo, _LONGITUD.size))
+        if longitud == 0:
+            return
+        yield _leer_exacto(archivo, longitud)
+
+
+def _leer_manifiesto(archivo) -> dict:
+    if archivo.readline() != MAGIA:
+        raise ValueError("No es un respaldo de negocio")
+    manifiesto = json.loads(archivo.readline())
+    if manifiesto.get("version", 0) > VERSION:
+        raise ValueError(f"Versión de respaldo no soportada: {manifiesto.get('version')}")
+    # Los nombres de tablas y columnas se usan en SQL: solo se aceptan los del esquema actual
+    conocidas = {tabla.name: set(_columnas(tabla)) for tabla, _ in tablas_del_negocio(0)}
+    for tabla in manifiesto["tablas"]:
+        if tabla["nombre"] not in conocidas or not set(tabla["columnas"]) <= conocidas[tabla["nombre"]]:
+            raise ValueError(f"El respaldo no coincide con el esquema actual ({tabla['nombre']})")
+    return manifiesto
+
+
+def _insercion(tabla: str, columnas: List[str], negocio_id: int) -> str:
+    """INSERT ... SELECT desde la tabla temporal con ids nuevos y referencias traducidas."""
+    valores = []
+    uniones = []
+    if "id" in columnas and tabla in TABLAS_CON_SECUENCIA:
+        uniones.append(f"JOIN mapa_{tabla} m ON m.viejo = i.id")
+    for columna in columnas:
+        if columna == "id" and tabla in TABLAS_CON_SECUENCIA:
+            valores.append("m.nuevo")
+        elif columna == "negocio_id":
+            valores.append(str(int(negocio_id)))
+        elif columna in _REFERENCIAS:
+            alias = f"r_{columna}"
+            uniones.append(f"JOIN mapa_{_REFERENCIAS[columna]} {alias} ON {alias}.viejo = i.{columna}")
+            valores.append(f"{alias}.nuevo")
+        else:
+            valores.append(f"i.{columna}")
+    return (
+        f"INSERT INTO {tabla} ({', '.join(columnas)}) "
+        f"SELECT {', '.join(valores)} FROM imp_{tabla} i {' '.join(uniones)}"
+    )
+
+
+async def _cargar(pg, archivo, manifiesto: dict, negocio_id: int, reemplazar: bool) -> Dict[str, int]:
+    """Carga el respaldo en el negocio dentro de la transacción abierta en `pg`."""
+    if reemplazar:
+        # Las transacciones se llevan sus deudas y abonos (ON DELETE CASCADE)
+        for tabla in ("transacciones", "clientes", "transacciones_resumen"):
+            await pg.execute(f"DELETE FROM {tabla} WHERE negocio_id = $1", negocio_id)
+
+    copiadas: Dict[str, int] = {}
+    for tabla in manifiesto["tablas"]:
+        nombre, columnas = tabla["nombre"], tabla["columnas"]
+        await pg.execute(
+            f"CREATE TEMP TABLE imp_{nombre} ON COMMIT DROP AS "
+            f"SELECT {', '.join(columnas)} FROM {nombre} WITH NO DATA"
+        )
+        estado = await pg.copy_to_table(f"imp_{nombre}", source=_bloques(archivo), columns=columnas, format="binary")
+        copiadas[nombre] = int(estado.split()[-1])
+    if json.loads(archivo.readline())["filas"] != copiadas:
+        raise ValueError("El respaldo está incompleto: las filas no coinciden con el manifiesto")
+
+    insertadas: Dict[str, int] = {}
+    # Ids nuevos de las secuencias del shard; las referencias se traducen con estos mapas
+    for nombre in [t["nombre"] for t in manifiesto["tablas"] if t["nombre"] in TABLAS_CON_SECUENCIA]:
+        await pg.execute(
+            f"CREATE TEMP TABLE mapa_{nombre} ON COMMIT DROP AS "
+            f"SELECT id AS viejo, nextval(pg_get_serial_sequence('{nombre}', 'id'))::int AS nuevo FROM imp_{nombre}"
+        )
+        await pg.execute(f"CREATE UNIQUE INDEX ON mapa_{nombre} (viejo)")
+        await pg.execute(f"ANALYZE mapa_{nombre}")
+    for tabla in manifiesto["tablas"]:
+        estado = await pg.execute(_insercion(tabla["nombre"], tabla["columnas"], negocio_id))
+        insertadas[tabla["nombre"]] = int(estado.split()[-1])
+    return insertadas
+
+
+async def restaurar(origen: BinaryIO, negocio_id: Optional[int] = None, usuario_id: Optional[int] = None,
+                    nombre: Optional[str] = None) -> dict:
+    """
+    Restaura el respaldo en el negocio `negocio_id` (reemplazando su
+    contenido) o, si no se indica, en un negocio nuevo del usuario `usuario_id`.
+    """
+    with gzip.GzipFile(fileobj=origen, mode="rb") as archivo:
+        manifiesto = _leer_manifiesto(archivo)
+        reemplazar = negocio_id is not None
+        if not reemplazar:
+            async with async_session_maker() as db:
+                nuevo = await crud.create_negocio(db, schemas.NegocioCreate(
+                    nombre=nombre or manifiesto["negocio"]["nombre"],
+                    descripcion=manifiesto["negocio"]["descripcion"]
+                ), usuario_id)
+            negocio_id = nuevo.id
+
+        try:
+            # Mismo bloqueo que el borrado y el traslado entre shards
+            async with bloqueo_asesor(f"borrado_negocio_{negocio_id}") as obtenido:
+                if not obtenido:
+                    raise RuntimeError("Otro proceso está borrando o trasladando este negocio")
+                negocio = await _negocio(negocio_id)
+                if negocio is None or negocio["migrando"]:
+                    raise ValueError(f"Negocio {negocio_id} no disponible")
+                async with engines[negocio["shard"]].connect() as conn:
+                    pg = (await conn.get_raw_connection()).driver_connection
+                    async with pg.transaction():
+                        filas = await _cargar(pg, archivo, manifiesto, negocio_id, reemplazar)
+        except BaseException:
+            if not reemplazar:
+                # El negocio recién creado quedaría vacío: se elimina (ya sin el bloqueo)
+                await borrado.ejecutar_borrado(negocio_id)
+            raise
+    return {"negocio_id": negocio_id, "origen": manifiesto["negocio"]["id"], "filas": filas}
+
+
+async def _main(argumentos):
+    parser = argparse.ArgumentParser(description="Respaldo y restauración de un negocio")
+    comandos = parser.add_subparsers(dest="comando", required=True)
+    exportacion = comandos.add_parser("exportar", help="vuelca un negocio a un archivo")
+    exportacion.add_argument("negocio_id", type=int)
+    exportacion.add_argument("archivo")
+    restauracion = comandos.add_parser("restaurar", help="carga un archivo en un negocio")
+    restauracion.add_argument("archivo")
+    objetivo = restauracion.add_mutually_exclusive_group(required=True)
+    objetivo.add_argument("--negocio", type=int, help="negocio existente cuyo contenido se reemplaza")
+    objetivo.add_argument("--usuario", type=int, help="crea un negocio nuevo para este usuario")
+    restauracion.add_argument("--nombre", help="nombre del negocio nuevo (por defecto el del respaldo)")
+    opciones = parser.parse_args(argumentos)
+
+    inicio = time.perf_counter()
+    if opciones.comando == "exportar":
+        with open(opciones.archivo, "wb") as archivo:
+            filas = await exportar(opciones.negocio_id, archivo)
+        print(f"filas: {filas}")
+    else:
+        with open(opciones.archivo, "rb") as archivo:
+            resultado = await restaurar(archivo, opciones.negocio, opciones.usuario, opciones.nombre)
+        for clave, valor in resultado.items():
+            print(f"{clave}: {valor}")
+    print(f"segundos: {time.perf_counter() - inicio:.1f}")
+    await cerrar_engines()
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main(sys.argv[1:]))
@@ -0,0 +1,103 @@
+import gzip
+import json
+import os
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Type
+
+from fastapi import HTTPException, Request, Response
+from pydantic import BaseModel, TypeAdapter
+
+# Formatos opcionales: si la librería no está instalada se responde en JSON / gzip
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+# Respuestas más pequeñas que esto no compensan el costo de comprimir
+UMBRAL_COMPRESION = int(os.getenv("UMBRAL_COMPRESION_BYTES", "1024"))
+
+TIPOS_MSGPACK = ("application/msgpack", "application/x-msgpack")
+
+_adaptadores: Dict[Tuple[type, str], TypeAdapter] = {}
+
+
+def campos_solicitados(fields: Optional[str], esquema: Type[BaseModel]) -> Optional[List[str]]:
+    """Valida el parámetro `fields=a,b,c` contra los campos del esquema de salida."""
+    if not fields:
+        return None
+    campos = list(dict.fromkeys(c.strip() for c in fields.split(",") if c.strip()))
+    desconocidos = [c for c in campos if c not in esquema.model_fields]
+    if desconocidos:
+        raise HTTPException(status_code=400, detail=f"Campos desconocidos: {', '.join(desconocidos)}")
+    return campos or None
+
+
+def _adaptador(esquema: Type[BaseModel], campo: str) -> TypeAdapter:
+    clave = (esquema, campo)
+    if clave not in _adaptadores:
+        _adaptadores[clave] = TypeAdapter(esquema.model_fields[campo].annotation)
+    return _adaptadores[clave]
+
+
+def serializar(objetos: Iterable[Any], esquema: Type[BaseModel], campos: Optional[List[str]] = None) -> List[dict]:
+    """Convierte objetos ORM (o dicts) a JSON nativo, solo con `campos` si se indican."""
+    if campos is None:
+        return [esquema.model_validate(obj).model_dump(mode="json") for obj in objetos]
+
+    adaptadores = [(campo, _adaptador(esquema, campo)) for campo in campos]
+    filas = []
+    for obj in objetos:
+        fila = {}
+        for campo, adaptador in adaptadores:
+            valor = obj[campo] if isinstance(obj, dict) else getattr(obj, campo)
+            fila[campo] = adaptador.dump_python(adaptador.validate_python(valor, from_attributes=True), mode="json")
+        filas.append(fila)
+    return filas
+
+
+def _codificaciones_aceptadas(cabecera: str) -> set:
+    aceptadas = set()
+    for parte in cabecera.split(","):
+        nombre, _, parametros = parte.strip().partition(";")
+        if parametros.replace(" ", "") in ("q=0", "q=0.0"):
+            continue
+        aceptadas.add(nombre.strip().lower())
+    return aceptadas
+
+
+def codificar(datos: Any, accept: str = "", accept_encoding: str = "") -> Tuple[bytes, Dict[str, str]]:
+    """Serializa `datos` según Accept (JSON o MessagePack) y los comprime según Accept-Encoding."""
+    cabeceras = {"Vary": "Accept, Accept-Encoding"}
+    if msgpack is not None and any(tipo in accept for tipo in TIPOS_MSGPACK):
+        cuerpo = msgpack.packb(datos)
+        cabeceras["Content-Type"] = "application/msgpack"
+    else:
+        cuerpo = json.dumps(datos, ensure_ascii=False, separators=(",", ":")).encode()
+        cabeceras["Content-Type"] = "application/json"
+
+    if len(cuerpo) >= UMBRAL_COMPRESION:
+        aceptadas = _codificaciones_aceptadas(accept_encoding)
+        if brotli is not None and "br" in aceptadas:
+            cuerpo = brotli.compress(cuerpo, quality=4)
+            cabeceras["Content-Encoding"] = "br"
+        elif "gzip" in aceptadas:
+            cuerpo = gzip.compress(cuerpo, compresslevel=5)
+            cabeceras["Content-Encoding"] = "gzip"
+    return cuerpo, cabeceras
+
+
+def responder(request: Request, datos: Any) -> Response:
+    """Respuesta compacta para listados: negocia formato y compresión con el cliente."""
+    cuerpo, cabeceras = codificar(
+        datos,
+        request.headers.get("accept", ""),
+        request.headers.get("accept-encoding", "")
+    )
+    return Response(content=cuerpo, media_type=cabeceras.pop("Content-Type"), headers=cabeceras)
@@ -0,0 +1,167 @@
+import hashlib
+import logging
+import math
+import os
+from datetime import datetime
+from typing import Iterable, Optional, Set
+
+from sqlalchemy import select, delete, event, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app import models
+from app.database import async_session_maker, SesionEnrutada
+from app.utils.metricas import metricas
+
+logger = logging.getLogger(__name__)
+
+# Cantidad esperada de tokens revocados vigentes y tasa de falsos positivos del filtro
+REVOCACION_CAPACIDAD = int(os.getenv("REVOCACION_CAPACIDAD", "100000"))
+REVOCACION_ERROR = float(os.getenv("REVOCACION_ERROR", "0.001"))
+# Canal por el que cada worker avisa a los demás de las revocaciones confirmadas
+CANAL_REVOCACION = "tokens_revocados"
+
+
+class FiltroBloom:
+    """Filtro de Bloom sobre un bytearray: sin falsos negativos, pocos falsos positivos."""
+
+    def __init__(self, capacidad: int, error: float):
+        self.bits = max(8, int(-capacidad * math.log(error) / (math.log(2) ** 2)))
+        self.funciones = max(1, round(self.bits / capacidad * math.log(2)))
+        self._datos = bytearray((self.bits + 7) // 8)
+
+    def _posiciones(self, valor: str):
+        # Doble hashing: k posiciones a partir de dos enteros de 64 bits
+        digest = hashlib.blake2b(valor.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.funciones):
+            yield (h1 + i * h2) % self.bits
+
+    def agregar(self, valor: str):
+        for posicion in self._posiciones(valor):
+            self._datos[posicion >> 3] |= 1 << (posicion & 7)
+
+    def contiene(self, valor: str) -> bool:
+        return all(self._datos[posicion >> 3] & (1 << (posicion & 7)) for posicion in self._posiciones(valor))
+
+
+class RegistroRevocados:
+    """
+    Identificadores revocados en memoria. El filtro de Bloom descarta casi
+    todos los tokens válidos sin tocar el conjunto; el conjunto confirma los
+    positivos, así nunca se rechaza un token por un falso positivo.
+    """
+
+    def __init__(self, capacidad: int, error: float):
+        self.capacidad = capacidad
+        self.error = error
+        self._filtro = FiltroBloom(capacidad, error)
+        self._revocados: Set[str] = set()
+        # Fecha del último registro leído de la tabla (sincronización incremental)
+        self.sincronizado_hasta: Optional[datetime] = None
+        metricas.registrar_medidor("tokens_revocados", lambda: len(self._revocados))
+
+    def agregar(self, identificador: str):
+        if identificador not in self._revocados:
+            self._revocados.add(identificador)
+            self._filtro.agregar(identificador)
+
+    def contiene(self, identificador: str) -> bool:
+        if not self._filtro.contiene(identificador):
+            return False
+        return identificador in self._revocados
+
+    def reconstruir(self, identificadores: Iterable[str]):
+        """Reemplaza el contenido; el filtro crece si se superó la capacidad prevista."""
+        identificadores = set(identificadores)
+        capacidad = max(self.capacidad, 2 * len(identificadores))
+        filtro = FiltroBloom(capacidad, self.error)
+        for identificador in identificadores:
+            filtro.agregar(identificador)
+        self._filtro, self._revocados = filtro, identificadores
+
+
+registro = RegistroRevocados(REVOCACION_CAPACIDAD, REVOCACION_ERROR)
+
+
+async def revocar(db, identificador: str, usuario_id: int, expira_en: datetime) -> bool:
+    """
+    Guarda `identificador` como revocado. Devuelve False si ya lo estaba: la
+    clave primaria resuelve la carrera entre workers con una sola escritura.
+    No confirma la transacción; el registro en memoria se actualiza al confirmar.
+    """
+    result = await db.execute(
+        pg_insert(models.TokenRevocado)
+        .values(identificador=identificador, usuario_id=usuario_id, expira_en=expira_en,
+                created_at=datetime.utcnow())
+        .on_conflict_do_nothing(index_elements=[models.TokenRevocado.identificador])
+        .returning(models.TokenRevocado.identificador)
+    )
+    db.info.setdefault("tokens_revocados", set()).add(identificador)
+    return result.scalar_one_or_none() is not None
+
+
+@event.listens_for(SesionEnrutada, "before_commit")
+def _notificar_revocacion(sesion):
+    # En la misma transacción: los demás workers lo reciben solo si se confirma
+    revocados = sesion.info.get("tokens_revocados")
+    if revocados:
+        sesion.execute(select(func.pg_notify(CANAL_REVOCACION, ",".join(sorted(revocados)))))
+
+
+def recibir_revocados(payload: str):
+    """Agrega al registro los identificadores recibidos por NOTIFY (app/utils/eventos.py)."""
+    for identificador in payload.split(","):
+        registro.agregar(identificador)
+
+
+@event.listens_for(SesionEnrutada, "after_commit")
+def _al_confirmar(sesion):
+    for identificador in sesion.info.pop("tokens_revocados", ()):
+        registro.agregar(identificador)
+
+
+@event.listens_for(SesionEnrutada, "after_rollback")
+def _al_descartar(sesion):
+    # Si la transacción no se confirma el token sigue siendo válido
+    sesion.info.pop("tokens_revocados", None)
+
+
+async def cargar_revocados():
+    """Reconstruye el registro con los tokens revocados que aún no vencieron."""
+    ahora = datetime.utcnow()
+    async with async_session_maker() as db:
+        result = await db.execute(
+            select(models.TokenRevocado.identificador, models.TokenRevocado.created_at)
+            .where(models.TokenRevocado.expira_en > ahora)
+        )
+        filas = result.all()
+    registro.reconstruir(fila.identificador for fila in filas)
+    registro.sincronizado_hasta = max((fila.created_at for fila in filas), default=ahora)
+    logger.info("Registro de tokens revocados cargado: %s", len(filas))
+
+
+async def sincronizar_revocados():
+    """
+    Agrega al registro las revocaciones hechas por otros workers. Cubre lo
+    que no llegó por NOTIFY (reconexiones del LISTEN).
+    """
+    if registro.sincronizado_hasta is None:
+        await cargar_revocados()
+        return
+    async with async_session_maker() as db:
+        result = await db.execute(
+            select(models.TokenRevocado.identificador, models.TokenRevocado.created_at)
+            .where(models.TokenRevocado.created_at >= registro.sincronizado_hasta)
+        )
+        for fila in result:
+            registro.agregar(fila.identificador)
+            registro.sincronizado_hasta = max(registro.sincronizado_hasta, fila.created_at)
+
+
+async def purgar_revocados_vencidos():
+    """Borra los tokens vencidos y reconstruye el filtro (un Bloom no admite borrados)."""
+    async with async_session_maker() as db:
+        await db.execute(delete(models.TokenRevocado).where(models.TokenRevocado.expira_en <= datetime.utcnow()))
+        await db.commit()
+    await cargar_revocados()
@@ -0,0 +1,340 @@
+"""
+Shards de datos de negocio: preparación y traslado de negocios entre shards.
+
+El directorio (DATABASE_URL) guarda usuarios, membresías y negocios, y en
+`Negocio.shard` dónde viven los clientes, transacciones y deudas de cada
+uno. Los shards se configuran con DB_SHARDS (ver app/database.py).
+
+Uso desde la línea de comandos:
+    python -m app.utils.shards preparar
+    python -m app.utils.shards listar
+    python -m app.utils.shards mover <negocio_id> <shard_destino>
+
+`mover` traslada un negocio sin detener la aplicación: copia sus filas por
+lotes mientras sigue en uso, después lo bloquea para copiar lo que cambió
+durante la copia (según el xmin de cada fila), apunta el directorio al nuevo
+shard y por último borra las filas del shard de origen.
+
+El bloqueo es el advisory lock (CLAVE_TRASLADO, negocio_id) del shard de
+origen: cada escritura de app/crud.py lo toma compartido en su transacción y
+vuelve a leer el directorio; el traslado lo toma en exclusiva tras marcar el
+negocio como migrando, con lo que espera a las escrituras en curso, y lo
+mantiene hasta cambiar el directorio.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from typing import Optional
+
+from sqlalchemy import select, update, delete, func, text, tuple_, literal, Table
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from app import models
+from app.crud import CLAVE_TRASLADO
+from app.database import engine, engines, SHARD_PRINCIPAL, BLOQUE_IDS, indice_shard, cerrar_engines
+from app.utils import borrado, particiones
+from app.utils.metricas import metricas
+from app.utils.programador import bloqueo_asesor
+
+logger = logging.getLogger(__name__)
+
+# Filas por lote al copiar (cada fila usa un parámetro por columna; asyncpg admite 32767)
+SHARDS_LOTE_COPIA = int(os.getenv("SHARDS_LOTE_COPIA", "2000"))
+
+# Tablas con id propio de secuencia: cada shard numera en su rango
+TABLAS_CON_SECUENCIA = ("clientes", "transacciones", "deudas", "abonos")
+
+# Cambios en tablas que ya existían, que create_all no aplica. Idempotentes;
+# la conversión de transacciones en particionada es aparte
+# (python -m app.utils.particiones migrar, antes de preparar)
+AJUSTES_DE_ESQUEMA = (
+    # Saldo pendiente calculado por Postgres (antes era una propiedad en Python)
+    "ALTER TABLE deudas ADD COLUMN IF NOT EXISTS saldo_pendiente numeric(12, 2) "
+    "GENERATED ALWAYS AS (monto_total - monto_pagado) STORED",
+    "DROP INDEX IF EXISTS ix_deudas_saldo",
+    "CREATE INDEX IF NOT EXISTS ix_deudas_cliente_saldo ON deudas (cliente_id, saldo_pendiente, id)",
+    # Progreso de los borrados en la fila del negocio (app/utils/borrado.py)
+    "ALTER TABLE negocios ADD COLUMN IF NOT EXISTS borrado_por integer",
+    "ALTER TABLE negocios ADD COLUMN IF NOT EXISTS borrado_etapa varchar(30)",
+    "ALTER TABLE negocios ADD COLUMN IF NOT EXISTS borrado_filas bigint NOT NULL DEFAULT 0",
+    "ALTER TABLE negocios ADD COLUMN IF NOT EXISTS borrado_fin timestamp",
+)
+
+
+async def preparar_esquema(conn: AsyncConnection):
+    """Extensiones, tablas, ajustes y particiones de una base (directorio o shard). Es idempotente."""
+    # Extensiones usadas por los índices (GIN compuesto por negocio, trigramas)
+    await conn.execute(text("CREATE EXTENSION IF NOT EXISTS btree_gin"))
+    await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    await conn.run_sync(models.Base.metadata.create_all)
+    for sentencia in AJUSTES_DE_ESQUEMA:
+        await conn.execute(text(sentencia))
+    await particiones.asegurar_particiones(conn)
+
+
+async def asegurar_secuencias():
+    """
+    Cada shard i numera en [i * BLOQUE_IDS, (i + 1) * BLOQUE_IDS): sus
+    secuencias se llevan al inicio del rango si aún no llegaron y su MAXVALUE
+    se fija al final, así Postgres rechaza un id antes de repetir uno de otro
+    shard y las filas trasladadas conservan el suyo. Si una secuencia ya salió
+    de su rango (p. ej. el principal superó BLOQUE_IDS antes de agregar
+    shards) falla el arranque: esos ids se reasignan a mano. Con un solo shard
+    no hay rangos.
+    """
+    if len(engines) == 1:
+        return
+    for nombre, motor in engines.items():
+        inicio = indice_shard(nombre) * BLOQUE_IDS
+        fin = inicio + BLOQUE_IDS - 1
+        async with motor.begin() as conn:
+            for tabla in TABLAS_CON_SECUENCIA:
+                secuencia = (await conn.execute(
+                    select(func.pg_get_serial_sequence(tabla, "id"))
+                )).scalar()
+                actual = (await conn.execute(text(f"SELECT last_value FROM {secuencia}"))).scalar()
+                if actual > fin:
+                    raise RuntimeError(
+                        f"La secuencia {secuencia} del shard {nombre} va en {actual}, "
+                        f"fuera de su rango [{inicio}, {fin}]"
+                    )
+                maximo = (await conn.execute(
+                    text("SELECT seqmax FROM pg_sequence WHERE seqrelid = CAST(:secuencia AS regclass)"),
+                    {"secuencia": secuencia}
+                )).scalar()
+                if maximo != fin:
+                    await conn.execute(text(f"ALTER SEQUENCE {secuencia} MAXVALUE {fin}"))
+                if actual < inicio:
+                    await conn.execute(select(func.setval(secuencia, inicio)))
+                    logger.info("Secuencia %s del shard %s llevada a %s", secuencia, nombre, inicio)
+
+
+def tablas_del_negocio(negocio_id: int):
+    """(tabla, filtro de las filas del negocio) en orden de claves foráneas."""
+    C = models.Cliente
+    T = models.Transaccion
+    D = models.Deuda
+    A = models.Abono
+    R = models.ResumenTransacciones
+    clientes = select(C.id).where(C.negocio_id == negocio_id)
+    deudas = select(D.id).where(D.cliente_id.in_(clientes))
+    return [
+        (C.__table__, C.negocio_id == negocio_id),
+        (T.__table__, T.negocio_id == negocio_id),
+        (D.__table__, D.cliente_id.in_(clientes)),
+        (A.__table__, A.deuda_id.in_(deudas)),
+        (R.__table__, R.negocio_id == negocio_id),
+    ]
+
+
+def _posteriores_a(tabla: Table, valores):
+    """Filas con clave primaria mayor que `valores` (recorrido por lotes)."""
+    claves = list(tabla.primary_key.columns)
+    return tuple_(*claves) > tuple_(*(literal(v, c.type) for c, v in zip(claves, valores)))
+
+
+async def _copiar(origen: AsyncConnection, destino: AsyncEngine, tabla: Table, filtro,
+                  desde_xid: Optional[int] = None) -> int:
+    """
+    Copia (upsert) las filas de `tabla` que cumplen `filtro` por lotes de
+    clave primaria. Con `desde_xid` solo las escritas por transacciones
+    iguales o posteriores a esa.
+    """
+    columnas = [c for c in tabla.columns if c.computed is None]
+    claves = list(tabla.primary_key.columns)
+    consulta = select(*columnas).where(filtro).order_by(*claves).limit(SHARDS_LOTE_COPIA)
+    if desde_xid is not None:
+        # age() es la distancia al xid actual: las filas más recientes tienen menor edad
+        consulta = consulta.where(
+            text(f"age({tabla.name}.xmin) <= age(CAST(:desde_xid AS text)::xid)")
+            .bindparams(desde_xid=str(desde_xid))
+        )
+    insercion = pg_insert(tabla)
+    insercion = insercion.on_conflict_do_update(
+        index_elements=claves,
+        set_={c.name: insercion.excluded[c.name] for c in columnas if not c.primary_key}
+    )
+
+    copiadas = 0
+    ultima = None
+    while True:
+        sentencia = consulta if ultima is None else consulta.where(_posteriores_a(tabla, ultima))
+        filas = (await origen.execute(sentencia)).mappings().all()
+        if not filas:
+            break
+        async with destino.begin() as conn:
+            await conn.execute(insercion, [dict(fila) for fila in filas])
+        copiadas += len(filas)
+        ultima = tuple(filas[-1][c.name] for c in claves)
+        if len(filas) < SHARDS_LOTE_COPIA:
+            break
+    metricas.incrementar("traslado_filas", tabla.name, copiadas)
+    return copiadas
+
+
+async def _descartar_borradas(origen: AsyncEngine, destino: AsyncEngine, tabla: Table, filtro) -> int:
+    """Borra en el destino las filas copiadas que ya no existen en el origen."""
+    claves = list(tabla.primary_key.columns)
+    consulta = select(*claves).where(filtro)
+    async with origen.connect() as conn:
+        en_origen = {tuple(fila) for fila in (await conn.execute(consulta)).all()}
+    async with destino.connect() as conn:
+        en_destino = {tuple(fila) for fila in (await conn.execute(consulta)).all()}
+    sobrantes = list(en_destino - en_origen)
+    for inicio in range(0, len(sobrantes), SHARDS_LOTE_COPIA):
+        async with destino.begin() as conn:
+            await conn.execute(
+                delete(tabla).where(tuple_(*claves).in_(sobrantes[inicio:inicio + SHARDS_LOTE_COPIA]))
+            )
+    return len(sobrantes)
+
+
+async def _marcar_migrando(negocio_id: int, migrando: bool):
+    async with engine.begin() as conn:
+        await conn.execute(
+            update(models.Negocio).where(models.Negocio.id == negocio_id).values(migrando=migrando)
+        )
+
+
+async def _limpiar(shard: str, negocio_id: int, progreso: borrado.ProgresoBorrado):
+    """Borra los datos del negocio en `shard` y su copia de la fila del negocio."""
+    motor = engines[shard]
+    await borrado.vaciar_negocio(motor, negocio_id, progreso)
+    if shard != SHARD_PRINCIPAL:
+        # En el principal la fila del negocio es la del directorio
+        async with motor.begin() as conn:
+            await conn.execute(delete(models.Negocio).where(models.Negocio.id == negocio_id))
+
+
+async def mover_negocio(negocio_id: int, destino: str) -> dict:
+    """Traslada los datos de un negocio a otro shard; devuelve un informe con las filas movidas."""
+    if destino not in engines:
+        raise ValueError(f"Shard desconocido: {destino}")
+    # Mismo bloqueo que el borrado: un negocio no se traslada y se borra a la vez
+    async with bloqueo_asesor(f"borrado_negocio_{negocio_id}") as obtenido:
+        if not obtenido:
+            raise RuntimeError("Otro proceso está borrando o trasladando este negocio")
+        return await _mover(negocio_id, destino)
+
+
+async def _mover(negocio_id: int, destino: str) -> dict:
+    async with engine.connect() as conn:
+        negocio = (await conn.execute(
+            select(models.Negocio.__table__).where(models.Negocio.id == negocio_id)
+        )).mappings().first()
+    if negocio is None or negocio["eliminado_en"] is not None:
+        raise ValueError(f"Negocio {negocio_id} no encontrado")
+    origen = negocio["shard"]
+    if origen == destino:
+        raise ValueError(f"El negocio {negocio_id} ya está en {destino}")
+
+    informe = {"negocio_id": negocio_id, "origen": origen, "destino": destino,
+               "copiadas": {}, "recopiadas": {}, "descartadas": {}}
+    motor_origen = engines[origen]
+    motor_destino = engines[destino]
+    tablas = tablas_del_negocio(negocio_id)
+    inicio = time.perf_counter()
+    bloqueo = None
+    try:
+        if destino != SHARD_PRINCIPAL:
+            async with motor_destino.begin() as conn:
+                await conn.execute(
+                    pg_insert(models.Negocio.__table__)
+                    .values(**{**negocio, "shard": destino, "migrando": False})
+                    .on_conflict_do_nothing()
+                )
+
+        # 1. Copia en línea: una sola instantánea para que las claves foráneas cuadren
+        async with motor_origen.connect() as conn:
+            await conn.execution_options(isolation_level="REPEATABLE READ")
+            # Transacciones en curso o posteriores a la instantánea: se revisan en el paso 2
+            marca = (await conn.execute(
+                text("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint % 4294967296")
+            )).scalar()
+            for tabla, filtro in tablas:
+                informe["copiadas"][tabla.name] = await _copiar(conn, motor_destino, tabla, filtro)
+            await conn.rollback()
+
+        # 2. Bloqueo breve: se copia lo que cambió durante la copia y se descarta lo borrado
+        await _marcar_migrando(negocio_id, True)
+        bloqueo = time.perf_counter()
+        async with motor_origen.connect() as bloqueada:
+            # Espera a las escrituras que ya tenían el bloqueo compartido; las
+            # siguientes ven migrando=True y responden 503
+            await bloqueada.execute(select(func.pg_advisory_xact_lock(CLAVE_TRASLADO, negocio_id)))
+            async with motor_origen.connect() as conn:
+                for tabla, filtro in tablas:
+                    informe["recopiadas"][tabla.name] = await _copiar(conn, motor_destino, tabla, filtro, marca)
+            for tabla, filtro in reversed(tablas):
+                informe["descartadas"][tabla.name] = await _descartar_borradas(
+                    motor_origen, motor_destino, tabla, filtro
+                )
+
+            # 3. El directorio apunta al destino y levanta el bloqueo en la misma sentencia
+            async with engine.begin() as conn:
+                await conn.execute(
+                    update(models.Negocio).where(models.Negocio.id == negocio_id)
+                    .values(shard=destino, migrando=False)
+                )
+            # Al cerrar la transacción se libera el advisory lock
+            await bloqueada.rollback()
+    except BaseException:
+        # El origen sigue siendo válido: se desbloquea y se descarta la copia parcial
+        await _marcar_migrando(negocio_id, False)
+        await _limpiar(destino, negocio_id, borrado.ProgresoBorrado(negocio_id))
+        raise
+    informe["segundos_bloqueado"] = round(time.perf_counter() - bloqueo, 2)
+    metricas.observar("traslado_bloqueo_segundos", informe["segundos_bloqueado"])
+
+    # 4. Las filas del origen ya no se leen: se borran por lotes
+    progreso = borrado.ProgresoBorrado(negocio_id)
+    await _limpiar(origen, negocio_id, progreso)
+    informe["borradas_origen"] = progreso.filas_borradas
+    informe["segundos"] = round(time.perf_counter() - inicio, 2)
+    logger.info("Negocio %s trasladado de %s a %s", negocio_id, origen, destino)
+    return informe
+
+
+async def _listar():
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            select(models.Negocio.shard, func.count())
+            .where(models.Negocio.eliminado_en.is_(None))
+            .group_by(models.Negocio.shard)
+        )
+        por_shard = dict(result.all())
+    for nombre in engines:
+        print(f"{nombre} (ids desde {indice_shard(nombre) * BLOQUE_IDS}): {por_shard.get(nombre, 0)} negocios")
+
+
+async def _main(argumentos):
+    parser = argparse.ArgumentParser(description="Shards de datos de negocio")
+    comandos = parser.add_subparsers(dest="comando", required=True)
+    comandos.add_parser("preparar", help="crea o pone al día el esquema en cada shard y ajusta sus secuencias")
+    comandos.add_parser("listar", help="negocios por shard")
+    mover = comandos.add_parser("mover", help="traslada un negocio a otro shard")
+    mover.add_argument("negocio_id", type=int)
+    mover.add_argument("destino")
+    opciones = parser.parse_args(argumentos)
+
+    if opciones.comando == "preparar":
+        for motor in engines.values():
+            async with motor.begin() as conn:
+                await preparar_esquema(conn)
+        await asegurar_secuencias()
+    elif opciones.comando == "listar":
+        await _listar()
+    else:
+        informe = await mover_negocio(opciones.negocio_id, opciones.destino)
+        for clave, valor in informe.items():
+            print(f"{clave}: {valor}")
+    await cerrar_engines()
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main(sys.argv[1:]))
@@ -1,21 +1,91 @@
-import httpx
+import asyncio
+from typing import Optional, TYPE_CHECKING
+
 import os
 
 from dotenv import load_dotenv
 
+if TYPE_CHECKING:
+    import httpx
+
 load_dotenv()
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Límite práctico de la API de bots: ~30 mensajes/segundo en total
+TELEGRAM_MENSAJES_POR_SEGUNDO = float(os.getenv("TELEGRAM_MENSAJES_POR_SEGUNDO", "20"))
+TELEGRAM_MAX_CARACTERES = 4096
+
+
+def _url_envio() -> str:
+    return f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+
 
 async def enviar_mensaje_telegram(chat_id: str, mensaje: str):
     if not TELEGRAM_BOT_TOKEN:
         return
 
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+    url = _url_envio()
 
+    # Importación diferida: httpx solo hace falta con el bot configurado (arranque más rápido)
+    import httpx
     async with httpx.AsyncClient() as client:
         await client.post(url, data={
             "chat_id": chat_id,
             "text": mensaje,
             "parse_mode": "HTML"
         })
+
+
+class EmisorTelegram:
+    """
+    Emisor para envíos masivos: reutiliza una sola conexión HTTP y espacia
+    los mensajes para no superar el límite de la API de Telegram.
+
+    Uso:
+        async with EmisorTelegram() as emisor:
+            await emisor.enviar(chat_id, mensaje)
+    """
+
+    def __init__(self, mensajes_por_segundo: float = TELEGRAM_MENSAJES_POR_SEGUNDO):
+        self._intervalo = 1 / mensajes_por_segundo
+        self._siguiente_envio = 0.0
+        self._turno = asyncio.Lock()
+        self._cliente: Optional["httpx.AsyncClient"] = None
+
+    async def __aenter__(self) -> "EmisorTelegram":
+        import httpx
+        self._cliente = httpx.AsyncClient(timeout=10)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._cliente.aclose()
+        self._cliente = None
+
+    async def _esperar_turno(self):
+        loop = asyncio.get_running_loop()
+        async with self._turno:
+            ahora = loop.time()
+            espera = self._siguiente_envio - ahora
+            self._siguiente_envio = max(ahora, self._siguiente_envio) + self._intervalo
+        if espera > 0:
+            await asyncio.sleep(espera)
+
+    async def enviar(self, chat_id: str, mensaje: str) -> bool:
+        """Envía un mensaje; devuelve True si Telegram lo aceptó."""
+        if not TELEGRAM_BOT_TOKEN:
+            return False
+
+        datos = {
+            "chat_id": chat_id,
+            "text": mensaje[:TELEGRAM_MAX_CARACTERES],
+            "parse_mode": "HTML"
+        }
+        for _ in range(2):
+            await self._esperar_turno()
+            resp = await self._cliente.post(_url_envio(), data=datos)
+            if resp.status_code != 429:
+                return resp.is_success
+            # Telegram indica cuántos segundos esperar antes de reintentar
+            retry_after = resp.json().get("parameters", {}).get("retry_after", 1)
+            await asyncio.sleep(retry_after)
+        return False
@@ -0,0 +1,78 @@
+"""
+Tiempo de arranque de un worker y latencia de la primera consulta, con y sin
+calentamiento.
+
+Uso:
+    python -m benchmarks.bench_arranque [repeticiones]
+
+Cada medición corre en un proceso nuevo (imports en frío). Sin base de datos
+disponible solo se mide el tiempo de importación.
+"""
+import json
+import os
+import subprocess
+import sys
+
+# Se ejecuta en el proceso hijo: importa la app, corre el lifespan y mide
+# la primera y la segunda consulta típica de una petición
+_HIJO = """
+import asyncio, json, time
+inicio = time.perf_counter()
+from app.main import app, lifespan
+importacion = time.perf_counter() - inicio
+resultado = {"importacion_ms": importacion * 1000}
+
+async def medir():
+    from app import crud
+    from app.database import async_session_maker
+    inicio = time.perf_counter()
+    async with lifespan(app):
+        resultado["lifespan_ms"] = (time.perf_counter() - inicio) * 1000
+        for nombre in ("primera_consulta_ms", "segunda_consulta_ms"):
+            inicio = time.perf_counter()
+            async with async_session_maker() as db:
+                await crud.get_usuario_por_email(db, "bench@example.com")
+                await crud.get_cliente(db, 1)
+            resultado[nombre] = (time.perf_counter() - inicio) * 1000
+
+try:
+    asyncio.run(medir())
+except Exception as e:
+    resultado["error"] = type(e).__name__
+print(json.dumps(resultado))
+"""
+
+COLUMNAS = ("importacion_ms", "lifespan_ms", "primera_consulta_ms", "segunda_consulta_ms")
+
+
+def _medir(calentar: bool) -> dict:
+    entorno = dict(os.environ, CALENTAMIENTO_ACTIVO="1" if calentar else "0")
+    # Sin outbox ni recordatorios compitiendo con la medición
+    entorno.pop("TELEGRAM_BOT_TOKEN", None)
+    salida = subprocess.run(
+        [sys.executable, "-c", _HIJO], env=entorno, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(salida.strip().splitlines()[-1])
+
+
+def _mediana(valores):
+    valores = sorted(valores)
+    return valores[len(valores) // 2] if valores else None
+
+
+def main(repeticiones: int):
+    print(f"{'calentamiento':<14}" + "".join(f"{c:>22}" for c in COLUMNAS))
+    for calentar in (False, True):
+        muestras = [_medir(calentar) for _ in range(repeticiones)]
+        errores = {m["error"] for m in muestras if "error" in m}
+        fila = f"{'sí' if calentar else 'no':<14}"
+        for columna in COLUMNAS:
+            mediana = _mediana([m[columna] for m in muestras if columna in m])
+            fila += f"{mediana:>22.1f}" if mediana is not None else f"{'-':>22}"
+        print(fila)
+        if errores:
+            print(f"  (sin base de datos: {', '.join(sorted(errores))})")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,93 @@
+"""
+CPU por llamada de las consultas frecuentes de crud: construidas en cada
+llamada (como antes) frente a las sentencias prearmadas con parámetros
+enlazados de app/crud.py.
+
+Uso:
+    python -m benchmarks.bench_consultas [repeticiones]
+
+No necesita base de datos: mide lo que SQLAlchemy hace antes de enviar la
+consulta (construir la sentencia, calcular su clave de caché y buscar la
+compilación en la caché del engine).
+"""
+import sys
+import time
+
+from sqlalchemy import select, func, union_all
+from sqlalchemy.dialects.postgresql.asyncpg import PGDialect_asyncpg
+from sqlalchemy.orm import joinedload
+
+from app import crud, models
+
+D = models.Deuda
+C = models.Cliente
+
+
+def _membresia(negocio_id, usuario_id):
+    return (
+        select(models.Negocio.shard, models.Negocio.migrando)
+        .join(models.usuarios_negocios, models.Negocio.id == models.usuarios_negocios.c.negocio_id)
+        .where(
+            models.usuarios_negocios.c.negocio_id == negocio_id,
+            models.usuarios_negocios.c.usuario_id == usuario_id,
+            models.Negocio.eliminado_en.is_(None)
+        )
+    )
+
+
+def _balance(negocio_id):
+    T = models.Transaccion
+    R = models.ResumenTransacciones
+    q_vivas = select(T.tipo.label("tipo"), T.monto.label("monto")).where(T.negocio_id == negocio_id)
+    q_archivo = select(R.tipo.label("tipo"), R.total.label("monto")).where(R.negocio_id == negocio_id)
+    movimientos = union_all(q_vivas, q_archivo).subquery()
+    return select(movimientos.c.tipo, func.sum(movimientos.c.monto)).group_by(movimientos.c.tipo)
+
+
+def _resumen_deudas(negocio_id):
+    # Antes eran cuatro consultas; se mide una de ellas por llamada
+    return select(func.coalesce(func.sum(D.saldo_pendiente), 0)).join(C).where(
+        C.negocio_id == negocio_id, D.estado != models.EstadoDeuda.saldado
+    )
+
+
+# (nombre, construcción en cada llamada, sentencia prearmada, consultas por llamada antes)
+CASOS = [
+    ("usuario_en_negocio", lambda i: _membresia(i, i), crud._MEMBRESIA, 1),
+    ("get_cliente", lambda i: select(C).where(C.id == i), crud._CLIENTE_POR_ID, 1),
+    ("get_transaccion", lambda i: select(models.Transaccion).where(models.Transaccion.id == i),
+     crud._TRANSACCION_POR_ID, 1),
+    ("get_deuda", lambda i: select(D).options(joinedload(D.cliente), joinedload(D.transaccion)).where(D.id == i),
+     crud._DEUDA_POR_ID, 1),
+    ("get_balance", _balance, crud._BALANCE[False, False], 1),
+    ("get_resumen_deudas", _resumen_deudas, crud._RESUMEN_DEUDAS, 4),
+]
+
+
+def _preparar(sentencia, dialecto, cache):
+    # Lo mismo que Connection.execute antes de enviar la consulta
+    sentencia._compile_w_cache(dialecto, compiled_cache=cache, column_keys=[])
+
+
+def _medir(funcion, repeticiones: int) -> float:
+    inicio = time.process_time()
+    for i in range(repeticiones):
+        funcion(i)
+    return (time.process_time() - inicio) / repeticiones * 1e6
+
+
+def main(repeticiones: int):
+    dialecto = PGDialect_asyncpg()
+    print(f"{'consulta':<22}{'antes µs':>12}{'después µs':>12}{'mejora':>9}")
+    for nombre, construir, prearmada, consultas in CASOS:
+        cache = {}
+        # Calentamiento: las dos variantes ya compiladas en la caché
+        _preparar(construir(0), dialecto, cache)
+        _preparar(prearmada, dialecto, cache)
+        antes = _medir(lambda i: _preparar(construir(i), dialecto, cache), repeticiones) * consultas
+        despues = _medir(lambda i: _preparar(prearmada, dialecto, cache), repeticiones)
+        print(f"{nombre:<22}{antes:>12.1f}{despues:>12.1f}{antes / despues:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,77 @@
+"""
+Tamaño y tiempo de serialización de los listados según fields= y formato.
+
+Uso:
+    python -m benchmarks.bench_respuestas [cantidad]
+
+No necesita base de datos: usa objetos sintéticos con la forma de las filas ORM.
+"""
+import sys
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+
+from app import schemas
+from app.utils.respuestas import serializar, codificar
+
+REPETICIONES = 20
+
+
+def _deudas(cantidad: int):
+    hoy = datetime(2025, 1, 1)
+    deudas = []
+    for i in range(cantidad):
+        cliente = SimpleNamespace(
+            id=i % 300, negocio_id=1, identidad=f"CC{100000 + i % 300}",
+            nombre=f"Cliente de prueba {i % 300}", created_at=hoy
+        )
+        transaccion = SimpleNamespace(
+            id=i, negocio_id=1, tipo="ingreso", monto=Decimal("150000.00"),
+            descripcion=f"Venta a crédito número {i} de mercancía variada",
+            fecha=date(2025, 1, 1) + timedelta(days=i % 365), created_at=hoy
+        )
+        deudas.append(SimpleNamespace(
+            id=i, transaccion_id=i, cliente_id=cliente.id, monto_total=Decimal("150000.00"),
+            monto_pagado=Decimal("50000.00"), saldo_pendiente=Decimal("100000.00"),
+            estado="parcial", created_at=hoy, cliente=cliente, transaccion=transaccion
+        ))
+    return deudas
+
+
+def _medir(nombre, funcion):
+    inicio = time.perf_counter()
+    for _ in range(REPETICIONES):
+        cuerpo = funcion()
+    ms = (time.perf_counter() - inicio) / REPETICIONES * 1000
+    print(f"{nombre:<50} {len(cuerpo):>10,} B {ms:>9.2f} ms")
+
+
+def main(cantidad: int):
+    deudas = _deudas(cantidad)
+    campos = ["id", "cliente_id", "saldo_pendiente", "estado"]
+    completo = serializar(deudas, schemas.DeudaDetalle)
+    parcial = serializar(deudas, schemas.DeudaDetalle, campos)
+
+    print(f"{cantidad} deudas (DeudaDetalle), promedio de {REPETICIONES} repeticiones")
+    print(f"{'variante':<50} {'bytes':>12} {'tiempo':>12}")
+    variantes = [
+        ("JSON completo", completo, "", ""),
+        ("JSON completo + gzip", completo, "", "gzip"),
+        ("JSON completo + br", completo, "", "br"),
+        ("MessagePack completo", completo, "application/msgpack", ""),
+        ("MessagePack completo + br", completo, "application/msgpack", "br"),
+        ("JSON fields=" + ",".join(campos), parcial, "", ""),
+        ("JSON fields + br", parcial, "", "br"),
+        ("MessagePack fields + br", parcial, "application/msgpack", "br"),
+    ]
+    for nombre, datos, accept, encoding in variantes:
+        _medir(nombre, lambda: codificar(datos, accept, encoding)[0])
+
+    # Costo de construir los dicts (validación Pydantic) con y sin fields=
+    _medir("serializar completo (sin codificar)", lambda: str(serializar(deudas, schemas.DeudaDetalle)).encode())
+    _medir("serializar fields (sin codificar)", lambda: str(serializar(deudas, schemas.DeudaDetalle, campos)).encode())
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)